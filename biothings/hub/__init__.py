@@ -196,7 +196,9 @@ class HubServer(object):
         each feature corresponds to one or more managers. Parameter defaults to
         all possible available. Managers are configured/init in the same order as the list,
         so if a manager (eg. job_manager) is required by all others, it must be the first
-        in the list.
+        in the list. Optional features, not part of default ones:
+            - "loopwatch": report callbacks blocking the event loop longer than
+              config.HUB_LOOP_BLOCKING_THRESHOLD (command "loop_blocking")
         "managers_custom_args" is an optional dict used to pass specific arguments while
         init managers:
             managers_custom_args={"upload" : {"poll_schedule" : "*/5 * * * *"}}
@@ -313,6 +315,11 @@ class HubServer(object):
     def configure_job_manager(self):
         import asyncio
         loop = asyncio.get_event_loop()
+        if getattr(config,"HUB_LOOP_DEBUG",False):
+            # asyncio debug mode logs (logger "asyncio") any callback or task step
+            # blocking the event loop longer than the threshold (in seconds)
+            loop.set_debug(True)
+            loop.slow_callback_duration = getattr(config,"HUB_LOOP_BLOCKING_THRESHOLD",0.1)
         from biothings.utils.manager import JobManager
         args = self.mixargs("job",{"num_workers":config.HUB_MAX_WORKERS,"max_memory_usage":config.HUB_MAX_MEM_USAGE})
         job_manager = JobManager(loop,**args)
@@ -526,6 +533,16 @@ class HubServer(object):
         reloader = HubReloader(monitored_folders, reload_managers, reload_func=reload_func)
         reloader.monitor()
 
+    def configure_loopwatch_feature(self):
+        # opt-in: detect callbacks blocking the event loop (see biothings.utils.loopwatch)
+        from biothings.utils.loopwatch import LoopWatchdog
+        job_manager = self.managers["job_manager"]
+        self.loop_watchdog = LoopWatchdog(job_manager.loop,
+                threshold=getattr(config,"HUB_LOOP_BLOCKING_THRESHOLD",0.1),logger=self.logger)
+        # blocking durations exposed along with job manager's metrics
+        job_manager.metrics_registry.register(self.loop_watchdog.histogram)
+        self.loop_watchdog.start()
+
     def configure_remaining_features(self):
         self.logger.info("Setting up remaining features: %s" % self.remaining_features)
         # specific order, eg. job_manager is used by all managers
@@ -560,6 +577,7 @@ class HubServer(object):
         if self.managers.get("upload_manager"):
             self.commands["upload"] = self.managers["upload_manager"].upload_src
             self.commands["upload_all"] = self.managers["upload_manager"].upload_all
+            self.commands["build_id_cache"] = self.managers["upload_manager"].build_id_cache
         # building/merging
         if self.managers.get("build_manager"):
             self.commands["whatsnew"] = CommandDefinition(command=self.managers["build_manager"].whatsnew,tracked=False)
@@ -624,6 +642,9 @@ class HubServer(object):
             self.extra_commands["jm"] = CommandDefinition(command=self.managers["job_manager"],tracked=False)
             self.extra_commands["top"] = CommandDefinition(command=self.managers["job_manager"].top,tracked=False)
             self.extra_commands["job_info"] = CommandDefinition(command=self.managers["job_manager"].job_info,tracked=False)
+            self.extra_commands["metrics"] = CommandDefinition(command=self.managers["job_manager"].metrics,tracked=False)
+        if "loopwatch" in self.features:
+            self.extra_commands["loop_blocking"] = CommandDefinition(command=self.loop_watchdog.report,tracked=False)
         if self.managers.get("source_manager"):
             self.extra_commands["sm"] = CommandDefinition(command=self.managers["source_manager"],tracked=False)
             self.extra_commands["sources"] = CommandDefinition(command=self.managers["source_manager"].get_sources,tracked=False)
@@ -705,6 +726,8 @@ class HubServer(object):
             self.api_endpoints.pop("publish")
         if "diff" in cmdnames: self.api_endpoints["diff"] = EndpointDefinition(name="diff",method="put",force_bodyargs=True)
         if "job_info" in cmdnames: self.api_endpoints["job_manager"] = EndpointDefinition(name="job_info",method="get")
+        if "metrics" in cmdnames: self.api_endpoints["job_manager/metrics"] = EndpointDefinition(name="metrics",method="get")
+        if "loop_blocking" in cmdnames: self.api_endpoints["loop_blocking"] = EndpointDefinition(name="loop_blocking",method="get")
         if "dump_info" in cmdnames: self.api_endpoints["dump_manager"] = EndpointDefinition(name="dump_info", method="get")
         if "upload_info" in cmdnames: self.api_endpoints["upload_manager"] = EndpointDefinition(name="upload_info",method="get")
         if "build_config_info" in cmdnames: self.api_endpoints["build_manager"] = EndpointDefinition(name="build_config_info",method="get")
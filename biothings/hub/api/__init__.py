@@ -5,9 +5,10 @@ import pprint
 import socket, contextlib
 
 import tornado.web
-from biothings.hub.api.handlers.base import GenericHandler, RootHandler
+from biothings.hub.api.handlers.base import GenericHandler, RootHandler, MetricsHandler
 from biothings.utils.hub import CompositeCommand, CommandInformation, CommandError,\
                                 CommandDefinition
+from biothings.utils.hub_db import run_in_executor
 
 class EndpointDefinition(dict): pass
 
@@ -114,7 +115,11 @@ def %(method)s(self%(mandatargs)s):
     strcmd = '''%(name)s''' + "("
     strcmd += ",".join([str(k) + "=" + repr(v) for k,v in cmdargs.items()])
     strcmd += ")"
-    res = command(**cmdargs)
+    if getattr(command,"__offload__",False) or getattr(getattr(command,"func",None),"__offload__",False):
+        # only blocking on hub db, run it in a thread to keep the event loop responsive
+        res = yield from run_in_executor(command,**cmdargs)
+    else:
+        res = command(**cmdargs)
     # ... but we register the command in the shell to track it
     cmdres = shell.register_command(strcmd,res)
     if type(cmdres) == CommandInformation:# or type(cmdres) == list and type(:
@@ -185,7 +190,7 @@ def generate_handler(shell, name, command_defs):
         command_globals = {}
         endpoint_ns = {"command":command,"asyncio":asyncio,
                        "shell":shell,"CommandInformation":CommandInformation,
-                       "tornado":tornado}
+                       "tornado":tornado,"run_in_executor":run_in_executor}
         eval(code,endpoint_ns,command_globals)
         methodfunc = command_globals[method]
         confdict[method] = methodfunc
@@ -241,6 +246,9 @@ def create_handlers(shell, command_defs):
 def generate_api_routes(shell, commands, settings={}):
     routes = create_handlers(shell,commands)
     routes.append(("/",RootHandler,{"features" : shell.server.DEFAULT_FEATURES}))
+    if shell.job_manager:
+        # plain text metrics, to be scraped (Prometheus format)
+        routes.append(("/metrics",MetricsHandler,{"job_manager" : shell.job_manager}))
     return routes
 
 def start_api(app, port, check=True, wait=5, retry=5, settings={}):
@@ -79,3 +79,17 @@ class RootHandler(DefaultHandler):
                 "now": datetime.datetime.now(),
                 "features": self.features,
                 })
+
+
+class MetricsHandler(RequestHandler):
+    """
+    Job manager's metrics in Prometheus text format (not wrapped in JSON,
+    see DefaultHandler)
+    """
+
+    def initialize(self, job_manager, **kwargs):
+        self.job_manager = job_manager
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(self.job_manager.metrics(fmt="text"))
@@ -207,6 +207,10 @@ class TargetDocMongoBackend(TargetDocBackend,DocMongoBackend):
         super(TargetDocMongoBackend,self).set_target_name(target_name,build_name)
         self.target_collection = self.target_db[self._target_name]
 
+    def drop(self):
+        super(TargetDocMongoBackend,self).drop()
+        get_content_hash_collection(self.target_collection).drop()
+
 
 class ShardedTargetDocMongoBackend(TargetDocMongoBackend):
 
@@ -252,6 +256,15 @@ class LinkTargetDocMongoBackend(TargetDocBackend):
         pass
 
 
+def get_content_hash_collection(col):
+    """
+    Return side collection storing content hashes for documents in
+    collection "col" (see DataBuilder.content_hash). Hash documents are
+    keyed by _id, with one field per merged source.
+    """
+    return col.database["content_hash_%s" % col.name]
+
+
 def create_backend(db_col_names,name_only=False,follow_ref=False,**kwargs):
     """
     Guess what's inside 'db_col_names' and return the corresponding backend.
@@ -280,7 +293,7 @@ def create_backend(db_col_names,name_only=False,follow_ref=False,**kwargs):
             db_col_names = ["%s:%s" % (db.client.HOST,db.client.PORT),db.name,col.name]
     elif db_col_names[0].startswith("mongodb://"):
         assert len(db_col_names) == 3, "Missing connection information for %s" % repr(db_col_names)
-        conn = mongo.MongoClient(db_col_names[0])
+        conn = mongo.get_client(db_col_names[0])
         db = conn[db_col_names[1]]
         col = db[db_col_names[2]]
         # normalize params
@@ -10,23 +10,26 @@ from pprint import pformat
 import asyncio
 from functools import partial
 import glob, random
+import threading
 import aiocron
 
 from .mapper import TransparentMapper
 from ..dataload.uploader import ResourceNotReady
 from .differ import set_pending_to_diff
 from ..databuild.backend import SourceDocMongoBackend, TargetDocMongoBackend, \
-                                LinkTargetDocMongoBackend
+                                LinkTargetDocMongoBackend, get_content_hash_collection
 from biothings.utils.common import timesofar, iter_n, get_timestamp, dotdict, \
                                    dump, rmdashfr, loadobj, open_compressed_file, \
-                                   get_class_from_classpath, find_classes_subclassing
-from biothings.utils.mongo import doc_feeder, id_feeder
+                                   get_class_from_classpath, find_classes_subclassing, \
+                                   content_hash
+from biothings.utils.mongo import doc_feeder, id_feeder, get_id_ranges, id_range_query
 from biothings.utils.loggers import get_logger
-from biothings.utils.manager import BaseManager, ManagerError
+from biothings.utils.manager import BaseManager, ManagerError, get_worker_resource
 from biothings.utils.dataload import update_dict_recur, merge_struct
 import biothings.utils.mongo as mongo
 from biothings.utils.hub_db import get_source_fullname, get_src_build_config, \
-                                   get_src_build, get_src_dump, get_src_master
+                                   get_src_build, get_src_dump, get_src_master, offload, \
+                                   run_in_executor
 from biothings import config as btconfig
 from biothings.hub import UPLOADER_CATEGORY, BUILDER_CATEGORY
 from .backend import create_backend
@@ -45,6 +48,13 @@ class DataBuilder(object):
     """
 
     keep_archive = 10 # number of archived collection to keep. Oldest get dropped first.
+    id_prefetch_size = 10 # number of _id batches fetched in advance while merging a source
+    merge_mode = "ids" # "ids": send batches of _ids to merger workers, "range": send _id boundaries
+                       # (can be overridden with "merge_mode" key in build_config)
+    content_hash = False # store a content hash per document and source, in a side collection, so differ
+                         # can skip identical documents (can be overridden with "content_hash" key in
+                         # build_config). Ignored if post_merge() is overridden, as it may modify documents
+                         # after hashes are computed.
 
     def __init__(self, build_name, source_backend, target_backend, log_folder,
                  doc_root_key="root", mappers=[], default_mapper_class=TransparentMapper,
@@ -509,44 +519,42 @@ class DataBuilder(object):
                 if "metadata" in steps:
                     pinfo = self.get_pinfo()
                     pinfo["step"] = "metadata"
-                    self.register_status("building",transient=True,init=True,job={"step":"metadata"})
+                    yield from run_in_executor(self.register_status,"building",transient=True,init=True,job={"step":"metadata"})
                     postjob = yield from job_manager.defer_to_thread(pinfo,
                             partial(self.store_metadata,res,sources=sources,job_manager=job_manager))
-                    def stored(f):
-                        try:
-                            nonlocal res
-                            if res:
-                                res = f.result() # consume to trigger exceptions if any
-                            strargs = "[sources=%s,stats=%s]" % \
-                                    (sources,self.merge_stats)
-                            build_version = self.get_build_version()
-                            if "." in build_version:
-                                raise BuilderException("Can't use '.' in build version '%s', it's reserved for minor versions" % build_version)
-                            # get original start dt
-                            src_build = self.source_backend.build
-                            build = src_build.find_one({'_id': target_name})
-                            _meta = {
-                                    "biothing_type" : build["build_config"]["doc_type"],
-                                    "src" : self.src_meta,
-                                    "stats" : self.stats,
-                                    "build_version" : build_version,
-                                    "build_date" : datetime.fromtimestamp(self.t0).isoformat()}
-                            # custom
-                            _meta.update(self.custom_metadata)
-                            self.register_status('success',build={
-                                "merge_stats" : self.merge_stats,
-                                "mapping" : self.mapping,
-                                "_meta" : _meta,
-                                })
-                            self.logger.info("success %s" % strargs,extra={"notify":True})
-                            set_pending_to_diff(target_name)
-                        except Exception as e:
-                            strargs = "[sources=%s]" % sources
-                            self.register_status("failed",job={"err": repr(e)})
-                            self.logger.exception("failed %s: %s" % (strargs,e),extra={"notify":True})
-                            raise
-                    postjob.add_done_callback(stored)
-                    yield from postjob
+                    def stored():
+                        strargs = "[sources=%s,stats=%s]" % \
+                                (sources,self.merge_stats)
+                        build_version = self.get_build_version()
+                        if "." in build_version:
+                            raise BuilderException("Can't use '.' in build version '%s', it's reserved for minor versions" % build_version)
+                        # get original start dt
+                        src_build = self.source_backend.build
+                        build = src_build.find_one({'_id': target_name})
+                        _meta = {
+                                "biothing_type" : build["build_config"]["doc_type"],
+                                "src" : self.src_meta,
+                                "stats" : self.stats,
+                                "build_version" : build_version,
+                                "build_date" : datetime.fromtimestamp(self.t0).isoformat()}
+                        # custom
+                        _meta.update(self.custom_metadata)
+                        self.register_status('success',build={
+                            "merge_stats" : self.merge_stats,
+                            "mapping" : self.mapping,
+                            "_meta" : _meta,
+                            })
+                        self.logger.info("success %s" % strargs,extra={"notify":True})
+                        set_pending_to_diff(target_name)
+                    try:
+                        yield from postjob
+                        # hub db calls, run out of the event loop
+                        yield from run_in_executor(stored)
+                    except Exception as e:
+                        strargs = "[sources=%s]" % sources
+                        yield from run_in_executor(self.register_status,"failed",job={"err": repr(e)})
+                        self.logger.exception("failed %s: %s" % (strargs,e),extra={"notify":True})
+                        raise
 
             task = asyncio.ensure_future(do())
             return task
@@ -638,30 +646,30 @@ class DataBuilder(object):
 
         if do_merge:
             if root_sources:
-                self.register_status("building",transient=True,init=True,
+                yield from run_in_executor(self.register_status,"building",transient=True,init=True,
                         job={"step":"merge-root","sources":root_sources})
                 self.logger.info("Merging root document sources: %s" % root_sources)
                 yield from merge(root_sources)
-                self.register_status("success",job={"step":"merge-root","sources":root_sources})
+                yield from run_in_executor(self.register_status,"success",job={"step":"merge-root","sources":root_sources})
 
             if other_sources:
-                self.register_status("building",transient=True,init=True,
+                yield from run_in_executor(self.register_status,"building",transient=True,init=True,
                         job={"step":"merge-others","sources":other_sources})
                 self.logger.info("Merging other resources: %s" % other_sources)
                 yield from merge(other_sources)
-                self.register_status("success",job={"step":"merge-others","sources":other_sources})
+                yield from run_in_executor(self.register_status,"success",job={"step":"merge-others","sources":other_sources})
 
-            self.register_status("building",transient=True,init=True,
+            yield from run_in_executor(self.register_status,"building",transient=True,init=True,
                     job={"step":"finalizing"})
             self.logger.info("Finalizing target backend")
             self.target_backend.finalize()
-            self.register_status("success",job={"step":"finalizing"})
+            yield from run_in_executor(self.register_status,"success",job={"step":"finalizing"})
         else:
             self.logger.info("Skip data merging")
 
         if do_post_merge:
             self.logger.info("Running post-merge process")
-            self.register_status("building",transient=True,init=True,job={"step":"post-merge"})
+            yield from run_in_executor(self.register_status,"building",transient=True,init=True,job={"step":"post-merge"})
             pinfo = self.get_pinfo()
             pinfo["step"] = "post-merge"
             job = yield from job_manager.defer_to_thread(pinfo,partial(self.post_merge, source_names, batch_size, job_manager))
@@ -669,7 +677,6 @@ class DataBuilder(object):
             def postmerged(f):
                 try:
                     self.logger.info("Post-merge completed [%s]" % f.result())
-                    self.register_status("success",job={"step":"post-merge"})
                 except Exception as e:
                     self.logger.exception("Failed post-merging source: %s" % e)
                     nonlocal got_error
@@ -678,12 +685,34 @@ class DataBuilder(object):
             res = yield from job
             if got_error:
                 raise got_error
+            yield from run_in_executor(self.register_status,"success",job={"step":"post-merge"})
         else:
             self.logger.info("Skip post-merge process")
 
         yield from asyncio.sleep(0.0)
         return self.merge_stats
 
+    def use_content_hash(self):
+        """
+        Return True if content hashes must be stored while merging (see content_hash).
+        Hashes are computed from merged documents, before post-merge step: if post_merge()
+        is overridden, documents may change afterward so no hashes are stored (differ
+        then compares all documents).
+        """
+        store_hashes = self.build_config.get("content_hash",self.content_hash)
+        if store_hashes and type(self).post_merge is not DataBuilder.post_merge:
+            self.logger.warning("post_merge() is overridden and may modify documents, content hashes disabled")
+            return False
+        return store_hashes
+
+    def get_max_inflight_jobs(self, job_manager):
+        """
+        Return the number of merger jobs submitted at the same time to the job manager
+        while merging a source. Default is the size of the process pool, so workers are
+        kept busy without flooding the queue with pending jobs.
+        """
+        return job_manager.process_queue._max_workers or btconfig.HUB_MAX_WORKERS
+
     def document_cleaner(self,src_name,*args,**kwargs):
         """
         Return a function taking a document as argument, cleaning the doc
@@ -715,24 +744,36 @@ class DataBuilder(object):
         got_error = False
         # grab ids only, so we can get more, let's say 10 times more
         id_batch_size = batch_size * 10
-        if ids:
-            self.logger.info("Merging '%s' specific list of _ids, create merger job with batch_size=%d" % (src_name, batch_size))
-            id_provider = [ids]
-        else:
-            self.logger.info("Fetch _ids from '%s' with batch_size=%d, and create merger job with batch_size=%d" % (src_name, id_batch_size, batch_size))
-            id_provider = id_feeder(self.source_backend[src_name], batch_size=id_batch_size)
+        store_hashes = self.use_content_hash()
+        merge_mode = self.build_config.get("merge_mode",self.merge_mode)
+        use_ranges = merge_mode == "range" and ids is None and not _query
+        if merge_mode == "range" and not use_ranges:
+            self.logger.info("Specific list of _ids or query/filter involved, can't use merge_mode='range', sending _ids to workers")
 
         if _query and not ids is None:
             self.logger.info("Query/filter involved, but also specific list of _ids. Ignoring query and use _ids")
 
-        if _query and ids is None:
+        if use_ranges:
+            self.logger.info("Splitting '%s' into _id ranges of about %d documents" % (src_name,batch_size))
+            src_col = self.source_backend[src_name]
+            def range_provider():
+                # boundaries sampling is a blocking call, it'll run within prefetch thread.
+                # ranges cover all _id types found in the collection
+                for id_range in get_id_ranges(src_col,batch_size):
+                    yield id_range
+            id_provider = range_provider()
+        elif ids:
+            self.logger.info("Merging '%s' specific list of _ids, create merger job with batch_size=%d" % (src_name, batch_size))
+            # when passing a list of _ids, IDs will be sent to the query, so we need to reduce the batch size
+            id_provider = iter_n(ids,int(batch_size/100))
+        elif _query:
             self.logger.info("Query/filter involved, can't use cache to fetch _ids")
             # use doc_feeder but post-process doc to keep only the _id
             id_provider = map(lambda docs: [d["_id"] for d in docs],doc_feeder(self.source_backend[src_name], query=_query,
                     step=batch_size, inbatch=True, fields={"_id":1}))
         else:
-            # when passing a list of _ids, IDs will be sent to the query, so we need to reduce the batch size
-            id_provider = ids and iter_n(ids,int(batch_size/100)) or id_feeder(self.source_backend[src_name],
+            self.logger.info("Fetch _ids from '%s' with batch_size=%d, and create merger job with batch_size=%d" % (src_name, id_batch_size, batch_size))
+            id_provider = id_feeder(self.source_backend[src_name],
                     batch_size=id_batch_size,logger=self.logger)
 
         src_master = self.source_backend.master
@@ -741,12 +782,27 @@ class DataBuilder(object):
         self.logger.info("Documents from source '%s' will be merged using %s" % (src_name,merger))
 
         doc_cleaner = self.document_cleaner(src_name)
-        for big_doc_ids in id_provider:
-            for doc_ids in iter_n(big_doc_ids,batch_size):
-                # try to put some async here to give control back
-                # (but everybody knows it's a blocking call: doc_feeder)
-                yield from asyncio.sleep(0.1)
-                cnt += len(doc_ids)
+        # fetching _ids is a blocking call (cursor or cache file), it runs in a thread
+        # and fills a bounded queue while we keep as many merger jobs in flight as
+        # there are workers in the process pool
+        max_inflight = self.get_max_inflight_jobs(job_manager)
+        batches, stop_prefetch = prefetch_id_batches(id_provider, not use_ranges and batch_size or None,
+                                                     job_manager.loop, maxsize=self.id_prefetch_size)
+        inflight = set()
+        try:
+            while True:
+                doc_ids = yield from batches.get()
+                if doc_ids is None:
+                    break # no more _ids
+                if isinstance(doc_ids,Exception):
+                    raise doc_ids
+                id_range = None
+                if use_ranges:
+                    # range size is an estimation
+                    id_range, doc_ids = doc_ids, None
+                    cnt = min(cnt + batch_size,total)
+                else:
+                    cnt += len(doc_ids)
                 pinfo = self.get_pinfo()
                 pinfo["step"] = src_name
                 pinfo["description"] = "#%d/%d (%.1f%%)" % (bnum,btotal,(cnt/total*100))
@@ -762,17 +818,25 @@ class DataBuilder(object):
                             doc_cleaner,
                             upsert,
                             merger,
-                            bnum))
+                            bnum,
+                            id_range=id_range,
+                            store_hashes=store_hashes))
                 def batch_merged(f,batch_num):
                     nonlocal got_error
                     if type(f.result()) != int:
                         got_error = Exception("Batch #%s failed while merging source '%s' [%s]" % (batch_num,src_name,f.result()))
                 job.add_done_callback(partial(batch_merged,batch_num=bnum))
                 jobs.append(job)
+                inflight.add(job)
                 bnum += 1
+                # pool is saturated, wait for one job to finish before submitting more
+                if len(inflight) >= max_inflight:
+                    _, inflight = yield from asyncio.wait(inflight,return_when=asyncio.FIRST_COMPLETED)
                 # raise error as soon as we know
                 if got_error:
                     raise got_error
+        finally:
+            stop_prefetch()
         self.logger.info("%d jobs created for merging step" % len(jobs))
         tasks = asyncio.gather(*jobs)
         def done(f):
@@ -860,13 +924,69 @@ def fix_batch_duplicates(docs, fail_if_struct_is_different=False):
     return dids.values()
 
 
-def merger_worker(col_name,dest_name,ids,mapper,cleaner,upsert,merger,batch_num):
+def prefetch_id_batches(id_provider, batch_size, loop, maxsize=10):
+    """
+    Consume id_provider (an iterable over lists of _ids, like id_feeder) in a
+    background thread, splitting lists in batches of batch_size, and store them
+    in a bounded asyncio.Queue (up to maxsize batches fetched in advance).
+    If batch_size is None, elements from id_provider are queued as-is.
+    None is queued once all batches were produced. If id_provider raises an
+    exception, the exception is queued instead. Returns (queue,stop) where
+    stop() is a function to call to interrupt the thread before completion.
+    """
+    queue = asyncio.Queue(maxsize=maxsize, loop=loop)
+    stopped = threading.Event()
+
+    def put(item):
+        # blocks until there's room in the queue
+        asyncio.run_coroutine_threadsafe(queue.put(item),loop).result()
+
+    def produce():
+        try:
+            for big_doc_ids in id_provider:
+                for doc_ids in batch_size and iter_n(big_doc_ids,batch_size) or [big_doc_ids]:
+                    if stopped.is_set():
+                        return
+                    put(doc_ids)
+        except Exception as e:
+            logging.exception("Error while fetching _ids: %s" % e)
+            if not stopped.is_set():
+                put(e)
+            return
+        if not stopped.is_set():
+            put(None)
+
+    def stop():
+        stopped.set()
+        # free the queue so a blocked producer can see it's been stopped
+        while not queue.empty():
+            queue.get_nowait()
+
+    thread = threading.Thread(target=produce,name="id_prefetch",daemon=True)
+    thread.start()
+    return queue, stop
+
+
+def merger_worker(col_name,dest_name,ids,mapper,cleaner,upsert,merger,batch_num,id_range=None,
+                  store_hashes=False):
+    """
+    Merge documents from source collection col_name into target collection dest_name.
+    Documents are selected either from a list of _ids ("ids") or, if id_range is passed
+    as (lo,hi) boundaries (see biothings.utils.mongo.id_ranges()), with a range scan
+    on _id index (ids is then ignored).
+    If store_hashes, a content hash of each merged document is stored in the
+    target's content hash collection, under a field named after the source.
+    """
     try:
-        src = mongo.get_src_db()
-        tgt = mongo.get_target_db()
+        # connections opened once per worker process, reused batch after batch
+        src = get_worker_resource("src_db")
+        tgt = get_worker_resource("target_db")
         col = src[col_name]
         dest = DocMongoBackend(tgt,tgt[dest_name])
-        cur = doc_feeder(col, step=len(ids), inbatch=False, query={'_id': {'$in': ids}})
+        if id_range:
+            cur = doc_feeder(col, step=10000, inbatch=False, query=id_range_query(*id_range))
+        else:
+            cur = doc_feeder(col, step=len(ids), inbatch=False, query={'_id': {'$in': ids}})
         if cleaner:
             cur = map(cleaner,cur)
         mapper.load()
@@ -887,12 +1007,17 @@ def merger_worker(col_name,dest_name,ids,mapper,cleaner,upsert,merger,batch_num)
                 ddocs[d["_id"]] = merge_struct(d,ddocs[d["_id"]])
             docs = list(ddocs.values())
         cnt = dest.update(docs, upsert=upsert)
+        if store_hashes:
+            # same upsert rule as target documents, hash docs mirror target's _ids
+            hashes = DocMongoBackend(tgt,get_content_hash_collection(tgt[dest_name]))
+            field = col_name.replace(".","_")
+            hashes.update([{"_id" : d["_id"], field : content_hash(d)} for d in docs], upsert=upsert)
         return cnt
     except Exception as e:
         logger_name = "build_%s_%s_batch_%s" % (dest_name,col_name,batch_num)
         logger,_ = get_logger(logger_name, btconfig.LOG_FOLDER)
         logger.exception(e)
-        logger.error("col_name: %s, dest_name: %s, ids: see pickle, " % (col_name,dest_name) + \
+        logger.error("col_name: %s, dest_name: %s, ids: see pickle, id_range: %s, " % (col_name,dest_name,repr(id_range)) + \
                 "mapper: %s, cleaner: %s, upsert: %s, " % (mapper,cleaner,upsert) + \
                 "merger: %s, batch_num: %s" % (merger,batch_num))
         exc_fn = os.path.join(btconfig.LOG_FOLDER,"%s.exc.pick" % logger_name)
@@ -1034,6 +1159,7 @@ class BuilderManager(BaseManager):
         target_db = mongo.get_target_db()
         col = target_db[merge_name]
         col.drop()
+        get_content_hash_collection(col).drop()
 
     def delete_merge(self,merge_name):
         """Delete merged collections and associated metadata"""
@@ -1308,6 +1434,7 @@ class BuilderManager(BaseManager):
         res["builder_classes"] = bclasses
         return res
 
+    @offload
     def build_info(self,id=None,conf_name=None,fields=None,only_archived=False):
         """
         Return build information given an build _id, or all builds
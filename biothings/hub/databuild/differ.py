@@ -9,17 +9,19 @@ import glob, random
 
 from biothings.utils.common import timesofar, iter_n, get_timestamp, \
                                    dump, rmdashfr, loadobj, md5sum
-from biothings.utils.mongo import id_feeder, get_target_db, get_previous_collection
-from biothings.utils.hub_db import get_src_build, get_source_fullname
+from biothings.utils.mongo import id_feeder, get_target_db, get_previous_collection, \
+                                  get_id_ranges, id_range_query
+from biothings.utils.hub_db import get_src_build, get_source_fullname, run_in_executor
 from biothings.utils.loggers import get_logger
-from biothings.utils.diff import diff_docs_jsonpatch
-from biothings.hub.databuild.backend import generate_folder
+from biothings.utils.diff import diff_docs_jsonpatch, diff_doc_jsonpatch, merge_join_iterator
+from biothings.hub.databuild.backend import generate_folder, get_content_hash_collection
 from biothings import config as btconfig
 from biothings.utils.manager import BaseManager, ManagerError
 from .backend import create_backend, merge_src_build_metadata
 from .syncer import SyncerManager
 from biothings.utils.backend import DocMongoBackend
 import biothings.utils.aws as aws
+from biothings.utils import diffstream
 from biothings.utils.jsondiff import make as jsondiff
 from biothings.utils.hub import publish_data_version
 from biothings.hub import DIFFER_CATEGORY, DIFFMANAGER_CATEGORY
@@ -37,6 +39,16 @@ class BaseDiffer(object):
     # diff type name, identifying the diff algorithm
     # must be set in sub-class
     diff_type = None
+    # how content is compared:
+    # - "ids": iterate over _ids from new (then old) collection, fetching docs
+    #          from other collection by batch of _ids
+    # - "mergejoin": walk both collections sorted by _id, in one pass, for each
+    #          _id range (only for mongo collections and jsonpatch diff)
+    # None means default from config (DIFF_ENGINE)
+    diff_engine = None
+    # diff files format: "pyobj" (compressed pickled dict) or "ndjson" (see biothings.utils.diffstream,
+    # streamable, reduced by concatenation)
+    diff_format = "pyobj"
 
     def __init__(self, diff_func, job_manager, log_folder):
         self.old = None
@@ -57,6 +69,57 @@ class BaseDiffer(object):
     def get_predicates(self):
         return []
 
+    def get_diff_engine(self, content_old, content_new):
+        engine = self.diff_engine or getattr(btconfig,"DIFF_ENGINE","ids")
+        if engine == "mergejoin":
+            if not (isinstance(content_old,DocMongoBackend) and isinstance(content_new,DocMongoBackend)):
+                self.logger.warning("Merge join diff engine requires mongo collections, using 'ids' engine")
+                engine = "ids"
+            elif self.diff_func != diff_docs_jsonpatch:
+                self.logger.warning("Merge join diff engine only supports jsonpatch diff, using 'ids' engine")
+                engine = "ids"
+        return engine
+
+    @asyncio.coroutine
+    def diff_content_mergejoin(self, content_old, content_new, old_db_col_names, new_db_col_names,
+                               batch_size, diff_folder, exclude, diff_stats):
+        """
+        Compare old and new collections with a merge join: _id ranges of
+        about batch_size documents are determined from both collections (per
+        _id type, so documents with an _id type only found in old collection
+        are reported as deleted), then for each range (in parallel), both
+        collections are walked sorted by _id. Added, updated and deleted
+        documents are found in a single pass.
+        """
+        pinfo = self.get_pinfo()
+        pinfo["source"] = "%s vs %s" % (content_new.target_name,content_old.target_name)
+        pinfo["step"] = "content: id ranges"
+        job = yield from self.job_manager.defer_to_thread(pinfo,
+                partial(get_id_ranges, [content_old.target_collection,content_new.target_collection], batch_size))
+        ranges = yield from job
+        self.logger.info("Diffing content with merge join over %d _id ranges" % len(ranges))
+        selfcontained = "selfcontained" in self.diff_type
+        pinfo["step"] = "content: merge join"
+        jobs = []
+        def diffed(f):
+            res = f.result()
+            for k in ["update","add","delete"]:
+                diff_stats[k] += res[k]
+            if res.get("diff_file"):
+                self.metadata["diff"]["files"].append(res["diff_file"])
+            self.logger.info("(Updated: {}, Added: {}, Deleted: {})".format(res["update"], res["add"], res["delete"]))
+        for cnt,id_range in enumerate(ranges,start=1):
+            pinfo["description"] = "batch #%s" % cnt
+            self.logger.info("Creating diff worker for batch #%s" % cnt)
+            job = yield from self.job_manager.defer_to_process(pinfo,
+                    partial(diff_worker_mergejoin, id_range, old_db_col_names,
+                            new_db_col_names, cnt, diff_folder, exclude, selfcontained,
+                            self.diff_format))
+            job.add_done_callback(diffed)
+            jobs.append(job)
+        yield from asyncio.gather(*jobs)
+        yield from run_in_executor(self.register_status,"success",job={"step":"diff-content"})
+
     def get_pinfo(self):
         """
         Return dict containing information about the current process
@@ -250,7 +313,6 @@ class BaseDiffer(object):
 
             def mapping_diffed(f):
                 res = f.result()
-                self.register_status("success",job={"step":"diff-mapping"})
                 if res.get("mapping_file"):
                     nonlocal got_error
                     # check mapping differences: only "add" ops are allowed, as any others actions would be
@@ -273,16 +335,24 @@ class BaseDiffer(object):
             pinfo = self.get_pinfo()
             pinfo["source"] = "%s vs %s" % (self.new.target_name,self.old.target_name)
             pinfo["step"] = "mapping: old vs new"
-            self.register_status("diffing",transient=True,init=True,job={"step":"diff-mapping"})
+            yield from run_in_executor(self.register_status,"diffing",transient=True,init=True,job={"step":"diff-mapping"})
             job = yield from self.job_manager.defer_to_thread(pinfo,
                     partial(diff_mapping, self.old, self.new, diff_folder))
             job.add_done_callback(mapping_diffed)
             yield from job
+            yield from run_in_executor(self.register_status,"success",job={"step":"diff-mapping"})
             if got_error:
                 raise got_error
 
         if content_old == content_new:
             self.logger.info("Old and new collections are the same, skipping 'content' step")
+        elif "content" in steps and self.get_diff_engine(content_old,content_new) == "mergejoin":
+            yield from run_in_executor(self.register_status,"diffing",transient=True,init=True,job={"step":"diff-content"})
+            yield from self.diff_content_mergejoin(content_old, content_new, old_db_col_names,
+                    new_db_col_names, batch_size, diff_folder, exclude, diff_stats)
+            self.logger.info("Finished calculating diff. Total number of docs updated: {}, added: {}, deleted: {}".format(
+                diff_stats["update"], diff_stats["add"], diff_stats["delete"]))
+            json.dump(self.metadata,open(self.metadata_filename,"w"),indent=True)
         elif "content" in steps:
             skip = 0
             cnt = 0
@@ -292,8 +362,12 @@ class BaseDiffer(object):
             pinfo["step"] = "content: new vs old"
             data_new = id_feeder(content_new, batch_size=batch_size)
             selfcontained = "selfcontained" in self.diff_type
-            self.register_status("diffing",transient=True,init=True,job={"step":"diff-content"})
-            for id_list_new in data_new:
+            yield from run_in_executor(self.register_status,"diffing",transient=True,init=True,job={"step":"diff-content"})
+            while True:
+                # id_feeder blocks (hub db metadata, cache file or cursor), fetch out of the loop
+                id_list_new = yield from run_in_executor(next,data_new,None)
+                if id_list_new is None:
+                    break
                 cnt += 1
                 pinfo["description"] = "batch #%s" % cnt
                 def diffed(f):
@@ -303,14 +377,15 @@ class BaseDiffer(object):
                     if res.get("diff_file"):
                         self.metadata["diff"]["files"].append(res["diff_file"])
                     self.logger.info("(Updated: {}, Added: {})".format(res["update"], res["add"]))
-                    self.register_status("success",job={"step":"diff-content"})
                 self.logger.info("Creating diff worker for batch #%s" % cnt)
                 job = yield from self.job_manager.defer_to_process(pinfo,
                         partial(diff_worker_new_vs_old, id_list_new, old_db_col_names,
-                                new_db_col_names, cnt , diff_folder, self.diff_func, exclude, selfcontained))
+                                new_db_col_names, cnt , diff_folder, self.diff_func, exclude, selfcontained,
+                                self.diff_format))
                 job.add_done_callback(diffed)
                 jobs.append(job)
             yield from asyncio.gather(*jobs)
+            yield from run_in_executor(self.register_status,"success",job={"step":"diff-content"})
             self.logger.info("Finished calculating diff for the new collection. Total number of docs updated: {}, added: {}".format(diff_stats["update"], diff_stats["add"]))
 
             data_old = id_feeder(content_old, batch_size=batch_size)
@@ -318,7 +393,10 @@ class BaseDiffer(object):
             pinfo = self.get_pinfo()
             pinfo["source"] = "%s vs %s" % (content_old.target_name,content_new.target_name)
             pinfo["step"] = "content: old vs new"
-            for id_list_old in data_old:
+            while True:
+                id_list_old = yield from run_in_executor(next,data_old,None)
+                if id_list_old is None:
+                    break
                 cnt += 1
                 pinfo["description"] = "batch #%s" % cnt
                 def diffed(f):
@@ -329,7 +407,8 @@ class BaseDiffer(object):
                     self.logger.info("(Deleted: {})".format(res["delete"]))
                 self.logger.info("Creating diff worker for batch #%s" % cnt)
                 job = yield from self.job_manager.defer_to_process(pinfo,
-                        partial(diff_worker_old_vs_new, id_list_old, new_db_col_names, cnt , diff_folder))
+                        partial(diff_worker_old_vs_new, id_list_old, new_db_col_names, cnt , diff_folder,
+                                self.diff_format))
                 job.add_done_callback(diffed)
                 jobs.append(job)
             yield from asyncio.gather(*jobs)
@@ -365,7 +444,7 @@ class BaseDiffer(object):
                     except Exception as e:
                         got_error = e
 
-                diff_files = [f for f in glob.glob(os.path.join(diff_folder,"*.pyobj")) \
+                diff_files = [f for f in glob_diff_files(diff_folder) \
                         if not os.path.basename(f).startswith("mapping")]
                 self.logger.info("%d diff files to process in total" % len(diff_files))
                 jobs = []
@@ -375,7 +454,7 @@ class BaseDiffer(object):
                         self.logger.info("%d diff files to process" % len(diff_files))
                     if current_size > max_diff_size:
                         job = yield from self.job_manager.defer_to_process(pinfo,
-                                partial(reduce_diffs,tomerge,cnt,diff_folder,done_folder))
+                                partial(reduce_diffs,tomerge,cnt,diff_folder,done_folder,self.diff_format))
                         job.add_done_callback(partial(merged,cnt=cnt))
                         jobs.append(job)
                         current_size = 0
@@ -390,7 +469,7 @@ class BaseDiffer(object):
 
                 if tomerge:
                     job = yield from self.job_manager.defer_to_process(pinfo,
-                                partial(reduce_diffs,tomerge,cnt,diff_folder,done_folder))
+                                partial(reduce_diffs,tomerge,cnt,diff_folder,done_folder,self.diff_format))
                     job.add_done_callback(partial(merged,cnt=cnt))
                     jobs.append(job)
                     yield from job
@@ -403,20 +482,20 @@ class BaseDiffer(object):
             pinfo["source"] = "diff_folder"
             pinfo["step"] = "reduce"
             #job = yield from self.job_manager.defer_to_thread(pinfo,merge_diff)
-            self.register_status("diffing",transient=True,init=True,job={"step":"diff-reduce"})
+            yield from run_in_executor(self.register_status,"diffing",transient=True,init=True,job={"step":"diff-reduce"})
             res = yield from merge_diff()
             self.metadata["diff"]["files"] = res
             json.dump(self.metadata,open(self.metadata_filename,"w"),indent=True)
             if got_error:
                 self.logger.exception("Failed to reduce diff files: %s" % got_error,extra={"notify":True})
                 raise got_error
-            self.register_status("success",job={"step":"diff-reduce"})
+            yield from run_in_executor(self.register_status,"success",job={"step":"diff-reduce"})
 
         if "post" in steps:
             pinfo = self.get_pinfo()
             pinfo["source"] = "diff_folder"
             pinfo["step"] = "post"
-            self.register_status("diffing",transient=True,init=True,job={"step":"diff-post"})
+            yield from run_in_executor(self.register_status,"diffing",transient=True,init=True,job={"step":"diff-post"})
             job = yield from self.job_manager.defer_to_thread(pinfo,
                              partial(self.post_diff_cols, old_db_col_names, new_db_col_names,
                                                           batch_size, steps, mode=mode, exclude=exclude))
@@ -424,16 +503,16 @@ class BaseDiffer(object):
                 nonlocal got_error
                 try:
                     res = f.result()
-                    self.register_status("success",job={"step":"diff-post"},diff={"post": res})
                     self.logger.info("Post diff process successfully run: %s" % res)
                 except Exception as e:
                     got_error = e
             job.add_done_callback(posted)
-            yield from job
+            res = yield from job
             json.dump(self.metadata,open(self.metadata_filename,"w"),indent=True)
             if got_error:
                 self.logger.exception("Failed to run post diff process: %s" % got_error,extra={"notify":True})
                 raise got_error
+            yield from run_in_executor(self.register_status,"success",job={"step":"diff-post"},diff={"post": res})
 
         strargs = "[old=%s,new=%s,steps=%s,diff_stats=%s]" % (old_db_col_names,new_db_col_names,steps,diff_stats)
         self.logger.info("success %s" % strargs,extra={"notify":True})
@@ -443,7 +522,7 @@ class BaseDiffer(object):
         self.metadata.pop("build_config",None)
         # record diff_folder so it's available for later without re-computing it
         self.metadata["diff_folder"] = diff_folder
-        self.register_status("success",diff=self.metadata)
+        yield from run_in_executor(self.register_status,"success",diff=self.metadata)
         return diff_stats
 
     def diff(self,old_db_col_names, new_db_col_names, batch_size=100000, steps=["content","mapping","reduce","post"], mode=None, exclude=[]):
@@ -547,12 +626,12 @@ class ColdHotJsonDifferBase(ColdHotDiffer):
         coldcol = get_target_db()[new_doc["build_config"]["cold_collection"]]
         assert coldcol.count() > 0, "Cold collection is empty..."
         diff_folder = generate_folder(btconfig.DIFF_PATH,old_db_col_names,new_db_col_names)
-        diff_files = glob.glob(os.path.join(diff_folder,"diff_*.pyobj"))
+        diff_files = glob_diff_files(diff_folder,"diff_*")
         fixed = 0
         for diff_file in diff_files:
             dirty = False
             self.logger.info("Post-processing diff file %s" % diff_file)
-            data = loadobj(diff_file)
+            data = load_diff(diff_file)
             # update/remove case #1
             for updt in data["update"]:
                 toremove = []
@@ -594,7 +673,10 @@ class ColdHotJsonDifferBase(ColdHotDiffer):
                 data["delete"].remove(i)
 
             if dirty:
-                dump(data,diff_file,compress="lzma")
+                if diffstream.is_diffstream(diff_file):
+                    diffstream.dump_diff(data,diff_file)
+                else:
+                    dump(data,diff_file,compress="lzma")
                 name = os.path.basename(diff_file)
                 md5 = md5sum(diff_file)
                 # find info to adjust md5sum
@@ -629,17 +711,51 @@ class ColdHotSelfContainedJsonDiffer(ColdHotJsonDifferBase, SelfContainedJsonDif
     diff_type = "coldhot-jsondiff-selfcontained"
 
 
+def dump_diff_result(result, diff_folder, batch_num, diff_format="pyobj"):
+    """
+    Write diff result (dict with add/update/delete/source/timestamp keys) in
+    diff_folder using diff_format, return file information for metadata
+    """
+    if diff_format == "ndjson":
+        file_name = os.path.join(diff_folder,"%s%s" % (batch_num,diffstream.EXTENSION))
+        diffstream.dump_diff(result, file_name)
+    elif diff_format == "pyobj":
+        file_name = os.path.join(diff_folder,"%s.pyobj" % str(batch_num))
+        dump(result, file_name)
+    else:
+        raise DifferException("Unknown diff format '%s'" % diff_format)
+    # compute md5 so when downloaded, users can check integreity
+    return {"name" : os.path.basename(file_name),
+            "md5sum" : md5sum(file_name),
+            "size" : os.stat(file_name).st_size}
+
+
+def load_diff(diff_file):
+    """Load diff file content (whatever the format) as a dict"""
+    if diffstream.is_diffstream(diff_file):
+        return diffstream.DiffStreamReader(diff_file).load()
+    return loadobj(diff_file)
+
+
+def glob_diff_files(diff_folder, pattern="*"):
+    """Return diff files (any format) found in diff_folder"""
+    return glob.glob(os.path.join(diff_folder,"%s.pyobj" % pattern)) + \
+           glob.glob(os.path.join(diff_folder,"%s%s" % (pattern,diffstream.EXTENSION)))
+
+
 def diff_worker_new_vs_old(id_list_new, old_db_col_names, new_db_col_names,
-                           batch_num, diff_folder, diff_func, exclude=[], selfcontained=False):
+                           batch_num, diff_folder, diff_func, exclude=[], selfcontained=False,
+                           diff_format="pyobj"):
     new = create_backend(new_db_col_names,follow_ref=True)
     old = create_backend(old_db_col_names,follow_ref=True)
     docs_common = old.mget_from_ids(id_list_new)
     ids_common = [_doc['_id'] for _doc in docs_common]
     id_in_new = list(set(id_list_new) - set(ids_common))
     _updates = []
-    if len(ids_common) > 0:
-        _updates = diff_func(old, new, list(ids_common), exclude_attrs=exclude)
-    file_name = os.path.join(diff_folder,"%s.pyobj" % str(batch_num))
+    # only documents with different content hashes need a proper diff
+    ids_changed = get_changed_ids(old, new, ids_common)
+    if len(ids_changed) > 0:
+        _updates = diff_func(old, new, list(ids_changed), exclude_attrs=exclude)
     _result = {'add': id_in_new,
                'update': _updates,
                'delete': [],
@@ -650,23 +766,33 @@ def diff_worker_new_vs_old(id_list_new, old_db_col_names, new_db_col_names,
         _result["add"] = [d for d in new.mget_from_ids(id_in_new)]
     summary = {"add" : len(id_in_new), "update" : len(_updates), "delete" : 0}
     if len(_updates) != 0 or len(id_in_new) != 0:
-        dump(_result, file_name)
-        # compute md5 so when downloaded, users can check integreity
-        md5 = md5sum(file_name)
-        summary["diff_file"] = {
-                "name" : os.path.basename(file_name),
-                "md5sum" : md5,
-                "size" : os.stat(file_name).st_size
-                }
+        summary["diff_file"] = dump_diff_result(_result, diff_folder, batch_num, diff_format)
 
     return summary
 
-def diff_worker_old_vs_new(id_list_old, new_db_col_names, batch_num, diff_folder):
+def get_changed_ids(old, new, ids):
+    """
+    Return _ids (from ids list) for which content hashes are different (or missing)
+    between old and new backends. If both backends don't have content hashes
+    (see DataBuilder.content_hash), ids are returned as-is.
+    """
+    if not (isinstance(old,DocMongoBackend) and isinstance(new,DocMongoBackend)):
+        return ids
+    old_hashes = get_content_hash_collection(old.target_collection)
+    new_hashes = get_content_hash_collection(new.target_collection)
+    if not old_hashes.name in old_hashes.database.collection_names() or \
+            not new_hashes.name in new_hashes.database.collection_names():
+        return ids
+    old_docs = dict([(d["_id"],d) for d in old_hashes.find({"_id" : {"$in" : ids}})])
+    new_docs = dict([(d["_id"],d) for d in new_hashes.find({"_id" : {"$in" : ids}})])
+    return [_id for _id in ids if not _id in old_docs or old_docs[_id] != new_docs.get(_id)]
+
+
+def diff_worker_old_vs_new(id_list_old, new_db_col_names, batch_num, diff_folder, diff_format="pyobj"):
     new = create_backend(new_db_col_names,follow_ref=True)
     docs_common = new.mget_from_ids(id_list_old)
     ids_common = [_doc['_id'] for _doc in docs_common]
     id_in_old = list(set(id_list_old)-set(ids_common))
-    file_name = os.path.join(diff_folder,"%s.pyobj" % str(batch_num))
     _result = {'delete': id_in_old,
                'add': [],
                'update': [],
@@ -674,14 +800,60 @@ def diff_worker_old_vs_new(id_list_old, new_db_col_names, batch_num, diff_folder
                'timestamp': get_timestamp()}
     summary = {"add" : 0, "update": 0, "delete" : len(id_in_old)}
     if len(id_in_old) != 0:
-        dump(_result, file_name)
-        # compute md5 so when downloaded, users can check integreity
-        md5 = md5sum(file_name)
-        summary["diff_file"] = {
-                "name" : os.path.basename(file_name),
-                "md5sum" : md5,
-                "size" : os.stat(file_name).st_size
-                }
+        summary["diff_file"] = dump_diff_result(_result, diff_folder, batch_num, diff_format)
+
+    return summary
+
+
+def diff_worker_mergejoin(id_range, old_db_col_names, new_db_col_names,
+                          batch_num, diff_folder, exclude=[], selfcontained=False, diff_format="pyobj"):
+    """
+    Diff documents within id_range (tuple (lower,upper[,query]), None meaning unbounded,
+    see id_range_query()) by walking old and new collections sorted by _id, producing
+    add/update/delete in one diff file. Documents found in both collections are only
+    compared if their content hashes differ (see get_changed_ids()).
+    """
+    new = create_backend(new_db_col_names,follow_ref=True)
+    old = create_backend(old_db_col_names,follow_ref=True)
+    query = id_range_query(*id_range)
+    old_cur = old.target_collection.find(query,no_cursor_timeout=True).sort("_id",1)
+    new_cur = new.target_collection.find(query,no_cursor_timeout=True).sort("_id",1)
+    _add = []
+    _updates = []
+    _delete = []
+    common = []
+    def diff_common():
+        if not common:
+            return
+        changed = set(get_changed_ids(old, new, [old_doc["_id"] for old_doc,_ in common]))
+        for old_doc,new_doc in common:
+            if old_doc["_id"] in changed:
+                _diff = diff_doc_jsonpatch(old_doc, new_doc, exclude_attrs=exclude)
+                if _diff:
+                    _updates.append(_diff)
+        common.clear()
+    try:
+        for old_doc, new_doc in merge_join_iterator(old_cur,new_cur):
+            if old_doc is None:
+                _add.append(selfcontained and new_doc or new_doc["_id"])
+            elif new_doc is None:
+                _delete.append(old_doc["_id"])
+            else:
+                common.append((old_doc,new_doc))
+                if len(common) >= 1000:
+                    diff_common()
+        diff_common()
+    finally:
+        old_cur.close()
+        new_cur.close()
+    _result = {'add': _add,
+               'update': _updates,
+               'delete': _delete,
+               'source': new.target_name,
+               'timestamp': get_timestamp()}
+    summary = {"add" : len(_add), "update" : len(_updates), "delete" : len(_delete)}
+    if _add or _updates or _delete:
+        summary["diff_file"] = dump_diff_result(_result, diff_folder, batch_num, diff_format)
 
     return summary
 
@@ -1009,7 +1181,7 @@ class DifferManager(BaseManager):
                 raise Exception("Can't perform detailed analysis without a metadata file")
 
         def analyze(diff_file, detailed):
-            data = loadobj(diff_file)
+            data = load_diff(diff_file)
             sources[data["source"]] = 1
             if detailed:
                 # TODO: if self-contained, no db connection needed
@@ -1054,7 +1226,7 @@ class DifferManager(BaseManager):
         # we randomize files order b/c we randomly pick some examples from those
         # files. If files contains data in order (like chrom 1, then chrom 2)
         # we won't have a representative sample
-        files = glob.glob(os.path.join(data_folder,"*.pyobj"))
+        files = glob_diff_files(data_folder)
         random.shuffle(files)
         total = len(files)
         for i,f in enumerate(files):
@@ -1081,7 +1253,7 @@ class DifferManager(BaseManager):
         self.diff(diff_type, old_db_col_names, new_db_col_names, **kwargs)
 
     def rebuild_diff_file_list(self,diff_folder):
-        diff_files = glob.glob(os.path.join(diff_folder,"*.pyobj"))
+        diff_files = glob_diff_files(diff_folder)
         metadata = json.load(open(os.path.join(diff_folder,"metadata.json")))
         try:
             metadata["diff"]["files"] = []
@@ -1108,10 +1280,10 @@ class DifferManager(BaseManager):
         return res
 
 
-def reduce_diffs(diffs, num, diff_folder, done_folder):
+def reduce_diffs(diffs, num, diff_folder, done_folder, diff_format="pyobj"):
     assert diffs
     res = []
-    fn = "diff_%s.pyobj" % num
+    fn = "diff_%s%s" % (num,diff_format == "ndjson" and diffstream.EXTENSION or ".pyobj")
     logging.info("Merging %s => %s" % ([os.path.basename(f) for f in diffs],fn))
 
     if len(diffs) == 1:
@@ -1122,6 +1294,15 @@ def reduce_diffs(diffs, num, diff_folder, done_folder):
         os.rename(diffs[0],os.path.join(done_folder,os.path.basename(diffs[0])))
         return res
 
+    if diff_format == "ndjson":
+        # streamed format: merging is a concatenation
+        file_name = os.path.join(diff_folder,fn)
+        diffstream.concat_diffs(diffs,file_name)
+        for diff_fn in diffs:
+            os.rename(diff_fn,os.path.join(done_folder,os.path.basename(diff_fn)))
+        res.append({"name":fn,"md5sum":md5sum(file_name),"size" : os.stat(file_name).st_size})
+        return res
+
     merged = loadobj(diffs[0])
     os.rename(diffs[0],os.path.join(done_folder,os.path.basename(diffs[0])))
     for diff_fn in diffs[1:]:
@@ -20,6 +20,7 @@ from biothings.utils.manager import BaseManager, ManagerError
 from .backend import create_backend, generate_folder
 from ..dataload.storage import UpsertStorage
 import biothings.utils.jsonpatch as jsonpatch
+from biothings.utils import diffstream
 from biothings.hub import SYNCER_CATEGORY
 
 logging = btconfig.logger
@@ -397,6 +398,23 @@ class ThrottledESColdHotJsonDiffSyncer(ThrottlerSyncer,ESColdHotJsonDiffSyncer):
 class ThrottledESColdHotJsonDiffSelfContainedSyncer(ThrottlerSyncer,ESColdHotJsonDiffSelfContainedSyncer): pass
 
 
+def load_diff_file(diff_file):
+    """
+    Return diff file content. "ndjson" diff files are streamed (add/update/delete
+    operations are iterables read from the file), with bounded memory.
+    """
+    if diffstream.is_diffstream(diff_file):
+        return diffstream.DiffStreamReader(diff_file)
+    return loadobj(diff_file)
+
+
+def docs_from_ids(col, ids, batch_size):
+    """Iterate over documents from collection col, querying _ids by batch"""
+    for batch_ids in iter_n(ids,batch_size):
+        for doc in doc_feeder(col, step=batch_size, inbatch=False, query={'_id': {'$in': list(batch_ids)}}):
+            yield doc
+
+
 # TODO: refactor workers (see sync_es_...)
 def sync_mongo_jsondiff_worker(diff_file, old_db_col_names, new_db_col_names, batch_size, cnt,
         force=False, selfcontained=False, metadata={}, debug=False):
@@ -406,13 +424,13 @@ def sync_mongo_jsondiff_worker(diff_file, old_db_col_names, new_db_col_names, ba
     synced_file = "%s.synced" % diff_file
     if os.path.exists(synced_file):
         logging.info("Diff file '%s' already synced, skip it" % os.path.basename(diff_file))
-        diff = loadobj(synced_file)
+        diff = load_diff_file(synced_file)
         res["skipped"] += len(diff["add"]) + len(diff["delete"]) + len(diff["update"])
         return res
     new = create_backend(new_db_col_names)
     old = create_backend(old_db_col_names)
     storage = UpsertStorage(get_target_db(),old.target_collection.name,logging)
-    diff = loadobj(diff_file)
+    diff = load_diff_file(diff_file)
     assert new.target_collection.name == diff["source"], "Source is different in diff file '%s': %s" % (diff_file,diff["source"])
 
     # add: get ids from "new" 
@@ -421,7 +439,7 @@ def sync_mongo_jsondiff_worker(diff_file, old_db_col_names, new_db_col_names, ba
         for docs in iter_n(diff["add"],batch_size):
             res["added"] += storage.process((d for d in docs),batch_size)
     else:
-        cur = doc_feeder(new.target_collection, step=batch_size, inbatch=False, query={'_id': {'$in': diff["add"]}})
+        cur = docs_from_ids(new.target_collection, diff["add"], batch_size)
         for docs in iter_n(cur,batch_size):
             # use generator otherwise process/doc_iterator will require a dict (that's bad...)
             res["added"] += storage.process((d for d in docs),batch_size)
@@ -463,7 +481,7 @@ def sync_es_jsondiff_worker(diff_file, es_config, new_db_col_names, batch_size,
     synced_file = "%s.synced" % diff_file
     if os.path.exists(synced_file):
         logging.info("Diff file '%s' already synced, skip it" % os.path.basename(diff_file))
-        diff = loadobj(synced_file)
+        diff = load_diff_file(synced_file)
         res["skipped"] += len(diff["add"]) + len(diff["delete"]) + len(diff["update"])
         return res
     eskwargs = {}
@@ -477,7 +495,7 @@ def sync_es_jsondiff_worker(diff_file, es_config, new_db_col_names, batch_size,
     logging.debug("Create ES backend with args: (%s,%s)" % (es_config,eskwargs))
     bckend = create_backend(es_config,**eskwargs)
     indexer = bckend.target_esidxer
-    diff = loadobj(diff_file)
+    diff = load_diff_file(diff_file)
     errors = []
     # add: get ids from "new" 
     if selfcontained:
@@ -486,7 +504,7 @@ def sync_es_jsondiff_worker(diff_file, es_config, new_db_col_names, batch_size,
     else:
         new = create_backend(new_db_col_names) # mongo collection to sync from
         assert new.target_collection.name == diff["source"], "Source is different in diff file '%s': %s" % (diff_file,diff["source"])
-        cur = doc_feeder(new.target_collection, step=batch_size, inbatch=False, query={'_id': {'$in': diff["add"]}})
+        cur = docs_from_ids(new.target_collection, diff["add"], batch_size)
     for docs in iter_n(cur,batch_size):
         # remove potenial existing _timestamp from document
         # (not allowed within an ES document (_source))
@@ -540,7 +558,7 @@ def sync_es_coldhot_jsondiff_worker(diff_file, es_config, new_db_col_names, batc
     synced_file = "%s.synced" % diff_file
     if os.path.exists(synced_file):
         logging.info("Diff file '%s' already synced, skip it" % os.path.basename(diff_file))
-        diff = loadobj(synced_file)
+        diff = load_diff_file(synced_file)
         res["skipped"] += len(diff["add"]) + len(diff["delete"]) + len(diff["update"])
         return res
     eskwargs = {}
@@ -554,7 +572,7 @@ def sync_es_coldhot_jsondiff_worker(diff_file, es_config, new_db_col_names, batc
     logging.debug("Create ES backend with args: (%s,%s)" % (es_config,eskwargs))
     bckend = create_backend(es_config,**eskwargs)
     indexer = bckend.target_esidxer
-    diff = loadobj(diff_file)
+    diff = load_diff_file(diff_file)
     errors = []
 
     # add: diff between hot collections showed we have new documents but it's
@@ -567,7 +585,7 @@ def sync_es_coldhot_jsondiff_worker(diff_file, es_config, new_db_col_names, batc
     else:
         new = create_backend(new_db_col_names) # mongo collection to sync from
         assert new.target_collection.name == diff["source"], "Source is different in diff file '%s': %s" % (diff_file,diff["source"])
-        cur = doc_feeder(new.target_collection, step=batch_size, inbatch=False, query={'_id': {'$in': diff["add"]}})
+        cur = docs_from_ids(new.target_collection, diff["add"], batch_size)
     for docs in iter_n(cur,batch_size):
         # remove potenial existing _timestamp from document
         # (not allowed within an ES document (_source))
@@ -629,15 +647,13 @@ def sync_es_coldhot_jsondiff_worker(diff_file, es_config, new_db_col_names, batc
 
 def sync_es_for_update(diff_file, indexer, diffupdates, batch_size, res, debug):
     batch = []
-    ids = [p["_id"] for p in diffupdates]
-    iterids_bcnt = iter_n(ids,batch_size,True)
-    for batchids,bcnt in iterids_bcnt:
+    # diffupdates can be a stream (see load_diff_file()), it's consumed by batch
+    for patch_infos,bcnt in iter_n(diffupdates,batch_size,True):
+        batchids = [p["_id"] for p in patch_infos]
         try:
             for i,doc in enumerate(indexer.get_docs(batchids)):
-                # recompute correct index in diff["update"], since we split it in batches
-                diffidx = i + bcnt - len(batchids) # len(batchids) is not == batch_size for the last one...
                 try:
-                    patch_info = diffupdates[diffidx] # same order as what's return by get_doc()...
+                    patch_info = patch_infos[i] # same order as what's return by get_doc()...
                     assert patch_info["_id"] == doc["_id"],"%s != %s" % (patch_info["_id"],doc["_id"]) # ... but just make sure
                     newdoc = jsonpatch.apply_patch(doc,patch_info["patch"])
                     if newdoc == doc:
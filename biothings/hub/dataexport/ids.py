@@ -1,4 +1,4 @@
-import os, subprocess, shutil
+import os, subprocess, shutil, heapq
 from functools import partial
 from boto import connect_s3
 from biothings.utils.aws import send_s3_file
@@ -6,12 +6,33 @@ from biothings.utils.aws import send_s3_file
 from biothings.utils.hub_db import get_src_dump, get_src_build
 from biothings.utils.mongo import get_src_db, id_feeder, get_target_db, \
                                   get_cache_filename
-from biothings.utils.common import anyfile
+from biothings.utils.common import anyfile, get_compressed_outfile
+from biothings.utils.idcache import MmapIdCache
 
 from biothings import config as btconfig
 logging = btconfig.logger
 
 
+def export_mmap_ids(cache_files, outfn):
+    """
+    Write the sorted, unique list of _ids found in binary (CACHE_FORMAT="mmap")
+    cache files into outfn (xz compressed). Cache files are already sorted so they're
+    merged without loading _ids in memory.
+    """
+    caches = [MmapIdCache(cache_file) for cache_file in cache_files]
+    try:
+        with get_compressed_outfile(outfn,compress="xz") as fout:
+            prev = None
+            for _id in heapq.merge(*caches):
+                if _id == prev:
+                    continue
+                prev = _id
+                fout.write(("%s\n" % _id).encode())
+    finally:
+        for cache in caches:
+            cache.close()
+
+
 def export_ids(col_name):
     """
     Export all _ids from collection named col_name.
@@ -64,7 +85,20 @@ def export_ids(col_name):
     # because it would load _id in memory (unless using hacks) so use cat (and
     # existing uncompressing ones, like gzcat/xzcat/...) to fully run the pipe
     # on the shell
-    if cold:
+    if getattr(btconfig,"CACHE_FORMAT",None) == "mmap":
+        # binary format, can't be copied or cat'ed as-is
+        logging.info("Exporting _ids from binary cache file(s)")
+        try:
+            export_mmap_ids([col_ids_cache] + (cold and [cold_ids_cache] or []),outfn)
+        except Exception as e:
+            logging.error("Error while exporting _ids: %s" % e)
+            # make sure to clean empty or half processed files
+            try:
+                os.unlink(outfn)
+            finally:
+                pass
+            raise
+    elif cold:
         fout = anyfile(outfn,"wb")
         colext = os.path.splitext(col_ids_cache)[1]
         coldext = os.path.splitext(cold_ids_cache)[1]
@@ -1,10 +1,20 @@
-import biothings.utils.redis as redis
+import os
+import sqlite3
+
+from biothings.utils.common import iter_n
+
 
 class IDCache(object):
 
     def mark_done(self,_ids):
         raise NotImplementedError()
 
+    def missing(self,_ids):
+        """
+        Return _ids (from given list) not marked as done yet
+        """
+        raise NotImplementedError()
+
     def load(self, name, id_provider, flush=True):
         """
         name is the cache name
@@ -17,6 +27,8 @@ class IDCache(object):
 class RedisIDCache(IDCache):
 
     def __init__(self, name, connection_params):
+        # redis is optional, only required for this cache
+        import biothings.utils.redis as redis
         self.name = name
         self.redis_client = redis.RedisClient(connection_params)
         try:
@@ -37,4 +49,115 @@ class RedisIDCache(IDCache):
         db  = self.redis_client.get_db(self.name)
         db.delete(*_ids)
 
-        
+    def missing(self,_ids):
+        db  = self.redis_client.get_db(self.name)
+        # loaded _ids are deleted once done
+        return [_id for _id,val in zip(_ids,db.mget(_ids)) if not val is None]
+
+
+class SqliteIDCache(IDCache):
+    """
+    File-backed done-set: _ids marked as done are stored in a SQLite database
+    file, so it can be shared between processes (workers marking _ids once
+    indexed) and survive a restart (resuming only what's missing).
+    """
+
+    # max number of SQL variables per query (SQLITE_MAX_VARIABLE_NUMBER, old default)
+    chunk_size = 500
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.execute("CREATE TABLE IF NOT EXISTS done (_id TEXT PRIMARY KEY) WITHOUT ROWID")
+        # batch numbers fully done, and how _ids were batched (see check_batches())
+        self.execute("CREATE TABLE IF NOT EXISTS batches (num INTEGER PRIMARY KEY)")
+        self.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    def connect(self):
+        # one connection per operation: cache is used from several processes
+        conn = sqlite3.connect(self.filename,timeout=60)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def execute(self, query, *args):
+        conn = self.connect()
+        try:
+            with conn:
+                return conn.execute(query,*args).fetchall()
+        finally:
+            conn.close()
+
+    def load(self, name, id_provider, flush=True):
+        """
+        Initialize done-set (emptied if flush is True), id_provider
+        returns batches of _ids already done. name is ignored, the
+        done-set is identified by its filename.
+        """
+        if flush:
+            self.execute("DELETE FROM done")
+            self.execute("DELETE FROM batches")
+            self.execute("DELETE FROM meta")
+        for _ids in id_provider:
+            self.mark_done(_ids)
+
+    def mark_done(self,_ids,batch_num=None):
+        """
+        Mark _ids as done, and batch number batch_num if given (all
+        its _ids are then done)
+        """
+        conn = self.connect()
+        try:
+            with conn:
+                conn.executemany("INSERT OR IGNORE INTO done VALUES (?)",((_id,) for _id in _ids))
+                if batch_num is not None:
+                    conn.execute("INSERT OR IGNORE INTO batches VALUES (?)",(batch_num,))
+        finally:
+            conn.close()
+
+    def check_batches(self, signature):
+        """
+        Record signature of how _ids are split into batches (ex: _id cache file
+        and batch size, None if unknown). Batch numbers marked as done are only
+        meaningful with the same signature: return True if it's the one recorded,
+        otherwise forget about done batches (not done _ids) and return False.
+        """
+        conn = self.connect()
+        try:
+            with conn:
+                rows = conn.execute("SELECT value FROM meta WHERE key = 'batches'").fetchall()
+                if signature is not None and rows and rows[0][0] == signature:
+                    return True
+                conn.execute("DELETE FROM batches")
+                conn.execute("INSERT OR REPLACE INTO meta VALUES ('batches',?)",(signature,))
+                return False
+        finally:
+            conn.close()
+
+    def next_batch(self, first=1):
+        """
+        Return the first batch number, from "first", not marked as done:
+        batches before it are all done.
+        """
+        for (num,) in self.execute("SELECT num FROM batches WHERE num >= ? ORDER BY num",(first,)):
+            if num != first:
+                break
+            first += 1
+        return first
+
+    def missing(self,_ids):
+        done = set()
+        conn = self.connect()
+        try:
+            for chunk in iter_n(_ids,self.chunk_size):
+                query = "SELECT _id FROM done WHERE _id IN (%s)" % ",".join("?" * len(chunk))
+                done.update(row[0] for row in conn.execute(query,chunk))
+        finally:
+            conn.close()
+        return [_id for _id in _ids if not _id in done]
+
+    def __len__(self):
+        return self.execute("SELECT COUNT(*) FROM done")[0][0]
+
+    def delete(self):
+        for suffix in ["","-wal","-shm"]:
+            if os.path.exists(self.filename + suffix):
+                os.remove(self.filename + suffix)
@@ -8,34 +8,85 @@ from functools import partial
 from elasticsearch import Elasticsearch
 
 import biothings.utils.mongo as mongo
-from biothings.utils.hub_db import get_src_build
+from biothings.utils.hub_db import get_src_build, run_in_executor
 import biothings.utils.aws as aws
 from biothings.utils.common import timesofar, get_random_string, iter_n, \
-                                   get_class_from_classpath, get_dotfield_value
+                                   get_class_from_classpath, get_dotfield_value, \
+                                   sizeof_fmt
 from biothings.utils.loggers import get_logger
-from biothings.utils.manager import BaseManager
-from biothings.utils.es import ESIndexer, IndexerException as ESIndexerException
+from biothings.utils.manager import BaseManager, get_worker_resource
+from biothings.utils.es import ESIndexer, IndexerException as ESIndexerException, get_es
 from biothings.utils.backend import DocESBackend
 from biothings import config as btconfig
-from biothings.utils.mongo import doc_feeder, id_feeder
+from biothings.utils.mongo import doc_feeder, id_feeder, get_id_boundaries, \
+                                  id_ranges, id_range_query, get_cache_file
 from config import LOG_FOLDER, logger as logging
 from biothings.utils.hub import publish_data_version
 from biothings.hub.databuild.backend import generate_folder, create_backend, \
                                             merge_src_build_metadata
+from biothings.hub.dataindex.idcache import SqliteIDCache
 from biothings.hub import INDEXER_CATEGORY, INDEXMANAGER_CATEGORY
 
 
+def get_worker_collection(col_name):
+    """Collection from target database, connection reused by current process worker"""
+    return get_worker_resource("target_db")[col_name]
+
+
+def get_worker_indexer(pindexer):
+    """ESIndexer instance from partial pindexer, reusing current process worker's ES client"""
+    es_host = pindexer.keywords["es_host"]
+    es_kwargs = dict([(k,v) for k,v in pindexer.keywords.items() \
+            if k in ["timeout","max_retries","retry_on_timeout"]])
+    es = get_worker_resource(("es",es_host,tuple(sorted(es_kwargs.items()))),
+                             partial(get_es,es_host,**es_kwargs))
+    return pindexer(es_client=es)
+
+
 def new_index_worker(col_name,ids,pindexer,batch_num):
-        col = create_backend(col_name).target_collection
-        idxer = pindexer()
+        col = get_worker_collection(col_name)
+        idxer = get_worker_indexer(pindexer)
         cur = doc_feeder(col, step=len(ids), inbatch=False, query={'_id': {'$in': ids}})
         cnt = idxer.index_bulk(cur)
+        if idxer.bulk_stats:
+            # adaptive bulk sender used, report worker's throughput
+            return cnt + (idxer.bulk_stats,)
         return cnt
 
 
+def scan_index_worker(col_name,id_range,pindexer,batch_num,projection=None):
+    """
+    Index documents within id_range (tuple (lower,upper), see biothings.utils.mongo.id_ranges),
+    streamed from the collection with a sorted cursor straight to the indexer
+    (no _id list to fetch, "fullscan" strategy)
+    """
+    col = get_worker_collection(col_name)
+    idxer = get_worker_indexer(pindexer)
+    cur = col.find(id_range_query(*id_range),projection,no_cursor_timeout=True)
+    cur = cur.sort("_id",1).batch_size(idxer.step)
+    skipped = []
+    def valid_docs():
+        for doc in cur:
+            # same restrictions as when indexing from _ids (ES6 limitation on length)
+            if type(doc["_id"]) != str or len(doc["_id"]) > 512:
+                skipped.append(doc["_id"])
+                continue
+            yield doc
+    try:
+        cnt = idxer.index_bulk(valid_docs())
+    finally:
+        cur.close()
+    if skipped:
+        logging.warning("%d document(s) with invalid _id skipped in batch #%s: %s" % \
+                (len(skipped),batch_num,[repr(_id) for _id in skipped[:10]]))
+    if idxer.bulk_stats:
+        return cnt + (idxer.bulk_stats,)
+    return cnt
+
+
 def merge_index_worker(col_name,ids,pindexer,batch_num):
-        col = create_backend(col_name).target_collection
-        idxer = pindexer()
+        col = get_worker_collection(col_name)
+        idxer = get_worker_indexer(pindexer)
         upd_cnt = 0
         new_cnt = 0
         cur = doc_feeder(col, step=len(ids), inbatch=False, query={'_id': {'$in': ids}})
@@ -61,19 +112,23 @@ def merge_index_worker(col_name,ids,pindexer,batch_num):
 
 
 def indexer_worker(col_name,ids,pindexer,batch_num,mode="index",
-                   worker=new_index_worker):
+                   worker=new_index_worker,done_cache=None):
     try:
         if mode in ["index","merge"]:
-            return worker(col_name,ids,pindexer,batch_num)
+            res = worker(col_name,ids,pindexer,batch_num)
         elif mode == "resume":
-            idxr = pindexer()
+            idxr = get_worker_indexer(pindexer)
             es_ids = idxr.mexists(ids)
             missing_ids = [e[0] for e in es_ids if e[1] == False]
             if missing_ids:
-                return worker(col_name,missing_ids,pindexer,batch_num)
+                res = worker(col_name,missing_ids,pindexer,batch_num)
             else:
                 # fake indexer results, it has to be a tuple, first elem is num of indexed docs
-                return (0,None)
+                res = (0,None)
+        if done_cache:
+            # batch is fully indexed (errors raise an exception), record it in done-set
+            SqliteIDCache(done_cache).mark_done(ids,batch_num)
+        return res
     except Exception as e:
         logger_name = "index_%s_%s_batch_%s" % (pindexer.keywords.get("index","index"),col_name,batch_num)
         logger,_ = get_logger(logger_name, btconfig.LOG_FOLDER)
@@ -88,11 +143,22 @@ class IndexerException(Exception):
     pass
 
 
+# index settings used while loading documents (see Indexer.bulk_load)
+BULK_LOAD_SETTINGS = {"refresh_interval" : "-1", "number_of_replicas" : 0}
+
+
 class Indexer(object):
     """
     Basic indexer, reading documents from a mongo collection (target_name)
     and sending documents to ES.
     """
+    # how documents are sent to indexer workers:
+    # - "ids": _ids are fetched (or taken from cache) and sent by batch, workers
+    #          query documents from these _ids
+    # - "fullscan": each worker gets an _id range and streams documents with a sorted
+    #          cursor (only when creating a whole index, not with ids, resume or merge mode)
+    # None means default from config (INDEX_STRATEGY)
+    index_strategy = None
 
     def __init__(self, es_host, target_name=None, **kwargs):
         self.host = es_host
@@ -106,12 +172,72 @@ class Indexer(object):
         self.doc_type = None
         self.num_shards = None
         self.num_replicas = None
+        # "bulk load" mode: index is loaded with refresh and replicas disabled,
+        # configured values are restored at the end of "index" step (and
+        # index optionally force-merged). Can be set in indexer's args.
+        self.bulk_load = kwargs.pop("bulk_load",getattr(btconfig,"INDEX_BULK_LOAD",False))
+        self.force_merge = kwargs.pop("force_merge",getattr(btconfig,"INDEX_FORCE_MERGE",False))
+        # keep track of indexed _ids in a file-backed done-set (see get_done_cache()), so
+        # resuming only sends missing batches, without querying the index
+        self.done_cache = kwargs.pop("done_cache",getattr(btconfig,"INDEX_DONE_CACHE",False))
         self.kwargs = kwargs
         self.ti = time.time()
 
     def get_predicates(self):
         return []
 
+    def get_index_strategy(self, target_collection, ids, mode, worker):
+        strategy = self.index_strategy or getattr(btconfig,"INDEX_STRATEGY","ids")
+        if strategy == "fullscan":
+            if ids or mode in ["resume","merge"]:
+                # _ids are required to select documents
+                strategy = "ids"
+            elif worker != new_index_worker:
+                self.logger.warning("Full scan strategy can't be used with custom worker %s, using 'ids' strategy" % worker)
+                strategy = "ids"
+            elif not isinstance(target_collection,mongo.Collection):
+                self.logger.warning("Full scan strategy requires a mongo collection, using 'ids' strategy")
+                strategy = "ids"
+        return strategy
+
+    def get_done_cache(self, flush=False):
+        """
+        Return done-set used to track indexed _ids for current index, or None if
+        it's not enabled (or can't be used, CACHE_FOLDER required). When flush is False,
+        existing done-set is returned (None if it doesn't exist), when True it's (re)created empty.
+        """
+        cache_folder = getattr(btconfig,"CACHE_FOLDER",None)
+        if not self.done_cache or not cache_folder:
+            return None
+        cache_file = os.path.join(cache_folder,"index_done_%s.sqlite" % self.index_name)
+        if not flush and not os.path.exists(cache_file):
+            return None
+        idcache = SqliteIDCache(cache_file)
+        if flush:
+            idcache.load(cache_file,[],flush=True)
+        return idcache
+
+    def get_batches_signature(self, target_collection, batch_size):
+        """
+        Return a signature of how id_feeder splits target_collection's _ids into
+        batches, or None if batches can't be reproduced. Only binary "mmap" _id
+        caches (sorted, random access to batch #k) are considered.
+        """
+        if getattr(btconfig,"CACHE_FORMAT",None) != "mmap":
+            return None
+        cache_file,use_cache,_ = get_cache_file(target_collection,logger=self.logger)
+        if not use_cache:
+            return None
+        st = os.stat(cache_file)
+        return "%s:%s:%s:%s" % (cache_file,st.st_mtime,st.st_size,batch_size)
+
+    def get_projection(self):
+        """
+        Override to return a projection (as for pymongo's find()) restricting fields
+        read from the collection in "fullscan" strategy
+        """
+        return None
+
     def get_pinfo(self):
         """
         Return dict containing information about the current process
@@ -159,13 +285,16 @@ class Indexer(object):
         cnt = 0
 
         if "index" in steps:
-            self.register_status("indexing",transient=True,init=True,job={"step":"index"})
+            yield from run_in_executor(self.register_status,"indexing",transient=True,init=True,job={"step":"index"})
             assert self.build_doc.get("backend_url")
             target_collection = create_backend(self.build_doc["backend_url"]).target_collection
             backend_url = self.build_doc["backend_url"]
             _mapping = self.get_mapping()
             _extra = self.get_index_creation_settings()
             _meta = {}
+            idxer_kwargs = dict(self.kwargs)
+            # adaptive bulk sender settings (see biothings.utils.es.AdaptiveBulkSender)
+            idxer_kwargs.setdefault("bulk_settings",getattr(btconfig,"INDEX_BULK_SETTINGS",None))
             # partially instantiated indexer instance for process workers
             partial_idxer = partial(ESIndexer,doc_type=self.doc_type,
                                  index=index_name,
@@ -173,7 +302,7 @@ class Indexer(object):
                                  step=batch_size,
                                  number_of_shards=self.num_shards,
                                  number_of_replicas=self.num_replicas,
-                                 **self.kwargs)
+                                 **idxer_kwargs)
             # instantiate one here for index creation
             es_idxer = partial_idxer()
             if es_idxer.exists_index():
@@ -181,16 +310,35 @@ class Indexer(object):
                     es_idxer.delete_index()
                 elif not mode in ["resume","merge"]:
                     msg = "Index already '%s' exists, (use mode='purge' to auto-delete it or mode='resume' to add more documents)" % index_name
-                    self.register_status("failed",job={"err": msg})
+                    yield from run_in_executor(self.register_status,"failed",job={"err": msg})
                     raise IndexerException(msg)
 
+            # pending bulk load state, from a previous (unfinished) run
+            bulk_state = self.get_bulk_load_state()
             if not mode in ["resume","merge"]:
+                bulk_state = None
+                if self.bulk_load:
+                    # keep track of configured settings, restored once loaded
+                    bulk_state = {"status" : "loading", "force_merge" : self.force_merge,
+                                  "settings" : {"refresh_interval" : _extra.get("refresh_interval"),
+                                                "number_of_replicas" : self.num_replicas}}
+                    _extra = dict(_extra,**BULK_LOAD_SETTINGS)
                 try:
                     es_idxer.create_index({self.doc_type:_mapping},_extra)
                 except Exception as e:
                     self.logger.exception("Failed to create index")
-                    self.register_status("failed",job={"err": repr(e)})
+                    yield from run_in_executor(self.register_status,"failed",job={"err": repr(e)})
                     raise
+                yield from run_in_executor(self.register_status,"indexing",transient=True,index={"bulk_load":bulk_state})
+            elif bulk_state:
+                self.logger.info("Index '%s' still in bulk load mode, settings will be restored once loaded" % index_name)
+            elif self.bulk_load:
+                current = es_idxer.get_settings()
+                bulk_state = {"status" : "loading", "force_merge" : self.force_merge,
+                              "settings" : {"refresh_interval" : current.get("refresh_interval"),
+                                            "number_of_replicas" : int(current.get("number_of_replicas",0))}}
+                yield from run_in_executor(self.register_status,"indexing",transient=True,index={"bulk_load":bulk_state})
+                es_idxer.update_settings(BULK_LOAD_SETTINGS)
 
             def clean_ids(ids):
                 # can't use a generator, it's going to be pickled
@@ -209,31 +357,93 @@ class Indexer(object):
             total = target_collection.count()
             btotal = math.ceil(total/batch_size) 
             bnum = 1
-            if ids:
+            throughput = {"docs" : 0, "bytes" : 0, "time" : 0.0, "rejected" : 0}
+            strategy = self.get_index_strategy(target_collection,ids,mode,worker)
+            if strategy == "fullscan":
+                pinfo = self.get_pinfo()
+                pinfo["step"] = "id ranges"
+                try:
+                    job = yield from job_manager.defer_to_thread(pinfo,
+                            partial(get_id_boundaries,target_collection,batch_size))
+                    boundaries = yield from job
+                except ValueError as e:
+                    self.logger.warning("Can't split '%s' into _id ranges (%s), using 'ids' strategy" % (target_name,e))
+                    strategy = "ids"
+            # done-set (whole index only), resuming from it if it exists, or tracking from scratch
+            idcache = None
+            resume_from_cache = False
+            already_done = 0 # documents found in done-set, not sent again
+            start_batch = 0 # first batches all done, not even fetched (see id_feeder)
+            if strategy == "ids" and not ids and mode != "merge":
+                if mode == "resume":
+                    idcache = self.get_done_cache()
+                    resume_from_cache = idcache is not None
+                    if resume_from_cache:
+                        self.logger.info("Resuming from done-set '%s' (%d _ids already indexed)" % \
+                                (idcache.filename,len(idcache)))
+                if idcache is None:
+                    idcache = self.get_done_cache(flush=True)
+                if idcache is not None:
+                    signature = yield from run_in_executor(self.get_batches_signature,target_collection,batch_size)
+                    same_batches = yield from run_in_executor(idcache.check_batches,signature)
+                    if resume_from_cache and same_batches:
+                        start_batch = (yield from run_in_executor(idcache.next_batch)) - 1
+            if strategy == "fullscan":
+                id_provider = id_ranges(boundaries) or [(None,None)]
+                btotal = len(id_provider)
+                worker = partial(scan_index_worker,projection=self.get_projection())
+                self.logger.info("Full scan of '%s', create %d indexer jobs over _id ranges" % (target_name,btotal))
+            elif ids:
                 self.logger.info("Indexing from '%s' with specific list of _ids, create indexer job with batch_size=%d" % (target_name, batch_size))
                 id_provider = [ids]
             else:
                 self.logger.info("Fetch _ids from '%s', and create indexer job with batch_size=%d" % (target_name, batch_size))
-                id_provider = id_feeder(target_collection, batch_size=batch_size,logger=self.logger)
-            for ids in id_provider:
-                yield from asyncio.sleep(0.0)
-                origcnt = len(ids)
-                ids = clean_ids(ids)
-                newcnt = len(ids)
-                if origcnt != newcnt:
-                    self.logger.warning("%d document(s) can't be indexed and " % (origcnt-newcnt) + \
-                                        "will be skipped (invalid _id)")
-                # progress count
-                cnt += len(ids)
+                if start_batch:
+                    self.logger.info("Batches #1 to #%d already indexed, starting from batch #%d" % \
+                            (start_batch,start_batch+1))
+                    bnum += start_batch
+                    already_done += min(start_batch*batch_size,total)
+                    cnt += min(start_batch*batch_size,total)
+                id_provider = id_feeder(target_collection, batch_size=batch_size,logger=self.logger,
+                                        start_batch=start_batch)
+            id_provider = iter(id_provider)
+            while True:
+                # id_feeder blocks (hub db metadata, cache file or cursor), fetch out of the loop
+                ids = yield from run_in_executor(next,id_provider,None)
+                if ids is None:
+                    break
+                if strategy == "fullscan":
+                    # ids is an _id range here, documents are read by the worker
+                    descprogress = bnum/btotal*100
+                    desc = "_id range %s" % repr(ids)
+                else:
+                    origcnt = len(ids)
+                    ids = clean_ids(ids)
+                    newcnt = len(ids)
+                    if origcnt != newcnt:
+                        self.logger.warning("%d document(s) can't be indexed and " % (origcnt-newcnt) + \
+                                            "will be skipped (invalid _id)")
+                    # progress count
+                    cnt += len(ids)
+                    try:
+                        descprogress = cnt/total*100
+                    except ZeroDivisionError:
+                        descprogress = 0.0
+                    desc = "%d/%d" % (cnt,total)
+                    if resume_from_cache:
+                        missing = yield from run_in_executor(idcache.missing,ids)
+                        already_done += len(ids) - len(missing)
+                        ids = missing
+                        if not ids:
+                            self.logger.debug("Batch #%d already indexed, skipped" % bnum)
+                            yield from run_in_executor(idcache.mark_done,[],bnum)
+                            bnum += 1
+                            continue
                 pinfo = self.get_pinfo()
                 pinfo["step"] = self.target_name
-                try:
-                    descprogress = cnt/total*100
-                except ZeroDivisionError:
-                    descprogress = 0.0
                 pinfo["description"] = "#%d/%d (%.1f%%)" % (bnum,btotal,descprogress)
-                self.logger.info("Creating indexer job #%d/%d, to index '%s' %d/%d (%.1f%%)" % \
-                        (bnum,btotal,backend_url,cnt,total,descprogress))
+                self.logger.info("Creating indexer job #%d/%d, to index '%s' %s (%.1f%%)" % \
+                        (bnum,btotal,backend_url,desc,descprogress))
                 job = yield from job_manager.defer_to_process(
                         pinfo,
                         partial(indexer_worker,
@@ -241,8 +451,10 @@ class Indexer(object):
                             ids,
                             partial_idxer,
                             bnum,
-                            mode,
-                            worker))
+                            # done-set knows what's missing, no need to check the index
+                            resume_from_cache and "index" or mode,
+                            worker,
+                            idcache is not None and idcache.filename or None))
                 def batch_indexed(f,batch_num):
                     nonlocal got_error
                     try:
@@ -250,6 +462,12 @@ class Indexer(object):
                         if type(res) != tuple or type(res[0]) != int:
                             got_error = Exception("Batch #%s failed while indexing collection '%s' [result:%s]" % \
                                     (batch_num,self.target_name,repr(res)))
+                        elif len(res) > 2 and res[2]:
+                            stats = res[2]
+                            for k in throughput:
+                                throughput[k] += stats[k]
+                            self.logger.info("Batch #%s indexed: %s docs/s, %s/s (%s rejected)" % \
+                                    (batch_num,stats["docs_per_sec"],sizeof_fmt(stats["bytes_per_sec"]),stats["rejected"]))
                     except Exception as e:
                         got_error = e
                         self.logger.exception("Batch indexed error %s" % e)
@@ -259,31 +477,48 @@ class Indexer(object):
                 bnum += 1
                 # raise error as soon as we know
                 if got_error:
-                    self.register_status("failed",job={"err": repr(got_error)})
+                    yield from run_in_executor(self.register_status,"failed",job={"err": repr(got_error)})
                     raise got_error
             self.logger.info("%d jobs created for indexing step" % len(jobs))
             tasks = asyncio.gather(*jobs)
+            index_info = None
             def done(f):
                 nonlocal got_error
+                nonlocal index_info
+                # number of indexed documents (in "fullscan" strategy, only known from results)
+                nonlocal cnt
                 if None in f.result():
                     got_error = None#Exception("Some batches failed")
                     return
                 # compute overall inserted/updated records
                 # returned values looks like [(num,[]),(num,[]),...]
-                cnt = sum([val[0] for val in f.result()])
-                self.register_status("success",job={"step":"index"},index={"count":cnt})
+                cnt = sum([val[0] for val in f.result()]) + already_done
+                index_info = {"count":cnt}
+                if throughput["time"]:
+                    # summed over workers: average throughput per worker
+                    index_info["throughput"] = {
+                            "docs_per_sec" : round(throughput["docs"]/throughput["time"],1),
+                            "bytes_per_sec" : round(throughput["bytes"]/throughput["time"],1),
+                            "rejected" : throughput["rejected"]}
                 if total != cnt:
                     # raise error if counts don't match, but index is still created,
                     # fully registered in case we want to use it anyways
                     err = "Merged collection has %d documents but %d have been indexed (check logs for more)" % (total,cnt)
                     raise IndexerException(err)
+                if idcache is not None:
+                    # complete, no need to resume anymore
+                    idcache.delete()
                 self.logger.info("Index '%s' successfully created using merged collection %s" % (index_name,target_name),extra={"notify":True})
             tasks.add_done_callback(done)
             yield from tasks
+            if index_info:
+                yield from run_in_executor(self.register_status,"success",job={"step":"index"},index=index_info)
+            if bulk_state:
+                yield from self.end_bulk_load(job_manager,es_idxer,bulk_state)
 
         if "post" in steps:
             self.logger.info("Running post-index process for index '%s'" % index_name)
-            self.register_status("indexing",transient=True,init=True,job={"step":"post-index"})
+            yield from run_in_executor(self.register_status,"indexing",transient=True,init=True,job={"step":"post-index"})
             pinfo = self.get_pinfo()
             pinfo["step"] = "post_index"
             # for some reason (like maintaining object's state between pickling).
@@ -296,19 +531,20 @@ class Indexer(object):
                 try:
                     res = f.result()
                     self.logger.info("Post-index process done for index '%s': %s" % (index_name,res))
-                    self.register_status("indexing",job={"step":"post-index"})
                 except Exception as e:
                     got_error = e
                     self.logger.error("Post-index process failed for index '%s': %s" % (index_name,e),extra={"notify":True})
                     return
             job.add_done_callback(posted)
             yield from job # consume future
+            if not got_error:
+                yield from run_in_executor(self.register_status,"indexing",job={"step":"post-index"})
 
         if got_error:
-            self.register_status("failed",job={"err": repr(got_error)})
+            yield from run_in_executor(self.register_status,"failed",job={"err": repr(got_error)})
             raise got_error
         else:
-            self.register_status("success")
+            yield from run_in_executor(self.register_status,"success")
             return {"%s" % self.index_name : cnt}
 
     def register_status(self,status,transient=False,init=False,**extra):
@@ -380,6 +616,36 @@ class Indexer(object):
             build = merge_index_info(build,index_info)
             src_build.replace_one({"_id" : build["_id"]}, build)
 
+    def get_bulk_load_state(self):
+        """
+        Return bulk load state registered in src_build for current index,
+        if the index is still being loaded (settings not restored yet), or None
+        """
+        build = get_src_build().find_one({'_id': self.target_name}) or {}
+        state = build.get("index",{}).get(self.index_name,{}).get("bulk_load")
+        if state and state.get("status") == "loading":
+            return state
+
+    @asyncio.coroutine
+    def end_bulk_load(self, job_manager, es_idxer, state):
+        """
+        Restore configured index settings once documents are loaded,
+        refresh the index and optionally force-merge it.
+        """
+        self.logger.info("Restoring settings %s for index '%s'" % (state["settings"],self.index_name))
+        def restore():
+            es_idxer.update_settings(state["settings"])
+            es_idxer.refresh()
+            if state.get("force_merge"):
+                self.logger.info("Force-merging index '%s'" % self.index_name)
+                es_idxer.optimize()
+        pinfo = self.get_pinfo()
+        pinfo["step"] = "restore_settings"
+        job = yield from job_manager.defer_to_thread(pinfo,restore)
+        yield from job
+        state["status"] = "restored"
+        yield from run_in_executor(self.register_status,"success",job={"step":"index"},index={"bulk_load":state})
+
     def post_index(self, target_name, index_name, job_manager, steps=["index","post"], batch_size=10000, ids=None, mode=None):
         """
         Override in sub-class to add a post-index process. Method's signature is the same as index() to get
@@ -562,7 +828,6 @@ class ColdHotIndexer(Indexer):
                     res = f.result()
                     # compute overall inserted/updated records
                     cnt = sum(res.values())
-                    self.register_status("success",job={"step":"index"},index={"count":cnt})
                     self.logger.info("index '%s' successfully created" % index_name,extra={"notify":True})
                 except Exception as e:
                     logging.exception("failed indexing cold/hot collections: %s" % e)
@@ -572,6 +837,7 @@ class ColdHotIndexer(Indexer):
             yield from task
             if got_error:
                 raise got_error
+            yield from run_in_executor(self.register_status,"success",job={"step":"index"},index={"count":cnt})
         if "post" in steps:
             # use super index but this time only on hot collection (this is the entry point, cold collection
             # remains hidden from outside)
@@ -692,6 +958,10 @@ class IndexManager(BaseManager):
                 if job.get("status") == "indexing":
                     logging.warning("Found stale build '%s', marking index status as 'canceled'" % build["_id"])
                     job["status"] = "canceled"
+            for index_name,info in build.get("index",{}).items():
+                if (info.get("bulk_load") or {}).get("status") == "loading":
+                    logging.warning("Index '%s' was left in bulk load mode (refresh and replicas disabled), " % index_name + \
+                                    "index it again with mode='resume' to complete it and restore its settings")
             src_build.replace_one({"_id":build["_id"]},build)
 
     def setup(self):
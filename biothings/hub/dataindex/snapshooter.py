@@ -175,8 +175,8 @@ class Snapshooter(BaseStatusRegisterer):
                 self.reset_repository_info(bdoc,snapshot_name)
 
                 if "pre" in steps:
-                    self.register_status(bdoc,"pre-snapshotting",transient=True,init=True,
-                                         job={"step":"pre-snapshot"},snapshot={snapshot_name:{}})
+                    yield from self.register_status_async(bdoc,"pre-snapshotting",transient=True,init=True,
+                            job={"step":"pre-snapshot"},snapshot={snapshot_name:{}})
                     pinfo["step"] = "pre-snapshot"
                     pinfo.pop("description",None)
                     job = yield from self.job_manager.defer_to_thread(pinfo,
@@ -188,8 +188,8 @@ class Snapshooter(BaseStatusRegisterer):
                         return
                     
                 if "snapshot" in steps:
-                    self.register_status(bdoc,"snapshotting",transient=True,init=True,
-                                         job={"step":"snapshot"},snapshot={snapshot_name:{}})
+                    yield from self.register_status_async(bdoc,"snapshotting",transient=True,init=True,
+                            job={"step":"snapshot"},snapshot={snapshot_name:{}})
                     pinfo["step"] = "snapshot"
                     pinfo["description"] = es_idxr.es_host
                     self.logger.info("Creating snapshot for index '%s' on host '%s', repository '%s'" % (index,es_idxr.es_host,repo_name))
@@ -221,7 +221,7 @@ class Snapshooter(BaseStatusRegisterer):
                             break
 
                     if got_error:
-                        self.register_status(
+                        yield from self.register_status_async(
                                 bdoc,
                                 "failed",
                                 job={
@@ -239,7 +239,7 @@ class Snapshooter(BaseStatusRegisterer):
                         return
 
                     else:
-                        self.register_status(
+                        yield from self.register_status_async(
                                 bdoc,
                                 "success",
                                 job={
@@ -255,8 +255,8 @@ class Snapshooter(BaseStatusRegisterer):
                                 )
 
                 if "post" in steps:
-                    self.register_status(bdoc,"post-snapshotting",transient=True,init=True,
-                                         job={"step":"post-snapshot"},snapshot={snapshot_name:{}})
+                    yield from self.register_status_async(bdoc,"post-snapshotting",transient=True,init=True,
+                            job={"step":"post-snapshot"},snapshot={snapshot_name:{}})
                     pinfo["step"] = "post-snapshot"
                     pinfo.pop("description",None)
                     job = yield from self.job_manager.defer_to_thread(pinfo,
@@ -1,18 +1,20 @@
-import time, copy
+import time, copy, json, threading, math
 import os, pprint, cgi
+import concurrent.futures
 from datetime import datetime
 import asyncio
 from functools import partial
 import inspect
 import subprocess
 
-from biothings.utils.hub_db import get_src_dump, get_data_plugin
-from biothings.utils.common import timesofar, rmdashfr
+from biothings.utils.hub_db import get_src_dump, get_data_plugin, run_in_executor
+from biothings.utils.common import timesofar, rmdashfr, sizeof_fmt, \
+                                    stream_decompression
 from biothings.utils.loggers import get_logger
 from biothings.hub import DUMPER_CATEGORY, UPLOADER_CATEGORY
 from biothings import config as btconfig
 from biothings.utils.manager import BaseSourceManager, ResourceError
-from biothings.hub.dataload.uploader import set_pending_to_upload
+from biothings.hub.dataload.uploader import set_pending_to_upload, is_uploaded_per_file
 
 logging = btconfig.logger
 
@@ -20,6 +22,11 @@ logging = btconfig.logger
 class DumperException(Exception):
     pass
 
+
+# download slots per remote host (see BaseDumper.get_host()), shared by all dumpers
+# (key: host) or specific to a dumper (key: (src_name,host))
+HOST_SEMAPHORES = {}
+
 class BaseDumper(object):
     # override in subclass accordingly
     SRC_NAME = None
@@ -33,12 +40,26 @@ class BaseDumper(object):
 
     # Max parallel downloads (None = no limit).
     MAX_PARALLEL_DUMP = None
+    # Max parallel downloads from the same host for this dumper (None = no specific limit).
+    # All dumpers included, limit is config.DUMPER_MAX_PARALLEL_PER_HOST
+    MAX_PARALLEL_DUMP_PER_HOST = None
+    # min delay in seconds between progress updates in src_dump
+    PROGRESS_UPDATE_DELAY = 5.0
     # waiting time between download (0.0 = no waiting)
     SLEEP_BETWEEN_DOWNLOAD = 0.0
 
     # keep all release (True) or keep only the latest ?
     ARCHIVE = True
 
+    # keep single compressed files (.gz) compressed in post_dump(), uploaders
+    # read them decompressed on the fly (see utils.common.stream_decompression())
+    STREAM_DECOMPRESS = False
+    # trigger upload as soon as download starts, uploaders (with UPLOAD_PER_FILE
+    # too) then process files one by one once downloaded. post_dump() isn't
+    # run yet on these files, they must be usable as downloaded. Ignored if one
+    # of the registered uploaders for that source doesn't set UPLOAD_PER_FILE.
+    UPLOAD_PER_FILE = False
+
     SCHEDULE = None # crontab format schedule, if None, won't be scheduled
 
     def __init__(self, src_name=None, src_root_folder=None, log_folder=None, archive=None):
@@ -56,6 +77,8 @@ class BaseDumper(object):
         self.timestamp = time.strftime('%Y%m%d')
         self.prepared = False
         self.steps=["dump","post"]
+        self.progress = None # download progress, see do_dump()
+        self.downloaded = [] # local files downloaded so far, see do_dump()
 
     def init_state(self):
         self._state = {
@@ -141,6 +164,39 @@ class BaseDumper(object):
         """
         raise NotImplementedError("Define in subclass")
 
+    def get_host(self, remotefile):
+        """
+        Return the host remotefile is downloaded from, used to limit
+        concurrent downloads per host. None means no limit.
+        """
+        return None
+
+    def get_host_semaphores(self, remotefile):
+        """
+        Return semaphores to acquire (in that order) before downloading remotefile:
+        one for this dumper if MAX_PARALLEL_DUMP_PER_HOST is set, then one shared
+        by all dumpers, limited by config.DUMPER_MAX_PARALLEL_PER_HOST.
+        """
+        host = self.get_host(remotefile)
+        if not host:
+            return []
+        sems = []
+        for key,limit in [((self.src_name,host),self.__class__.MAX_PARALLEL_DUMP_PER_HOST),
+                          (host,getattr(btconfig,"DUMPER_MAX_PARALLEL_PER_HOST",4))]:
+            if not limit:
+                continue
+            if not key in HOST_SEMAPHORES:
+                HOST_SEMAPHORES[key] = asyncio.Semaphore(limit)
+            sems.append(HOST_SEMAPHORES[key])
+        return sems
+
+    def upload_per_file(self):
+        """
+        Return True if files are uploaded while being downloaded: UPLOAD_PER_FILE
+        must be set on this dumper and on all uploaders registered for the source
+        """
+        return self.__class__.UPLOAD_PER_FILE and is_uploaded_per_file(self.src_name)
+
     def post_download(self, remotefile, localfile):
         """Placeholder to add a custom process once a file is downloaded.
         This is a good place to check file's integrity. Optional"""
@@ -153,6 +209,13 @@ class BaseDumper(object):
         """
         pass
 
+    def run_post_dump(self, *args, **kwargs):
+        """Call post_dump(), keeping files compressed if STREAM_DECOMPRESS"""
+        if self.__class__.STREAM_DECOMPRESS:
+            with stream_decompression():
+                return self.post_dump(*args, **kwargs)
+        return self.post_dump(*args, **kwargs)
+
     def setup_log(self):
         self.logger, self.logfile = get_logger("dump_%s" % self.src_name)
 
@@ -211,6 +274,7 @@ class BaseDumper(object):
                         "convert to new format")
                 self.src_doc.pop(field)
 
+        previous = self.src_doc.get("download") or {}
         self.src_doc.update({
                 '_id': self.src_name,
                'download' : {
@@ -225,6 +289,10 @@ class BaseDumper(object):
             self.src_doc["download"]["pid"] = os.getpid()
         else:
             self.src_doc["download"]["time"] = timesofar(self.t0)
+            # keep download details for final states (uploaders may use files list)
+            for field in ["progress","files"]:
+                if field in previous:
+                    self.src_doc["download"][field] = previous[field]
         if "download" in extra:
             self.src_doc["download"].update(extra["download"])
         else:
@@ -269,12 +337,18 @@ class BaseDumper(object):
                             (self.release,len(self.to_dump)),extra={"notify":True})
                         return self.release
                     # mark the download starts
-                    self.register_status("downloading",transient=True)
+                    yield from run_in_executor(self.register_status,"downloading",transient=True,download={"files" : []})
+                    if self.__class__.AUTO_UPLOAD and self.upload_per_file():
+                        # upload files while downloading
+                        set_pending_to_upload(self.src_name)
                     # unsync to make it pickable
                     state = self.unprepare()
                     yield from self.do_dump(job_manager=job_manager)
                     # then restore state
                     self.prepare(state)
+                    yield from run_in_executor(self.register_status,"downloading",transient=True,
+                                               download={"progress" : self.progress,
+                                                         "files" : self.downloaded})
                 else:
                     # if nothing to dump, don't do post process
                     self.logger.debug("Nothing to dump",extra={"notify":True})
@@ -287,7 +361,7 @@ class BaseDumper(object):
                 # we can't use process there. Need to use thread to maintain that state without
                 # building an unmaintainable monster
                 job = yield from job_manager.defer_to_thread(pinfo,
-                        partial(self.post_dump,job_manager=job_manager))
+                        partial(self.run_post_dump,job_manager=job_manager))
                 def postdumped(f):
                     nonlocal got_error
                     if f.exception():
@@ -297,15 +371,18 @@ class BaseDumper(object):
                 if got_error:
                     raise got_error
                 # set it to success at the very end
-                self.register_status("success")
-                if self.__class__.AUTO_UPLOAD:
+                yield from run_in_executor(self.register_status,"success")
+                # when uploading per file, upload was triggered when download started
+                # (unless only post step was run)
+                if self.__class__.AUTO_UPLOAD and \
+                        not (self.upload_per_file() and "dump" in self.steps):
                     set_pending_to_upload(self.src_name)
                 self.logger.info("success %s" % strargs,extra={"notify":True})
         except (KeyboardInterrupt,Exception) as e:
             self.logger.error("Error while dumping source: %s" % e)
             import traceback
             self.logger.error(traceback.format_exc())
-            self.register_status("failed",download={"err" : str(e)})
+            yield from run_in_executor(self.register_status,"failed",download={"err" : str(e)})
             self.logger.error("failed %s: %s" % (strargs,e),extra={"notify":True})
             raise
         finally:
@@ -326,6 +403,9 @@ class BaseDumper(object):
             """
             return len([j for j in job_manager.jobs.values() if \
                     j["source"].split(".")[0] == self.src_name and j["category"] == UPLOADER_CATEGORY]) == 0
+        if self.upload_per_file():
+            # uploader runs while downloading, by design
+            return []
         return [no_corresponding_uploader_running]
 
     def get_pinfo(self):
@@ -378,50 +458,99 @@ class BaseDumper(object):
 
     @asyncio.coroutine
     def do_dump(self,job_manager=None):
+        """
+        Download files from self.to_dump in parallel, each one being a process job.
+        Concurrency is limited by MAX_PARALLEL_DUMP for the dumper, and by
+        MAX_PARALLEL_DUMP_PER_HOST and config.DUMPER_MAX_PARALLEL_PER_HOST for
+        each remote host (see get_host_semaphores())
+        """
         self.logger.info("%d file(s) to download" % len(self.to_dump))
         # should downloads be throttled ?
         max_dump = self.__class__.MAX_PARALLEL_DUMP and asyncio.Semaphore(self.__class__.MAX_PARALLEL_DUMP)
         courtesy_wait = self.__class__.SLEEP_BETWEEN_DOWNLOAD
+        launch_lock = asyncio.Lock()
+        progress_lock = asyncio.Lock()
+        upload_per_file = self.upload_per_file()
         got_error = None
-        jobs = []
+        self.progress = {"files_total" : len(self.to_dump), "files_done" : 0,
+                         "bytes" : 0, "throughput" : 0}
+        self.downloaded = []
+        t0 = time.time()
+        last_update = t0
         state = self.unprepare()
-        for todo in self.to_dump:
-            remote = todo["remote"]
-            local = todo["local"]
-            def done(f):
-                try:
-                    res = f.result()
-                    nonlocal max_dump
-                    nonlocal got_error
-                    if max_dump:
-                        #self.logger.debug("Releasing download semaphore: %s" % max_dump)
-                        max_dump.release()
-                    self.post_download(remote,local)
-                except Exception as e:
-                    self.logger.exception("Error downloading '%s': %s" % (remote,e))
-                    got_error = e
-            pinfo = self.get_pinfo()
-            pinfo["step"] = "dump"
-            pinfo["description"] = remote
+
+        @asyncio.coroutine
+        def download(remote,local):
+            nonlocal got_error,last_update
+            host_sems = self.get_host_semaphores(remote)
             if max_dump:
                 yield from max_dump.acquire()
-            if courtesy_wait:
-                yield from asyncio.sleep(courtesy_wait)
-            job = yield from job_manager.defer_to_process(pinfo, partial(self.download,remote,local))
-            job.add_done_callback(done)
-            jobs.append(job)
-            # raise error as soon as we get it:
-            # 1. it prevents from launching things for nothing
-            # 2. if we gather the error at the end of the loop *and* if we
-            #    have more errors than the queue size, we get stuck
-            if got_error:
-                raise got_error
+            try:
+                acquired = []
+                try:
+                    for sem in host_sems:
+                        yield from sem.acquire()
+                        acquired.append(sem)
+                    # don't launch things for nothing
+                    if got_error:
+                        return
+                    if courtesy_wait:
+                        # space out launches
+                        with (yield from launch_lock):
+                            yield from asyncio.sleep(courtesy_wait)
+                    pinfo = self.get_pinfo()
+                    pinfo["step"] = "dump"
+                    pinfo["description"] = remote
+                    job = yield from job_manager.defer_to_process(pinfo, partial(self.download,remote,local))
+                    yield from job
+                finally:
+                    for sem in acquired:
+                        sem.release()
+                self.post_download(remote,local)
+            except Exception as e:
+                self.logger.exception("Error downloading '%s': %s" % (remote,e))
+                got_error = got_error or e
+                return
+            finally:
+                if max_dump:
+                    max_dump.release()
+            self.progress["files_done"] += 1
+            self.downloaded.append(local)
+            if os.path.isfile(local):
+                self.progress["bytes"] += os.path.getsize(local)
+            now = time.time()
+            self.progress["throughput"] = int(self.progress["bytes"] / max(now - t0,1e-3))
+            # uploader is waiting for that file, don't delay
+            if upload_per_file or \
+                    now - last_update > self.__class__.PROGRESS_UPDATE_DELAY:
+                last_update = now
+                # one update at a time, so a stale one can't overwrite a newer one
+                with (yield from progress_lock):
+                    yield from run_in_executor(self.update_progress,
+                                               dict(self.progress),list(self.downloaded))
+
+        jobs = [asyncio.ensure_future(download(todo["remote"],todo["local"])) for todo in self.to_dump]
         yield from asyncio.gather(*jobs)
         if got_error:
             raise got_error
-        self.logger.info("%s successfully downloaded" % self.SRC_NAME)
+        self.logger.info("%s successfully downloaded (%s file(s), %s, %s/s)" % \
+                (self.SRC_NAME,self.progress["files_done"],sizeof_fmt(self.progress["bytes"]),
+                 sizeof_fmt(self.progress["throughput"])))
         self.to_dump = []
 
+    def update_progress(self, progress, downloaded):
+        """
+        Record download progress and files downloaded so far in src_dump. Dumper's state
+        is unprepared (pickable) while downloading, so register_status() can't be used,
+        src_dump is updated directly. Blocking, called in a thread from do_dump().
+        """
+        try:
+            get_src_dump().update_one({"_id" : self.src_name},
+                                      {"$set" : {"download.progress" : progress,
+                                                 "download.files" : downloaded}})
+        except Exception as e:
+            logging.warning("Can't update download progress for '%s': %s" % (self.src_name,e))
+
     def prepare_local_folders(self,localfile):
         localdir = os.path.dirname(localfile)
         if not os.path.exists(localdir):
@@ -481,6 +610,9 @@ class FTPDumper(BaseDumper):
         finally:
             self.release_client()
 
+    def get_host(self, remotefile):
+        return self.FTP_HOST
+
     def remote_is_better(self,remotefile,localfile):
         """'remotefile' is relative path from current working dir (CWD_DIR), 
         'localfile' is absolute path"""
@@ -580,6 +712,9 @@ class LastModifiedFTPDumper(LastModifiedBaseDumper):
         ftpdumper.prepare_client()
         return ftpdumper
 
+    def get_host(self, url):
+        return urlparse.urlsplit(url).hostname
+
     def get_remote_file(self,url):
         split = urlparse.urlsplit(url)
         remotef = split.path.split("/")[-1]
@@ -618,6 +753,13 @@ class HTTPDumper(BaseDumper):
     IGNORE_HTTP_CODE = [] # list of HTTP code to ignore in case on non-200 response
     RESOLVE_FILENAME = False # global trigger to get filenames from headers
                              # when available
+    # files bigger than RANGE_MIN_SIZE bytes are downloaded by chunks of RANGE_CHUNK_SIZE
+    # bytes, RANGE_WORKERS at a time, if server accepts range requests (1 to disable)
+    RANGE_MIN_SIZE = 256 * 1024 * 1024
+    RANGE_CHUNK_SIZE = 64 * 1024 * 1024
+    RANGE_WORKERS = 4
+    # keep partial downloads (".part" files) to resume them after a failure
+    RESUME_DOWNLOAD = True
 
     def prepare_client(self):
         self.client = requests.Session()
@@ -630,19 +772,13 @@ class HTTPDumper(BaseDumper):
         self.client.close()
         self.client = None
 
+    def get_host(self, remoteurl):
+        return urlparse.urlsplit(remoteurl).netloc
+
     def remote_is_better(self,remotefile,localfile):
         return True
 
-    def download(self,remoteurl,localfile,headers={}):
-        self.prepare_local_folders(localfile)
-        res = self.client.get(remoteurl,stream=True,headers=headers)
-        if not res.status_code == 200:
-            if res.status_code in self.__class__.IGNORE_HTTP_CODE:
-                self.logger.info("Remote URL gave http code %s, ignored" % (remoteurl,res.status_code))
-                return
-            else:
-                raise DumperException("Error while downloading '%s' (status: %s, reason: %s)" % \
-                        (remoteurl,res.status_code,res.reason))
+    def resolve_filename(self, res, localfile):
         # issue biothings.api #3: take filename from header if specified
         # note: this has to explicit, either on a globa (class) level or per file to dump
         if self.__class__.RESOLVE_FILENAME and res.headers.get("content-disposition"):
@@ -651,14 +787,195 @@ class HTTPDumper(BaseDumper):
             if parsed and parsed[0] == "attachment" and parsed[1].get("filename"):
                 # localfile is an absolute path, replace last part
                 localfile = os.path.join(os.path.dirname(localfile),parsed[1]["filename"])
+        return localfile
+
+    def download(self,remoteurl,localfile,headers={}):
+        """
+        Download remoteurl as localfile. Data is first written in localfile + ".part",
+        kept on failure so the download can be resumed (RESUME_DOWNLOAD) with a
+        range request. Large files (RANGE_MIN_SIZE) are downloaded in chunks, with
+        parallel range requests, if server supports them.
+        """
+        self.prepare_local_folders(localfile)
+        if not self.__class__.RESUME_DOWNLOAD:
+            self.discard_part(localfile + ".part")
+        head = None
+        if self.__class__.RANGE_WORKERS > 1:
+            # size of data as stored, not encoded for transfer
+            reqheaders = dict(headers)
+            reqheaders["Accept-Encoding"] = "identity"
+            head = self.client.head(remoteurl,allow_redirects=True,headers=reqheaders)
+            if head.status_code != 200:
+                # HEAD not supported, or error reported by the GET request below
+                head = None
+        if not head is None:
+            size = int(head.headers.get("content-length") or 0)
+            if size >= self.__class__.RANGE_MIN_SIZE and \
+                    head.headers.get("accept-ranges","").lower() == "bytes" and \
+                    not head.headers.get("content-encoding"):
+                localfile = self.resolve_filename(head,localfile)
+                self.download_ranges(remoteurl,localfile,size,head.headers.get("etag"),headers)
+                return head
+        return self.download_stream(remoteurl,localfile,headers)
+
+    def download_stream(self,remoteurl,localfile,headers={}):
+        """
+        Download remoteurl with one request, resuming previous partial download if any.
+        Data isn't requested with a content-encoding (ex: gzip), decoded data in partial
+        download couldn't be resumed from a byte offset in encoded data.
+        """
+        partfile = localfile + ".part"
+        state = self.load_part_state(partfile)
+        if state.get("encoding","identity") != "identity":
+            # server ignored "Accept-Encoding: identity" last time, data was decoded
+            self.discard_part(partfile)
+        reqheaders = dict(headers)
+        if self.__class__.RESUME_DOWNLOAD:
+            reqheaders["Accept-Encoding"] = "identity"
+        offset = os.path.exists(partfile) and os.path.getsize(partfile) or 0
+        if offset:
+            reqheaders["Range"] = "bytes=%d-" % offset
+            if state.get("etag") and not state["etag"].startswith("W/"):
+                # get whole file if it changed since
+                reqheaders["If-Range"] = state["etag"]
+        res = self.client.get(remoteurl,stream=True,headers=reqheaders)
+        if res.status_code == 206 and \
+                res.headers.get("content-range","").startswith("bytes %d-" % offset):
+            self.logger.info("Resuming download of '%s' from byte %d" % (remoteurl,offset))
+            mode = "ab"
+            expected = int(res.headers["content-range"].split("/")[-1].replace("*","0"))
+        elif res.status_code == 200:
+            offset = 0
+            mode = "wb"
+            expected = int(res.headers.get("content-length") or 0)
+        elif res.status_code in self.__class__.IGNORE_HTTP_CODE:
+            self.logger.info("Remote URL %s gave http code %s, ignored" % (remoteurl,res.status_code))
+            return
+        else:
+            if offset:
+                # can't resume, start over next time
+                self.discard_part(partfile)
+            raise DumperException("Error while downloading '%s' (status: %s, reason: %s)" % \
+                    (remoteurl,res.status_code,res.reason))
+        encoding = res.headers.get("content-encoding","identity").lower()
+        if encoding != "identity" and mode == "ab":
+            # offset refers to decoded data, range to encoded data
+            self.discard_part(partfile)
+            raise DumperException("Can't resume download of '%s', range is %s-encoded" % \
+                    (remoteurl,encoding))
+        localfile = self.resolve_filename(res,localfile)
+        self.save_part_state(partfile,{"etag" : res.headers.get("etag"), "encoding" : encoding})
         self.logger.debug("Downloading '%s' as '%s'" % (remoteurl,localfile))
-        fout = open(localfile, 'wb')
-        for chunk in res.iter_content(chunk_size=512 * 1024):
-            if chunk:
-                fout.write(chunk)
-        fout.close()
+        with open(partfile,mode) as fout:
+            for chunk in res.iter_content(chunk_size=512 * 1024):
+                if chunk:
+                    fout.write(chunk)
+        if encoding != "identity":
+            # iter_content() decodes data, expected size is the encoded one (received
+            # from the connection), partial download can't be resumed
+            received = res.raw.tell()
+            if expected and received != expected:
+                self.discard_part(partfile)
+                raise DumperException("Download of '%s' is incomplete, expected %d %s-encoded bytes, got %d" % \
+                        (localfile,expected,encoding,received))
+            expected = None
+        self.complete_part(partfile,localfile,expected)
         return res
 
+    def download_ranges(self,remoteurl,localfile,size,etag=None,headers={}):
+        """
+        Download remoteurl (size bytes) in chunks of RANGE_CHUNK_SIZE bytes, with
+        RANGE_WORKERS parallel range requests. Completed chunks are recorded
+        so only missing ones are downloaded again after a failure.
+        """
+        partfile = localfile + ".part"
+        state = self.load_part_state(partfile)
+        if state.get("size") != size or state.get("etag") != etag or not os.path.exists(partfile):
+            # new download, or remote file changed since
+            state = {"size" : size, "etag" : etag, "chunks" : []}
+            with open(partfile,"wb") as fout:
+                fout.truncate(size)
+            self.save_part_state(partfile,state)
+        chunk_size = self.__class__.RANGE_CHUNK_SIZE
+        todo = [(start,min(start + chunk_size,size) - 1) for start in range(0,size,chunk_size) \
+                if not start in state["chunks"]]
+        self.logger.debug("Downloading '%s' as '%s', %d/%d chunk(s) to fetch" % \
+                (remoteurl,localfile,len(todo),math.ceil(size / chunk_size)))
+        lock = threading.Lock()
+
+        def fetch(chunk):
+            start,end = chunk
+            reqheaders = dict(headers)
+            reqheaders["Range"] = "bytes=%d-%d" % (start,end)
+            reqheaders["Accept-Encoding"] = "identity"
+            if etag and not etag.startswith("W/"):
+                reqheaders["If-Range"] = etag
+            # one session per thread
+            session = requests.Session()
+            session.verify = self.__class__.VERIFY_CERT
+            try:
+                res = session.get(remoteurl,stream=True,headers=reqheaders)
+                if res.status_code != 206:
+                    # 200: file changed (If-Range) or range ignored
+                    raise DumperException("Range request %s on '%s' failed (status: %s, reason: %s)" % \
+                            (reqheaders["Range"],remoteurl,res.status_code,res.reason))
+                if res.headers.get("content-encoding","identity").lower() != "identity":
+                    raise DumperException("Range request %s on '%s' returned %s-encoded data" % \
+                            (reqheaders["Range"],remoteurl,res.headers["content-encoding"]))
+                if etag and res.headers.get("etag") and res.headers["etag"] != etag:
+                    raise DumperException("'%s' changed while downloading (ETag %s != %s)" % \
+                            (remoteurl,res.headers["etag"],etag))
+                written = 0
+                with open(partfile,"r+b") as fout:
+                    fout.seek(start)
+                    for data in res.iter_content(chunk_size=512 * 1024):
+                        fout.write(data)
+                        written += len(data)
+                if written != end - start + 1:
+                    raise DumperException("Incomplete chunk %s for '%s' (got %d bytes)" % \
+                            (reqheaders["Range"],remoteurl,written))
+            finally:
+                session.close()
+            with lock:
+                state["chunks"].append(start)
+                self.save_part_state(partfile,state)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.__class__.RANGE_WORKERS) as pool:
+            # raises first error found, if any
+            list(pool.map(fetch,todo))
+        self.complete_part(partfile,localfile,size)
+
+    def load_part_state(self, partfile):
+        try:
+            with open(partfile + ".state") as fin:
+                return json.load(fin)
+        except (IOError,ValueError):
+            return {}
+
+    def save_part_state(self, partfile, state):
+        with open(partfile + ".state","w") as fout:
+            json.dump(state,fout)
+
+    def discard_part(self, partfile):
+        for path in [partfile,partfile + ".state"]:
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def complete_part(self, partfile, localfile, expected=None):
+        """Check partfile integrity (expected size), and rename it as localfile"""
+        size = os.path.getsize(partfile)
+        if expected and size < expected:
+            # connection closed early, can be resumed
+            raise DumperException("Download of '%s' is incomplete, expected %d bytes, got %d" % \
+                    (localfile,expected,size))
+        elif expected and size > expected:
+            self.discard_part(partfile)
+            raise DumperException("Downloaded file '%s' is corrupted, expected %d bytes, got %d" % \
+                    (localfile,expected,size))
+        os.replace(partfile,localfile)
+        if os.path.exists(partfile + ".state"):
+            os.unlink(partfile + ".state")
+
 class LastModifiedHTTPDumper(HTTPDumper,LastModifiedBaseDumper):
     """Given a list of URLs, check Last-Modified header to see
     whether the file should be downloaded. Sub-class should only have
@@ -809,10 +1126,10 @@ class DummyDumper(BaseDumper):
         pinfo = self.get_pinfo()
         pinfo["step"] = "post_dump"
         job = yield from job_manager.defer_to_thread(pinfo,
-                partial(self.post_dump,job_manager=job_manager))
+                partial(self.run_post_dump,job_manager=job_manager))
         yield from asyncio.gather(job) # consume future
         self.logger.info("Registering success")
-        self.register_status("success")
+        yield from run_in_executor(self.register_status,"success")
         if self.__class__.AUTO_UPLOAD:
             set_pending_to_upload(self.src_name)
         self.logger.info("success",extra={"notify":True})
@@ -876,10 +1193,10 @@ class ManualDumper(BaseDumper):
         pinfo["step"] = "post_dump"
         strargs = "[path=%s,release=%s]" % (self.new_data_folder,self.release)
         job = yield from job_manager.defer_to_thread(pinfo,
-                partial(self.post_dump,job_manager=job_manager))
+                partial(self.run_post_dump,job_manager=job_manager))
         yield from asyncio.gather(job) # consume future
         # ok, good to go
-        self.register_status("success")
+        yield from run_in_executor(self.register_status,"success")
         if self.__class__.AUTO_UPLOAD:
             set_pending_to_upload(self.src_name)
         self.logger.info("success %s" % strargs,extra={"notify":True})
@@ -1014,18 +1331,14 @@ class GitDumper(BaseDumper):
             self._pull(self.src_root_folder,release)
         pinfo = self.get_pinfo()
         job = yield from job_manager.defer_to_thread(pinfo,partial(do))
-        def done(f):
-            nonlocal got_error
-            try:
-                res = f.result()
-                self.register_status("success")
-            except Exception as e:
-                got_error = e
-                self.logger.exception("failed: %s" % e,extra={"notify":True})
-                self.register_status("failed",download={"err" : str(e)})
-                raise
-        job.add_done_callback(done)
-        yield from job
+        try:
+            yield from job
+            yield from run_in_executor(self.register_status,"success")
+        except Exception as e:
+            got_error = e
+            self.logger.exception("failed: %s" % e,extra={"notify":True})
+            yield from run_in_executor(self.register_status,"failed",download={"err" : str(e)})
+            raise
 
     def prepare_client(self):
         """Check if 'git' executable exists"""
@@ -8,7 +8,7 @@ from biothings.utils.hub_db import get_data_plugin
 from biothings.utils.dataload import to_boolean
 from biothings.utils.manager import BaseSourceManager
 from biothings.utils.hub_db import get_src_master, get_source_fullname, \
-                                   get_src_dump
+                                   get_src_dump, offload
 
 
 class SourceManager(BaseSourceManager):
@@ -182,6 +182,7 @@ class SourceManager(BaseSourceManager):
 
         return mini
 
+    @offload
     def get_sources(self,id=None,debug=False,detailed=False):
         dm = self.dump_manager
         um = self.upload_manager
@@ -294,6 +295,7 @@ class SourceManager(BaseSourceManager):
         else:
             return list(sources.values())
 
+    @offload
     def get_source(self,name,debug=False):
         return self.get_sources(id=name,debug=debug,detailed=True)
 
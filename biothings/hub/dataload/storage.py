@@ -1,12 +1,15 @@
 import types, copy, datetime, time
 import logging
+import threading, queue
 
 import asyncio
+import bson
 from pymongo.errors import DuplicateKeyError, BulkWriteError
 
-from biothings.utils.common import timesofar, iter_n
+from biothings.utils.common import timesofar, sizeof_fmt
 from biothings.utils.dataload import merge_struct, merge_root_keys
 from biothings.utils.mongo import get_src_db, check_document_size
+from biothings.utils.manager import update_job_status
 
 
 class StorageException(Exception):
@@ -48,41 +51,124 @@ class CheckSizeStorage(BaseStorage):
 
 class BasicStorage(BaseStorage):
 
-    def doc_iterator(self, doc_d, batch=True, batch_size=10000):
-        if (isinstance(doc_d, types.GeneratorType) or isinstance(doc_d,list)) and batch:
-            for doc_li in iter_n(doc_d, n=batch_size):
-                doc_li = [d for d in doc_li if self.check_doc_func(d)]
+    # max size of a batch, from documents' BSON size (in bytes). Batches
+    # are also limited by number of documents (batch_size), whichever is
+    # reached first. None to limit by number of documents only
+    BATCH_MAX_BYTES = 16 * 1024 * 1024
+    # one document in BATCH_SIZE_SAMPLING is BSON-encoded to get its size, others
+    # are estimated from average sampled size (1 to encode all documents)
+    BATCH_SIZE_SAMPLING = 10
+
+    def iter_batches(self, docs, batch_size, max_bytes=None):
+        """
+        Group docs in lists of at most batch_size docs, and at most max_bytes
+        bytes (BSON size, estimated, see BATCH_SIZE_SAMPLING). A single sampled
+        doc larger than max_bytes is its own batch. Size of last yielded batch
+        is available in self.batch_bytes.
+        """
+        doc_li = []
+        size = 0
+        sampling = self.__class__.BATCH_SIZE_SAMPLING or 1
+        nb_sampled = 0
+        avg_size = 0
+        for i,doc in enumerate(docs):
+            doc_size = 0
+            if max_bytes:
+                if i % sampling == 0:
+                    doc_size = len(bson.BSON.encode(doc))
+                    nb_sampled += 1
+                    avg_size += (doc_size - avg_size) / nb_sampled
+                else:
+                    doc_size = avg_size
+            if doc_li and max_bytes and size + doc_size > max_bytes:
+                self.batch_bytes = int(size)
+                yield doc_li
+                doc_li = []
+                size = 0
+            doc_li.append(doc)
+            size += doc_size
+            if len(doc_li) >= batch_size:
+                self.batch_bytes = int(size)
                 yield doc_li
+                doc_li = []
+                size = 0
+        if doc_li:
+            self.batch_bytes = int(size)
+            yield doc_li
+
+    def doc_iterator(self, doc_d, batch=True, batch_size=10000, max_bytes=None):
+        if (isinstance(doc_d, types.GeneratorType) or isinstance(doc_d,list)) and batch:
+            docs = (d for d in doc_d if self.check_doc_func(d))
+            yield from self.iter_batches(docs, batch_size, max_bytes)
         else:
+            def docs():
+                for _id, doc in doc_d.items():
+                    doc['_id'] = _id
+                    _doc = {}
+                    _doc.update(doc)
+                    yield _doc
             if batch:
-                doc_li = []
-                i = 0
-            for _id, doc in doc_d.items():
-                doc['_id'] = _id
-                _doc = {}
-                _doc.update(doc)
-                if batch:
-                    doc_li.append(_doc)
-                    i += 1
-                    if i % batch_size == 0:
-                        doc_li = [d for d in doc_li if self.check_doc_func(d)]
-                        yield doc_li
-                        doc_li = []
-                else:
+                yield from self.iter_batches((d for d in docs() if self.check_doc_func(d)),
+                                             batch_size, max_bytes)
+            else:
+                for _doc in docs():
                     yield self.check_doc_func(_doc)
 
-            if batch:
-                doc_li = [d for d in doc_li if self.check_doc_func(d)]
-                yield doc_li
+    def batches(self, doc_d, batch_size):
+        """Iterate over batches to store, sized by BATCH_MAX_BYTES and batch_size"""
+        self.stats = {"batches" : 0, "docs" : 0, "bytes" : 0, "insert_time" : 0.0}
+        self.t0 = time.time()
+        self.batch_bytes = 0
+        return self.doc_iterator(doc_d, batch=True, batch_size=batch_size,
+                                 max_bytes=self.__class__.BATCH_MAX_BYTES)
+
+    def record_batch(self, nb_docs, nb_bytes, duration):
+        """
+        Update storage stats once a batch was stored (nb_docs documents,
+        nb_bytes bytes, in "duration" seconds)
+        """
+        self.stats["batches"] += 1
+        self.stats["docs"] += nb_docs
+        self.stats["bytes"] += nb_bytes
+        self.stats["insert_time"] += duration
+        self.stats["last_batch"] = {"docs" : nb_docs, "bytes" : nb_bytes,
+                                    "time" : round(duration,3),
+                                    "docs_per_sec" : round(nb_docs / max(duration,1e-3),1)}
+
+    def report_stats(self):
+        """Report storage stats in the job's status"""
+        elapsed = max(time.time() - self.t0,1e-3)
+        update_job_status(storage={
+            "batches" : self.stats["batches"],
+            "docs" : self.stats["docs"],
+            "bytes" : self.stats["bytes"],
+            "insert_time" : round(self.stats["insert_time"],3),
+            "docs_per_sec" : round(self.stats["docs"] / elapsed,1),
+            "bytes_per_sec" : round(self.stats["bytes"] / elapsed,1),
+            "last_batch" : self.stats.get("last_batch")})
+
+    def store_batch(self, doc_li, nb_bytes=None):
+        """
+        Store a list of documents (nb_bytes bytes, estimated), return the
+        number of documents stored
+        """
+        self.temp_collection.insert(doc_li, manipulate=False, check_keys=False)
+        return len(doc_li)
+
+    def insert_batch(self, doc_li, nb_bytes):
+        t0 = time.time()
+        nb = self.store_batch(doc_li,nb_bytes)
+        self.record_batch(nb,nb_bytes,time.time() - t0)
+        return nb
 
     def process(self, doc_d, batch_size):
         self.logger.info("Uploading to the DB...")
         t0 = time.time()
         total = 0
-        for doc_li in self.doc_iterator(doc_d, batch=True, batch_size=batch_size):
-            self.temp_collection.insert(doc_li, manipulate=False, check_keys=False)
-            total += len(doc_li)
-        self.logger.info('Done[%s]' % timesofar(t0))
+        for doc_li in self.batches(doc_d, batch_size):
+            total += self.insert_batch(doc_li,self.batch_bytes)
+            self.report_stats()
+        self.logger.info('Done[%s] (%s docs, %s)' % (timesofar(t0),total,sizeof_fmt(self.stats["bytes"])))
 
         return total
 
@@ -96,65 +182,56 @@ class MergerStorage(BasicStorage):
     """
 
     merge_func = merge_struct
+    aslistofdict = None
 
-    def process(self, doc_d, batch_size):
-        self.logger.info("Uploading to the DB...")
-        t0 = time.time()
+    def store_batch(self, doc_li, nb_bytes=None):
         tinner = time.time()
-        aslistofdict = None
-        total = 0
-        for doc_li in self.doc_iterator(doc_d, batch=True, batch_size=batch_size):
-            toinsert = len(doc_li)
-            nbinsert = 0
-            self.logger.info("Inserting %s records ... " % toinsert)
-            try:
-                bob = self.temp_collection.initialize_unordered_bulk_op()
-                for d in doc_li:
-                    aslistofdict = d.pop("__aslistofdict__",None)
-                    bob.insert(d)
-                res = bob.execute()
-                nbinsert += res["nInserted"]
-                self.logger.info("OK [%s]" % timesofar(tinner))
-            except BulkWriteError as e:
-                inserted = e.details["nInserted"]
-                nbinsert += inserted
-                self.logger.info("Fixing %d records " % len(e.details["writeErrors"]))
-                ids = [d["op"]["_id"] for d in e.details["writeErrors"]]
-                # build hash of existing docs
-                docs = self.temp_collection.find({"_id" : {"$in" : ids}})
-                hdocs = {}
-                for doc in docs:
-                    hdocs[doc["_id"]] = doc
-                bob2 = self.temp_collection.initialize_unordered_bulk_op()
-                for err in e.details["writeErrors"]:
-                    errdoc = err["op"]
-                    existing = hdocs[errdoc["_id"]]
-                    if errdoc is existing:
-                        # if the same document has been yielded twice,
-                        # they could be the same, so we ignore it but
-                        # count it as processed (see assert below)
-                        nbinsert += 1
-                        continue
-                    assert "_id" in existing
-                    _id = errdoc.pop("_id")
-                    merged = self.__class__.merge_func(errdoc, existing, aslistofdict=aslistofdict)
-                    # update previously fetched doc. if several errors are about the same doc id,
-                    # we would't merged things properly without an updated document
-                    assert "_id" in merged
-                    bob2.find({"_id" : _id}).update_one({"$set" : merged})
-                    hdocs[_id] = merged
+        toinsert = len(doc_li)
+        nbinsert = 0
+        self.logger.info("Inserting %s records (%s) ... " % (toinsert,sizeof_fmt(nb_bytes or 0)))
+        try:
+            bob = self.temp_collection.initialize_unordered_bulk_op()
+            for d in doc_li:
+                self.aslistofdict = d.pop("__aslistofdict__",None)
+                bob.insert(d)
+            res = bob.execute()
+            nbinsert += res["nInserted"]
+            self.logger.info("OK [%s]" % timesofar(tinner))
+        except BulkWriteError as e:
+            inserted = e.details["nInserted"]
+            nbinsert += inserted
+            self.logger.info("Fixing %d records " % len(e.details["writeErrors"]))
+            ids = [d["op"]["_id"] for d in e.details["writeErrors"]]
+            # build hash of existing docs
+            docs = self.temp_collection.find({"_id" : {"$in" : ids}})
+            hdocs = {}
+            for doc in docs:
+                hdocs[doc["_id"]] = doc
+            bob2 = self.temp_collection.initialize_unordered_bulk_op()
+            for err in e.details["writeErrors"]:
+                errdoc = err["op"]
+                existing = hdocs[errdoc["_id"]]
+                if errdoc is existing:
+                    # if the same document has been yielded twice,
+                    # they could be the same, so we ignore it but
+                    # count it as processed (see assert below)
                     nbinsert += 1
-                
-                res = bob2.execute()
-                self.logger.info("OK [%s]" % timesofar(tinner))
-            assert nbinsert == toinsert, "nb %s to %s" % (nbinsert,toinsert)
-            # end of loop so it counts the time spent in doc_iterator
-            tinner = time.time()
-            total += nbinsert
-
-        self.logger.info('Done[%s]' % timesofar(t0))
-
-        return total
+                    continue
+                assert "_id" in existing
+                _id = errdoc.pop("_id")
+                merged = self.__class__.merge_func(errdoc, existing, aslistofdict=self.aslistofdict)
+                # update previously fetched doc. if several errors are about the same doc id,
+                # we would't merged things properly without an updated document
+                assert "_id" in merged
+                bob2.find({"_id" : _id}).update_one({"$set" : merged})
+                hdocs[_id] = merged
+                nbinsert += 1
+            
+            res = bob2.execute()
+            self.logger.info("OK [%s]" % timesofar(tinner))
+        assert nbinsert == toinsert, "nb %s to %s" % (nbinsert,toinsert)
+
+        return nbinsert
 
 
 class RootKeyMergerStorage(MergerStorage):
@@ -184,27 +261,18 @@ class RootKeyMergerStorage(MergerStorage):
 
 class IgnoreDuplicatedStorage(BasicStorage):
 
-    def process(self, iterable, batch_size):
-        self.logger.info("Uploading to the DB...")
-        t0 = time.time()
+    def store_batch(self, doc_li, nb_bytes=None):
         tinner = time.time()
-        total = 0
-        for doc_li in self.doc_iterator(iterable, batch=True, batch_size=batch_size):
-            try:
-                bob = self.temp_collection.initialize_unordered_bulk_op()
-                for d in doc_li:
-                    bob.insert(d)
-                res = bob.execute()
-                total += res['nInserted']
-                self.logger.info("Inserted %s records [%s]" % (res['nInserted'], timesofar(tinner)))
-            except BulkWriteError as e:
-                self.logger.info("Inserted %s records, ignoring %d [%s]" % (e.details['nInserted'],len(e.details["writeErrors"]),timesofar(tinner)))
-            except Exception as e:
-                raise
-            tinner = time.time()
-        self.logger.info('Done[%s]' % timesofar(t0))
-
-        return total 
+        try:
+            bob = self.temp_collection.initialize_unordered_bulk_op()
+            for d in doc_li:
+                bob.insert(d)
+            res = bob.execute()
+            self.logger.info("Inserted %s records [%s]" % (res['nInserted'], timesofar(tinner)))
+            return res['nInserted']
+        except BulkWriteError as e:
+            self.logger.info("Inserted %s records, ignoring %d [%s]" % (e.details['nInserted'],len(e.details["writeErrors"]),timesofar(tinner)))
+            return 0
 
 class NoBatchIgnoreDuplicatedStorage(BasicStorage):
     """
@@ -242,26 +310,76 @@ class NoBatchIgnoreDuplicatedStorage(BasicStorage):
 class UpsertStorage(BasicStorage):
     """Insert or update documents, based on _id"""
 
-    def process(self, iterable, batch_size):
-        self.logger.info("Uploading to the DB...")
-        t0 = time.time()
+    def store_batch(self, doc_li, nb_bytes=None):
         tinner = time.time()
-        total = 0
-        for doc_li in self.doc_iterator(iterable, batch=True, batch_size=batch_size):
-            try:
-                bob = self.temp_collection.initialize_unordered_bulk_op()
-                for d in doc_li:
-                    bob.find({"_id" : d["_id"]}).upsert().replace_one(d)
-                res = bob.execute()
-                nb = res["nUpserted"] + res["nModified"]
-                total += nb
-                self.logger.info("Upserted %s records [%s]" % (nb,timesofar(tinner)))
-            except Exception as e:
-                raise
-            tinner = time.time()
-        self.logger.info('Done[%s]' % timesofar(t0))
+        bob = self.temp_collection.initialize_unordered_bulk_op()
+        for d in doc_li:
+            bob.find({"_id" : d["_id"]}).upsert().replace_one(d)
+        res = bob.execute()
+        nb = res["nUpserted"] + res["nModified"]
+        self.logger.info("Upserted %s records [%s]" % (nb,timesofar(tinner)))
+        return nb
 
-        return total
+
+class AsyncWriterStorage(BasicStorage):
+    """
+    Batches are stored by a writer thread while the next ones are being
+    parsed, so parsing and database I/O overlap. At most WRITER_QUEUE_SIZE
+    batches wait for the writer (bounding memory usage), errors from the writer
+    are raised back in the caller. Can be combined with other storages to
+    change how batches are stored, ex: storage_class = (AsyncWriterStorage,MergerStorage).
+    Note: documents must not be modified by the parser once yielded.
+    """
+
+    # number of parsed batches waiting to be stored
+    WRITER_QUEUE_SIZE = 2
+
+    def process(self, doc_d, batch_size):
+        self.logger.info("Uploading to the DB (async writer)...")
+        t0 = time.time()
+        batches = queue.Queue(maxsize=self.__class__.WRITER_QUEUE_SIZE)
+        res = {"total" : 0, "error" : None}
+
+        def writer():
+            while True:
+                item = batches.get()
+                if item is None:
+                    return
+                if res["error"]:
+                    # keep consuming so parser isn't blocked, it'll stop on next batch
+                    continue
+                try:
+                    res["total"] += self.insert_batch(*item)
+                except Exception as e:
+                    res["error"] = e
+
+        thread = threading.Thread(target=writer,name="storage-writer",daemon=True)
+        thread.start()
+        parser_error = None
+        try:
+            for doc_li in self.batches(doc_d, batch_size):
+                batches.put((doc_li,self.batch_bytes))
+                # stats are updated by the writer, reported from here (job's thread)
+                self.report_stats()
+                if res["error"]:
+                    break
+        except Exception as e:
+            parser_error = e
+        finally:
+            # let writer finish storing pending batches
+            batches.put(None)
+            thread.join()
+        if parser_error:
+            if res["error"]:
+                # parser's error is raised, don't lose writer's one
+                self.logger.error("Storing batches failed as well: %s" % repr(res["error"]))
+            raise parser_error
+        if res["error"]:
+            raise res["error"]
+        self.report_stats()
+        self.logger.info('Done[%s] (%s docs, %s)' % (timesofar(t0),res["total"],sizeof_fmt(self.stats["bytes"])))
+
+        return res["total"]
 
 
 class NoStorage(object):
@@ -7,8 +7,9 @@ import inspect
 import git
 
 from biothings.utils.common import get_timestamp, get_random_string, timesofar, iter_n
-from biothings.utils.hub_db import get_src_dump, get_src_master
-from biothings.utils.mongo import get_src_conn
+from biothings.utils.hub_db import get_src_dump, get_src_master, AsyncCollection, \
+                                   run_in_executor
+from biothings.utils.mongo import get_src_conn, build_id_cache
 from biothings.utils.dataload import merge_struct
 from biothings.utils.manager import BaseSourceManager, \
                                     ManagerError, ResourceNotFound
@@ -204,8 +205,18 @@ class BaseSourceUploader(object):
         #    """
         #    return len([j for j in job_manager.jobs.values() if \
         #            j["source"] == self.fullname and j["category"] == UPLOADER_CATEGORY]) == 0
+        if self.upload_per_file():
+            # files are uploaded as soon as downloaded, dumper is expected to run
+            return [no_builder_running]
         return [no_dumper_running,no_builder_running]
 
+    def upload_per_file(self):
+        """
+        Return True if files can be uploaded while they're still being downloaded
+        (see ParallelizedSourceUploader.UPLOAD_PER_FILE)
+        """
+        return False
+
     def get_pinfo(self):
         """
         Return dict containing information about the current process
@@ -225,7 +236,8 @@ class BaseSourceUploader(object):
             raise ResourceNotReady("Missing information for source '%s' to start upload" % self.main_source)
         if not self.src_doc.get("download",{}).get("data_folder"):
             raise ResourceNotReady("No data folder found for resource '%s'" % self.name)
-        if not force and not self.src_doc.get("download",{}).get("status") == "success":
+        ready = ["success","downloading"] if self.upload_per_file() else ["success"]
+        if not force and not self.src_doc.get("download",{}).get("status") in ready:
             raise ResourceNotReady("No successful download found for resource '%s'" % self.name)
         if not os.path.exists(self.data_folder):
             raise ResourceNotReady("Data folder '%s' doesn't exist for resource '%s'" % (self.data_folder,self.name))
@@ -316,6 +328,24 @@ class BaseSourceUploader(object):
             raise got_error
         self.switch_collection()
 
+    @asyncio.coroutine
+    def build_id_cache(self, job_manager):
+        """
+        Build _id cache file for uploaded collection, so it's ready
+        (pre-warmed) when merged
+        """
+        pinfo = self.get_pinfo()
+        pinfo["step"] = "build_id_cache"
+        pinfo["description"] = self.collection_name
+        # only needs mongo, no predicates on dumpers/builders
+        pinfo.pop("__predicates__",None)
+        job = yield from job_manager.defer_to_process(
+                pinfo,
+                partial(build_id_cache, self.collection_name))
+        cnt = yield from job
+        self.logger.info("_id cache built for '%s' (%s _ids)" % (self.collection_name,cnt))
+        return cnt
+
     def generate_doc_src_master(self):
         _doc = {"_id": str(self.name),
                 "name": self.regex_name and self.regex_name or str(self.name),
@@ -416,7 +446,7 @@ class BaseSourceUploader(object):
             # sanity check before running
             self.check_ready(force)
             self.logger.info("Uploading '%s' (collection: %s)" % (self.name, self.collection_name))
-            self.register_status("uploading")
+            yield from run_in_executor(self.register_status,"uploading")
             if update_data:
                 # unsync to make it pickable
                 state = self.unprepare()
@@ -442,11 +472,21 @@ class BaseSourceUploader(object):
             cnt = cnt or self.db[self.collection_name].count()
             if clean_archives:
                 self.clean_archived_collections()
-            self.register_status("success",count=cnt)
+            yield from run_in_executor(self.register_status,"success",count=cnt)
             self.logger.info("success %s" % strargs,extra={"notify":True})
+            if update_data and getattr(config,"PREWARM_ID_CACHE",False) and \
+                    getattr(config,"CACHE_FOLDER",None):
+                # not part of upload process, errors are only reported
+                fut = asyncio.ensure_future(self.build_id_cache(job_manager))
+                def prewarmed(f):
+                    try:
+                        f.result()
+                    except Exception as e:
+                        self.logger.exception("Couldn't build _id cache for '%s': %s" % (self.collection_name,e))
+                fut.add_done_callback(prewarmed)
         except Exception as e:
             self.logger.exception("failed %s: %s" % (strargs,e),extra={"notify":True})
-            self.register_status("failed",err=str(e))
+            yield from run_in_executor(self.register_status,"failed",err=str(e))
             raise
 
     def prepare_src_dump(self):
@@ -532,6 +572,16 @@ class DummySourceUploader(BaseSourceUploader):
 
 class ParallelizedSourceUploader(BaseSourceUploader):
 
+    # upload can start while files are still being downloaded (dumper
+    # must set UPLOAD_PER_FILE too), each file being loaded once downloaded
+    UPLOAD_PER_FILE = False
+    # when uploading per file (UPLOAD_PER_FILE), delay in seconds between
+    # checks for newly downloaded files
+    UPLOAD_PER_FILE_POLL_DELAY = 5.0
+
+    def upload_per_file(self):
+        return self.__class__.UPLOAD_PER_FILE
+
     def jobs(self):
         """Return list of (*arguments) passed to self.load_data, in order. for
         each parallelized jobs. Ex: [(x,1),(y,2),(z,3)]
@@ -539,10 +589,64 @@ class ParallelizedSourceUploader(BaseSourceUploader):
         """
         raise NotImplementedError("implement me in subclass")
 
+    def file_jobs(self, path):
+        """
+        When uploading per file (UPLOAD_PER_FILE), return list of (*arguments)
+        passed to self.load_data for a newly downloaded file (full path).
+        Default is to load the file as a whole, None or an empty list skips it.
+        Arguments must be the same as the ones returned by jobs() for that file:
+        once download is over, files from jobs() (called before download is over)
+        not already loaded are loaded (ie. files not downloaded again because they
+        were up-to-date).
+        Note: it's called once uploader is unprepared, so it must not use
+        unpickable attributes (logger, db, ...)
+        """
+        return [(path,)]
+
+    def downloaded_files_poller(self):
+        """
+        Return a coroutine function polling src_dump while the dumper is still
+        downloading. It returns a list of newly downloaded files (full paths,
+        possibly empty once download is over), then None when there's nothing left.
+        """
+        seen = set()
+        acol = AsyncCollection(get_src_dump())
+        main_source = self.main_source
+        delay = self.__class__.UPLOAD_PER_FILE_POLL_DELAY
+        done = False
+        @asyncio.coroutine
+        def poll():
+            nonlocal done
+            while not done:
+                doc = (yield from acol.find_one({"_id" : main_source})) or {}
+                download = doc.get("download",{})
+                if download.get("status") == "failed":
+                    raise ResourceError("Download failed for '%s' while uploading: %s" % \
+                            (main_source,download.get("err")))
+                done = download.get("status") != "downloading"
+                new = [f for f in download.get("files",[]) if not f in seen]
+                seen.update(new)
+                if new or done:
+                    return new
+                yield from asyncio.sleep(delay)
+        return poll
+
     @asyncio.coroutine
     def update_data(self, batch_size, job_manager=None):
         jobs = []
-        job_params = self.jobs()
+        # dumper still downloading: files are uploaded as soon as they're
+        # downloaded, until download is over
+        per_file = self.upload_per_file() and \
+                self.src_doc.get("download",{}).get("status") == "downloading"
+        if per_file:
+            next_files = self.downloaded_files_poller()
+            file_jobs = self.file_jobs
+            job_params = []
+            # files already there: once download is over, the ones which weren't
+            # downloaded again (up-to-date) are loaded too
+            remaining_jobs = self.jobs()
+        else:
+            job_params = self.jobs()
         got_error = False
         # make sure we don't use any of self reference in the following loop
         fullname = copy.deepcopy(self.fullname)
@@ -556,49 +660,66 @@ class ParallelizedSourceUploader(BaseSourceUploader):
         # (logger is unpicklable) while at the same another job from the loop would be
         # subtmitted to job_manager causing a error due to that logger attribute)
         # in other words: once unprepared, self should never be changed until all 
-        # jobs are submitted
-        for bnum,args in enumerate(job_params):
-            pinfo = self.get_pinfo()
-            pinfo["step"] = "update_data"
-            pinfo["description"] = "%s" % str(args)
-            job = yield from job_manager.defer_to_process(
-                    pinfo,
-                    partial(
-                        # pickable worker
-                        upload_worker,
-                        # worker name
-                        fullname,
-                        # storage class
-                        storage_class,
-                        # loading func
-                        load_data,
-                        # dest collection name
-                        temp_collection_name,
-                        # batch size
-                        batch_size,
-                        # batch num
-                        bnum,
-                        # and finally *args passed to loading func
-                        *args
+        # jobs are submitted (file_jobs() and the poller don't use unpicklable attributes)
+        bnum = 0
+        submitted = []
+        while True:
+            for args in job_params:
+                submitted.append(tuple(args))
+                pinfo = self.get_pinfo()
+                pinfo["step"] = "update_data"
+                pinfo["description"] = "%s" % str(args)
+                job = yield from job_manager.defer_to_process(
+                        pinfo,
+                        partial(
+                            # pickable worker
+                            upload_worker,
+                            # worker name
+                            fullname,
+                            # storage class
+                            storage_class,
+                            # loading func
+                            load_data,
+                            # dest collection name
+                            temp_collection_name,
+                            # batch size
+                            batch_size,
+                            # batch num
+                            bnum,
+                            # and finally *args passed to loading func
+                            *args
+                            )
                         )
-                    )
-            jobs.append(job)
+                jobs.append(job)
 
-            # raise error as soon as we know
+                # raise error as soon as we know
+                if got_error:
+                    raise got_error
+
+                def batch_uploaded(f,name,batch_num):
+                    # important: don't even use "self" ref here to make sure jobs can be submitted
+                    # (see comment above, before loop)
+                    nonlocal got_error
+                    try:
+                        if type(f.result()) != int:
+                            got_error = Exception("Batch #%s failed while uploading source '%s' [%s]" % (batch_num, name, f.result()))
+                    except Exception as e:
+                        got_error = e
+
+                job.add_done_callback(partial(batch_uploaded,name=fullname,batch_num=bnum))
+                bnum += 1
+            if not per_file:
+                break
+            files = yield from next_files()
             if got_error:
                 raise got_error
-
-            def batch_uploaded(f,name,batch_num):
-                # important: don't even use "self" ref here to make sure jobs can be submitted
-                # (see comment above, before loop)
-                nonlocal got_error
-                try:
-                    if type(f.result()) != int:
-                        got_error = Exception("Batch #%s failed while uploading source '%s' [%s]" % (batch_num, name, f.result()))
-                except Exception as e:
-                    got_error = e
-
-            job.add_done_callback(partial(batch_uploaded,name=fullname,batch_num=bnum))
+            if files is None:
+                # download is over, files which weren't downloaded in this run
+                # (already up-to-date) still have to be loaded
+                per_file = False
+                job_params = [args for args in remaining_jobs if not tuple(args) in submitted]
+            else:
+                job_params = [args for path in files for args in file_jobs(path) or []]
         if jobs:
             yield from asyncio.gather(*jobs)
             if got_error:
@@ -663,10 +784,11 @@ class UploaderManager(BaseSourceManager):
     def register_classes(self,klasses):
         for klass in klasses:
             config.supersede(klass) # monkey-patch from DB
-            if klass.main_source:
-                self.register.setdefault(klass.main_source,[]).append(klass)
-            else:
-                self.register.setdefault(klass.name,[]).append(klass)
+            src_name = klass.main_source or klass.name
+            self.register.setdefault(src_name,[]).append(klass)
+            # dumpers trigger upload while downloading only if all uploaders can deal with it
+            UPLOAD_PER_FILE_SOURCES[src_name] = all([issubclass(k,ParallelizedSourceUploader) \
+                    and k.UPLOAD_PER_FILE for k in self.register[src_name]])
 
     def upload_all(self,raise_on_error=False,**kwargs):
         """
@@ -710,6 +832,24 @@ class UploaderManager(BaseSourceManager):
             logging.exception("Error while uploading '%s': %s" % (src,e),extra={"notify":True})
             raise
 
+    def build_id_cache(self, src):
+        """
+        Build (or resume building) _id cache files for registered
+        resource named 'src' (main source or sub-source)
+        """
+        try:
+            klasses = self[src]
+        except KeyError:
+            raise ResourceNotFound("Can't find '%s' in registered sources (whether as main or sub-source)" % src)
+        jobs = []
+        for klass in klasses:
+            insts = self.create_instance(klass)
+            if type(insts) != list:
+                insts = [insts]
+            for inst in insts:
+                jobs.append(asyncio.ensure_future(inst.build_id_cache(self.job_manager)))
+        return asyncio.gather(*jobs)
+
     @asyncio.coroutine
     def create_and_load(self,klass,*args,**kwargs):
         insts = self.create_instance(klass)
@@ -766,6 +906,13 @@ class UploaderManager(BaseSourceManager):
         return res
 
 
+# main source name => True if all uploaders registered for it upload
+# files while they're downloaded (see UploaderManager.register_classes())
+UPLOAD_PER_FILE_SOURCES = {}
+
+def is_uploaded_per_file(src_name):
+    return UPLOAD_PER_FILE_SOURCES.get(src_name,False)
+
 def set_pending_to_upload(src_name):
     src_dump = get_src_dump()
     src_dump.update({"_id":src_name},{"$addToSet":{"pending":"upload"}})
@@ -18,6 +18,7 @@ from biothings.utils.loggers import get_logger
 from biothings.utils.manager import BaseManager, BaseStatusRegisterer
 from biothings.utils.es import ESIndexer
 from biothings.utils.backend import DocMongoBackend
+from biothings.utils import diffstream
 from biothings import config as btconfig
 from biothings.utils.hub import publish_data_version, template_out
 from biothings.hub.databuild.backend import generate_folder, create_backend, \
@@ -622,11 +623,12 @@ class DiffPublisher(BasePublisher):
 
     def reset_synced(self,diff_folder,backend=None):
         """
-        Remove "synced" flag from any pyobj file in diff_folder
+        Remove "synced" flag from any diff file in diff_folder
         """
-        synced_files = glob.glob(os.path.join(diff_folder,"*.pyobj.synced"))
+        synced_files = glob.glob(os.path.join(diff_folder,"*.pyobj.synced")) + \
+                       glob.glob(os.path.join(diff_folder,"*%s.synced" % diffstream.EXTENSION))
         for synced in synced_files:
-            diff_file = re.sub("\.pyobj\.synced$",".pyobj",synced)
+            diff_file = re.sub("\.synced$","",synced)
             os.rename(synced,diff_file)
 
     def get_release_note_filename(self, build_version):
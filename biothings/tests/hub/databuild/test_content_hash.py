@@ -0,0 +1,65 @@
+import logging
+import types
+import unittest
+
+from biothings.tests.hub.helper import stub_config
+stub_config("DATA_SRC_DATABASE", "DATA_TARGET_DATABASE")
+from biothings.hub.databuild.backend import get_content_hash_collection
+from biothings.hub.databuild.builder import DataBuilder
+from biothings.hub.databuild.differ import get_changed_ids
+from biothings.utils.backend import DocMongoBackend
+from biothings.utils.common import content_hash
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+
+@unittest.skipIf(mongomock is None, "mongomock is required (stand-in for a mongod server)")
+class TestGetChangedIds(unittest.TestCase):
+
+    def setUp(self):
+        self.db = mongomock.MongoClient()["unittest_target"]
+        self.old = DocMongoBackend(self.db, self.db["old"])
+        self.new = DocMongoBackend(self.db, self.db["new"])
+        self.ids = ["id%d" % i for i in range(10)]
+
+    def store_hashes(self, backend, docs):
+        get_content_hash_collection(backend.target_collection).insert_many(
+            [{"_id": d["_id"], "src": content_hash(d)} for d in docs])
+
+    def test_no_hashes(self):
+        # no hash collection, all documents need a diff
+        self.assertEqual(get_changed_ids(self.old, self.new, self.ids), self.ids)
+        self.store_hashes(self.old, [{"_id": _id} for _id in self.ids])
+        self.assertEqual(get_changed_ids(self.old, self.new, self.ids), self.ids)
+
+    def test_changed(self):
+        self.store_hashes(self.old, [{"_id": _id, "v": 1} for _id in self.ids])
+        # id1 changed, id2 missing from new hashes
+        self.store_hashes(self.new, [{"_id": _id, "v": _id == "id1" and 2 or 1}
+                                     for _id in self.ids if _id != "id2"])
+        self.assertEqual(get_changed_ids(self.old, self.new, self.ids), ["id1", "id2"])
+        self.assertEqual(get_changed_ids(self.old, self.new, ["id3", "id4"]), [])
+
+
+class TestUseContentHash(unittest.TestCase):
+
+    def builder(self, klass, build_config):
+        bdr = klass.__new__(klass)
+        bdr.init_state()
+        bdr.build_name = "test"
+        bdr.logger = logging
+        # build_config is fetched from source backend
+        bdr._state["source_backend"] = types.SimpleNamespace(get_build_configuration=lambda name: build_config)
+        return bdr
+
+    def test_post_merge_overridden(self):
+        class PostMergeBuilder(DataBuilder):
+            def post_merge(self, source_names, batch_size, job_manager):
+                pass
+        self.assertFalse(self.builder(DataBuilder, {}).use_content_hash())
+        self.assertTrue(self.builder(DataBuilder, {"content_hash": True}).use_content_hash())
+        # documents may be modified after hashes are computed
+        self.assertFalse(self.builder(PostMergeBuilder, {"content_hash": True}).use_content_hash())
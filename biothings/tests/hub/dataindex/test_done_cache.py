@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import unittest
+from multiprocessing import Pool
+
+from biothings.tests.hub.helper import stub_config
+stub_config()
+from biothings.hub.dataindex.idcache import SqliteIDCache
+
+
+def mark_batch(args):
+    filename, ids = args
+    SqliteIDCache(filename).mark_done(ids)
+
+
+class TestSqliteIDCache(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, "index_done_test.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_missing(self):
+        cache = SqliteIDCache(self.filename)
+        ids = ["id%04d" % i for i in range(2000)]
+        self.assertEqual(cache.missing(ids), ids)
+        cache.mark_done(ids[:1200])
+        cache.mark_done(ids[1000:1300])  # already done ones are ignored
+        self.assertEqual(len(cache), 1300)
+        self.assertEqual(cache.missing(ids), ids[1300:])
+
+    def test_batches(self):
+        cache = SqliteIDCache(self.filename)
+        self.assertFalse(cache.check_batches("mycol.mmap:100"))
+        self.assertEqual(cache.next_batch(), 1)
+        cache.mark_done(["a", "b"], 1)
+        cache.mark_done(["c", "d"], 2)
+        cache.mark_done(["g"], 4)
+        # batch #3 not done yet
+        self.assertEqual(cache.next_batch(), 3)
+        self.assertEqual(cache.next_batch(4), 5)
+        self.assertTrue(SqliteIDCache(self.filename).check_batches("mycol.mmap:100"))
+        self.assertEqual(cache.next_batch(), 3)
+        # batched differently: done batches forgotten, not done _ids
+        self.assertFalse(cache.check_batches("mycol.mmap:200"))
+        self.assertEqual(cache.next_batch(), 1)
+        self.assertEqual(cache.missing(["a", "c", "e", "g"]), ["e"])
+        # unknown batching never matches
+        self.assertFalse(cache.check_batches(None))
+        self.assertFalse(cache.check_batches(None))
+
+    def test_persistent_from_processes(self):
+        SqliteIDCache(self.filename).load(self.filename, [], flush=True)
+        batches = [["b%d_%d" % (b, i) for i in range(100)] for b in range(8)]
+        with Pool(4) as pool:
+            pool.map(mark_batch, [(self.filename, batch) for batch in batches[:6]])
+        # reopened, as when resuming
+        cache = SqliteIDCache(self.filename)
+        missing = [batch for batch in batches if cache.missing(batch)]
+        self.assertEqual(missing, batches[6:])
+        cache.load(self.filename, [], flush=True)
+        self.assertEqual(len(cache), 0)
+        cache.delete()
+        self.assertEqual(os.listdir(self.folder), [])
@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+from biothings.tests.hub.helper import stub_config
+stub_config("LOG_FOLDER", "DATA_SRC_DATABASE", "DATA_TARGET_DATABASE")
+import biothings.hub.dataindex.indexer as indexer
+from biothings.hub.dataindex.idcache import SqliteIDCache
+from biothings.utils.common import iter_n
+from biothings.utils.mongo import id_range_query
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+
+class FakeESIndexer(object):
+
+    def __init__(self, **kwargs):
+        pass
+
+    def exists_index(self):
+        return False
+
+    def create_index(self, mapping, extra):
+        pass
+
+
+class FakeJobManager(object):
+    """Run nothing, record jobs and return the number of documents each would index"""
+
+    def __init__(self, col):
+        self.col = col
+        self.jobs = []
+
+    @asyncio.coroutine
+    def defer_to_process(self, pinfo, func):
+        yield from asyncio.sleep(0)
+        self.jobs.append(func)
+        # partial(indexer_worker, col_name, ids, pindexer, batch_num, mode, worker, done_cache)
+        ids, worker = func.args[1], func.args[5]
+        if worker == indexer.new_index_worker:
+            cnt = len(ids)
+        else:
+            # _id range (fullscan)
+            cnt = self.col.count_documents(id_range_query(*ids))
+        fut = asyncio.Future()
+        fut.set_result((cnt, []))
+        return fut
+
+    @asyncio.coroutine
+    def defer_to_thread(self, pinfo, func):
+        yield from asyncio.sleep(0)
+        fut = asyncio.Future()
+        fut.set_result(func())
+        return fut
+
+
+class TestIndexer(indexer.Indexer):
+
+    def load_build(self, target_name=None):
+        self.build_doc = {"backend_url": "mycol", "mapping": {}}
+        self.conf_name = "test"
+
+    def setup_log(self):
+        self.logger, self.logfile = logging, None
+
+    def register_status(self, *args, **kwargs):
+        pass
+
+    def get_bulk_load_state(self):
+        return None
+
+
+@unittest.skipIf(mongomock is None, "mongomock is required (stand-in for a mongod server)")
+class TestIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.col = mongomock.MongoClient()["unittest_target"]["mycol"]
+        self.ids = ["id%04d" % i for i in range(250)]
+        self.col.insert_many([{"_id": _id} for _id in self.ids])
+        self.job_manager = FakeJobManager(self.col)
+        self.patches = [
+            mock.patch.object(indexer, "create_backend",
+                              lambda url: types.SimpleNamespace(target_collection=self.col)),
+            mock.patch.object(indexer, "ESIndexer", FakeESIndexer),
+            mock.patch.object(indexer, "id_feeder", self.id_feeder),
+            # mongomock collection accepted for "fullscan" strategy
+            mock.patch.object(indexer.mongo, "Collection", mongomock.collection.Collection),
+            mock.patch.object(indexer.btconfig, "CACHE_FOLDER", self.folder, create=True),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def id_feeder(self, col, batch_size, logger, start_batch=0):
+        self.start_batch = start_batch
+        return iter_n(self.ids[start_batch * batch_size:], batch_size)
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        shutil.rmtree(self.folder)
+
+    def index(self, idxer=None, **kwargs):
+        idxer = idxer or TestIndexer("localhost:9200", done_cache=True)
+        loop = asyncio.get_event_loop()
+        return loop.run_until_complete(idxer.index("mycol", "myindex", self.job_manager,
+                                                   steps=["index"], batch_size=100, **kwargs))
+
+    def sent_ids(self):
+        return [_id for job in self.job_manager.jobs for _id in job.args[1]]
+
+    def done_cache_file(self):
+        return os.path.join(self.folder, "index_done_myindex.sqlite")
+
+    def test_index(self):
+        self.assertEqual(self.index(), {"myindex": 250})
+        self.assertEqual(self.sent_ids(), self.ids)
+        self.assertEqual([job.args[4] for job in self.job_manager.jobs], ["index"] * 3)
+        self.assertEqual(self.job_manager.jobs[0].args[6], self.done_cache_file())
+        # complete, done-set removed
+        self.assertFalse(os.path.exists(self.done_cache_file()))
+
+    def test_resume(self):
+        SqliteIDCache(self.done_cache_file()).mark_done(self.ids[:150])
+        # already indexed documents are counted
+        self.assertEqual(self.index(mode="resume"), {"myindex": 250})
+        # only missing _ids sent, without checking the index
+        self.assertEqual(self.sent_ids(), self.ids[150:])
+        self.assertEqual([job.args[4] for job in self.job_manager.jobs], ["index", "index"])
+        self.assertFalse(os.path.exists(self.done_cache_file()))
+
+    def test_resume_batches(self):
+        cache = SqliteIDCache(self.done_cache_file())
+        cache.check_batches("mycol.mmap:100")
+        cache.mark_done(self.ids[:100], 1)
+        cache.mark_done(self.ids[200:210])
+        with mock.patch.object(TestIndexer, "get_batches_signature", return_value="mycol.mmap:100"):
+            self.assertEqual(self.index(mode="resume"), {"myindex": 250})
+        # batch #1 not even fetched, done _ids filtered out from the others
+        self.assertEqual(self.start_batch, 1)
+        self.assertEqual(self.sent_ids(), self.ids[100:200] + self.ids[210:])
+        self.assertEqual([job.args[3] for job in self.job_manager.jobs], [2, 3])
+
+    def test_resume_other_batches(self):
+        cache = SqliteIDCache(self.done_cache_file())
+        cache.check_batches("mycol.mmap:100")
+        cache.mark_done(self.ids[:100], 1)
+        # cache rebuilt since (or no cache): batch numbers can't be trusted
+        with mock.patch.object(TestIndexer, "get_batches_signature", return_value=None):
+            self.assertEqual(self.index(mode="resume"), {"myindex": 250})
+        self.assertEqual(self.start_batch, 0)
+        self.assertEqual(self.sent_ids(), self.ids[100:])
+
+    def test_ids(self):
+        self.index(ids=self.ids[:10])
+        self.assertEqual(self.sent_ids(), self.ids[:10])
+        # no done-set for a partial index
+        self.assertIsNone(self.job_manager.jobs[0].args[6])
+
+    def test_fullscan(self):
+        idxer = TestIndexer("localhost:9200")
+        idxer.index_strategy = "fullscan"
+        self.assertEqual(self.index(idxer), {"myindex": 250})
+        self.assertTrue(self.job_manager.jobs)
+        for job in self.job_manager.jobs:
+            self.assertEqual(job.args[5].func, indexer.scan_index_worker)
+        self.assertEqual(sum([self.col.count_documents(id_range_query(*job.args[1]))
+                              for job in self.job_manager.jobs]), 250)
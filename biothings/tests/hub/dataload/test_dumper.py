@@ -0,0 +1,341 @@
+import asyncio
+import gzip
+import http.server
+import json
+import logging
+import os
+import shutil
+import socketserver
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from biothings.tests.hub.helper import stub_config
+stub_config("LOG_FOLDER", "DATA_SRC_DATABASE", "DATA_TARGET_DATABASE", "DATA_ARCHIVE_ROOT")
+from biothings.hub.dataload import dumper
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    """Serve server.data, with range requests (and If-Range) support"""
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        srv = self.server
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(srv.data)))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", srv.head_etag or srv.etag)
+        self.end_headers()
+
+    def do_GET(self):
+        srv = self.server
+        srv.requests.append(dict(self.headers))
+        data = srv.gzip and gzip.compress(srv.data) or srv.data
+        rng = self.headers.get("Range")
+        if rng and self.headers.get("If-Range", srv.etag) == srv.etag:
+            start, end = rng.split("=")[1].split("-")
+            start, end = int(start), end and int(end) or len(data) - 1
+            body = data[start:end + 1]
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, len(data)))
+        else:
+            # file changed (If-Range), whole file sent
+            body = data
+            self.send_response(200)
+        with srv.lock:
+            short, srv.short = srv.short, max(srv.short - 1, 0)
+            fail, srv.fail = srv.fail, max(srv.fail - 1, 0)
+        if short:
+            # server ending the response early, consistently with headers
+            srv.shortened.append(rng)
+            body = body[:len(body) // 2]
+        self.send_header("ETag", srv.etag)
+        self.send_header("Content-Length", str(len(body)))
+        if srv.gzip:
+            # ignoring "Accept-Encoding: identity"
+            self.send_header("Content-Encoding", "gzip")
+        self.end_headers()
+        if fail:
+            # connection closed before the end
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.connection.shutdown(2)
+            return
+        self.wfile.write(body)
+
+
+class RangeServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class TestHTTPDumper(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.localfile = os.path.join(self.folder, "file.bin")
+        self.server = RangeServer(("127.0.0.1", 0), RangeHandler)
+        self.server.data = os.urandom(1000003)
+        self.server.etag = '"v1"'
+        self.server.head_etag = None
+        self.server.requests = []
+        self.server.shortened = []
+        self.server.fail = self.server.short = 0
+        self.server.gzip = False
+        self.server.lock = threading.Lock()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:%d/file.bin" % self.server.server_address[1]
+        klass = type("TestDumper", (dumper.HTTPDumper,),
+                     {"SRC_NAME": "test", "RANGE_MIN_SIZE": 100000, "RANGE_CHUNK_SIZE": 150000})
+        self.dumper = klass(src_root_folder=self.folder, log_folder=self.folder)
+        self.dumper.logger = logging
+        self.dumper.prepare_client()
+
+    def tearDown(self):
+        self.dumper.release_client()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.folder)
+
+    def stream(self):
+        self.dumper.__class__.RANGE_WORKERS = 1
+
+    def assertDownloaded(self):
+        with open(self.localfile, "rb") as fin:
+            self.assertEqual(fin.read(), self.server.data)
+        self.assertEqual(os.listdir(self.folder), ["file.bin"])
+
+    def write_part(self, data, state):
+        with open(self.localfile + ".part", "wb") as fout:
+            fout.write(data)
+        with open(self.localfile + ".part.state", "w") as fout:
+            json.dump(state, fout)
+
+    def test_stream(self):
+        self.stream()
+        self.dumper.download(self.url, self.localfile)
+        self.assertDownloaded()
+        self.assertEqual(self.server.requests[0]["Accept-Encoding"], "identity")
+
+    def test_stream_resume(self):
+        self.stream()
+        self.server.fail = 1
+        with self.assertRaises(Exception):
+            self.dumper.download(self.url, self.localfile)
+        offset = os.path.getsize(self.localfile + ".part")
+        self.assertTrue(0 < offset < len(self.server.data))
+        self.dumper.download(self.url, self.localfile)
+        self.assertDownloaded()
+        self.assertEqual(self.server.requests[-1]["Range"], "bytes=%d-" % offset)
+        self.assertEqual(self.server.requests[-1]["If-Range"], '"v1"')
+
+    def test_stream_changed(self):
+        self.stream()
+        # partial download of a previous version: If-Range gets a 200
+        self.write_part(b"x" * 1000, {"etag": '"v0"', "encoding": "identity"})
+        self.dumper.download(self.url, self.localfile)
+        self.assertDownloaded()
+        self.assertEqual(self.server.requests[-1]["Range"], "bytes=1000-")
+
+    def test_stream_encoded(self):
+        self.stream()
+        # server ignoring "Accept-Encoding: identity"
+        self.server.gzip = True
+        self.dumper.download(self.url, self.localfile)
+        self.assertDownloaded()
+
+    def test_stream_encoded_incomplete(self):
+        self.stream()
+        self.server.gzip = True
+        self.server.fail = 1
+        # checked against encoded size, decoded data can't be resumed
+        with self.assertRaisesRegex(dumper.DumperException, "incomplete"):
+            self.dumper.download(self.url, self.localfile)
+        self.assertEqual(os.listdir(self.folder), [])
+
+    def test_stream_encoded_part(self):
+        self.stream()
+        # decoded data left by a failed download
+        self.write_part(b"x" * 1000, {"etag": '"v1"', "encoding": "gzip"})
+        self.dumper.download(self.url, self.localfile)
+        self.assertDownloaded()
+        self.assertNotIn("Range", self.server.requests[-1])
+
+    def test_complete_part(self):
+        partfile = self.localfile + ".part"
+        self.write_part(b"x" * 100, {})
+        with self.assertRaisesRegex(dumper.DumperException, "incomplete"):
+            self.dumper.complete_part(partfile, self.localfile, 200)
+        # can be resumed
+        self.assertTrue(os.path.exists(partfile))
+        with self.assertRaisesRegex(dumper.DumperException, "corrupted"):
+            self.dumper.complete_part(partfile, self.localfile, 50)
+        self.assertEqual(os.listdir(self.folder), [])
+
+    def test_ranges(self):
+        self.dumper.download(self.url, self.localfile)
+        self.assertDownloaded()
+        # 7 chunks of 150000 bytes
+        self.assertEqual(len(self.server.requests), 7)
+        for headers in self.server.requests:
+            self.assertEqual(headers["Accept-Encoding"], "identity")
+            self.assertEqual(headers["If-Range"], '"v1"')
+
+    def test_ranges_incomplete_chunk(self):
+        self.server.short = 1
+        with self.assertRaisesRegex(dumper.DumperException, "Incomplete chunk"):
+            self.dumper.download(self.url, self.localfile)
+        # failed chunk not recorded (chunks not started yet are cancelled)
+        failed = int(self.server.shortened[0].split("=")[1].split("-")[0])
+        state = self.dumper.load_part_state(self.localfile + ".part")
+        self.assertNotIn(failed, state["chunks"])
+        self.assertTrue(state["chunks"])
+        # restarting from chunks recorded in state file
+        self.server.requests = []
+        self.dumper.download(self.url, self.localfile)
+        self.assertDownloaded()
+        missing = ["bytes=%d-%d" % (start, min(start + 150000, 1000003) - 1)
+                   for start in range(0, 1000003, 150000) if not start in state["chunks"]]
+        self.assertEqual(sorted([headers["Range"] for headers in self.server.requests]), sorted(missing))
+
+    def test_ranges_restart_from_state(self):
+        data = self.server.data
+        part = data[:150000] + b"\0" * 150000 + data[300000:450000] + b"\0" * (len(data) - 450000)
+        self.write_part(part, {"size": len(data), "etag": '"v1"', "chunks": [0, 300000]})
+        self.dumper.download(self.url, self.localfile)
+        self.assertDownloaded()
+        self.assertEqual(len(self.server.requests), 5)
+        self.assertNotIn("bytes=0-149999", [headers["Range"] for headers in self.server.requests])
+
+    def test_ranges_changed(self):
+        self.write_part(b"\0" * len(self.server.data),
+                        {"size": len(self.server.data), "etag": '"v0"', "chunks": [0]})
+        self.dumper.download(self.url, self.localfile)
+        # other version, all chunks downloaded again
+        self.assertDownloaded()
+        self.assertEqual(len(self.server.requests), 7)
+
+    def test_ranges_changed_while_downloading(self):
+        self.server.head_etag = '"v0"'
+        # 200 reply to If-Range
+        with self.assertRaisesRegex(dumper.DumperException, "status: 200"):
+            self.dumper.download(self.url, self.localfile)
+        self.assertFalse(os.path.exists(self.localfile))
+
+
+class FakeJobManager(object):
+    """Run download jobs as coroutines, recording how many run at the same time"""
+
+    def __init__(self, failing=[]):
+        self.failing = failing
+        self.launched = []
+        self.running = {}
+        self.peak = {}
+
+    def count(self, key, inc):
+        self.running[key] = self.running.get(key, 0) + inc
+        self.peak[key] = max(self.peak.get(key, 0), self.running[key])
+
+    @asyncio.coroutine
+    def run(self, src_name, remote):
+        for key in [src_name, "all"]:
+            self.count(key, 1)
+        try:
+            yield from asyncio.sleep(0.01)
+            if remote in self.failing:
+                raise IOError("can't download %s" % remote)
+        finally:
+            for key in [src_name, "all"]:
+                self.count(key, -1)
+
+    @asyncio.coroutine
+    def defer_to_process(self, pinfo, func):
+        yield from asyncio.sleep(0)
+        # partial(self.download, remote, local)
+        remote = func.args[0]
+        self.launched.append(remote)
+        return asyncio.ensure_future(self.run(pinfo["source"], remote))
+
+
+class StubDumper(dumper.BaseDumper):
+
+    MAX_PARALLEL_DUMP_PER_HOST = 1
+
+    def prepare_src_dump(self):
+        self.src_doc = {}
+
+    def setup_log(self):
+        self.logger = logging
+
+    def get_host(self, remotefile):
+        return "myhost"
+
+    def update_progress(self, progress, downloaded):
+        pass
+
+
+class TestDoDump(unittest.TestCase):
+
+    def setUp(self):
+        self.patches = [
+            mock.patch.dict(dumper.HOST_SEMAPHORES, clear=True),
+            mock.patch.object(dumper.btconfig, "DUMPER_MAX_PARALLEL_PER_HOST", 3, create=True),
+        ]
+        for patch in self.patches:
+            patch.start()
+        self.loop = asyncio.get_event_loop()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+
+    def get_dumper(self, src_name, num_files=6, **attrs):
+        klass = type("TestDumper", (StubDumper,), attrs)
+        dmp = klass(src_name=src_name, src_root_folder="/nowhere", log_folder="/nowhere")
+        dmp.to_dump = [{"remote": "%s_%d" % (src_name, i), "local": "/nowhere/%s_%d" % (src_name, i)}
+                       for i in range(num_files)]
+        return dmp
+
+    def test_host_limits(self):
+        job_manager = FakeJobManager()
+        dumpers = [self.get_dumper("src1"),
+                   self.get_dumper("src2", MAX_PARALLEL_DUMP_PER_HOST=None),
+                   self.get_dumper("src3", MAX_PARALLEL_DUMP_PER_HOST=2)]
+        self.loop.run_until_complete(asyncio.gather(*[dmp.do_dump(job_manager) for dmp in dumpers]))
+        self.assertEqual(len(job_manager.launched), 18)
+        # per dumper limit (MAX_PARALLEL_DUMP_PER_HOST)
+        self.assertEqual(job_manager.peak["src1"], 1)
+        self.assertEqual(job_manager.peak["src3"], 2)
+        # shared by all dumpers for this host (DUMPER_MAX_PARALLEL_PER_HOST)
+        self.assertEqual(job_manager.peak["all"], 3)
+        for dmp in dumpers:
+            self.assertEqual(dmp.progress["files_done"], 6)
+
+    def test_release_after_error(self):
+        job_manager = FakeJobManager(failing=["src1_1"])
+        dmp = self.get_dumper("src1", MAX_PARALLEL_DUMP_PER_HOST=2)
+        with self.assertRaisesRegex(IOError, "src1_1"):
+            self.loop.run_until_complete(dmp.do_dump(job_manager))
+        self.assertEqual(len(dumper.HOST_SEMAPHORES), 2)
+        self.assertEqual(dumper.HOST_SEMAPHORES[("src1", "myhost")]._value, 2)
+        self.assertEqual(dumper.HOST_SEMAPHORES["myhost"]._value, 3)
+        # next dump isn't blocked
+        job_manager.failing = []
+        dmp.to_dump = [{"remote": "src1_10", "local": "/nowhere/src1_10"}]
+        self.loop.run_until_complete(dmp.do_dump(job_manager))
+        self.assertEqual(job_manager.launched[-1], "src1_10")
+
+    def test_no_launch_after_error(self):
+        job_manager = FakeJobManager(failing=["src1_0"])
+        dmp = self.get_dumper("src1")
+        with self.assertRaisesRegex(IOError, "src1_0"):
+            self.loop.run_until_complete(dmp.do_dump(job_manager))
+        # one download at a time, nothing launched once the first one failed
+        self.assertEqual(job_manager.launched, ["src1_0"])
+        self.assertEqual(dmp.progress["files_done"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
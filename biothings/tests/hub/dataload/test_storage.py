@@ -0,0 +1,163 @@
+import logging
+import threading
+import unittest
+from unittest import mock
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+from biothings.tests.hub.helper import MONGODB_URI, get_test_db, stub_config
+stub_config()
+from biothings.hub.dataload import storage
+
+
+def gen_docs(num, size=100):
+    return ({"_id": "doc%04d" % i, "data": "x" * size} for i in range(num))
+
+
+class TestBatches(unittest.TestCase):
+
+    def get_storage(self, max_bytes, sampling):
+        klass = type("TestStorage", (storage.BasicStorage,),
+                     {"BATCH_MAX_BYTES": max_bytes, "BATCH_SIZE_SAMPLING": sampling})
+        return klass(mock.MagicMock(), "test", logging)
+
+    def test_batch_size(self):
+        st = self.get_storage(None, 1)
+        self.assertEqual([len(b) for b in st.batches(gen_docs(25), 10)], [10, 10, 5])
+        self.assertEqual(st.batch_bytes, 0)
+
+    def test_max_bytes(self):
+        doc_size = len(storage.bson.BSON.encode(next(gen_docs(1))))
+        st = self.get_storage(doc_size * 4, 1)
+        sizes = []
+        for batch in st.batches(gen_docs(10), 100):
+            sizes.append(len(batch))
+            self.assertEqual(st.batch_bytes, len(batch) * doc_size)
+        self.assertEqual(sizes, [4, 4, 2])
+        # whichever limit is reached first
+        self.assertEqual([len(b) for b in st.batches(gen_docs(10), 3)], [3, 3, 3, 1])
+        self.assertEqual([len(b) for b in st.batches(gen_docs(10), 6)], [4, 4, 2])
+
+    def test_large_doc(self):
+        st = self.get_storage(1000, 1)
+        docs = [{"_id": "small1"}, {"_id": "large", "data": "x" * 2000}, {"_id": "small2"}]
+        self.assertEqual([[d["_id"] for d in b] for b in st.batches((d for d in docs), 10)],
+                         [["small1"], ["large"], ["small2"]])
+
+    def test_sampling(self):
+        doc_size = len(storage.bson.BSON.encode(next(gen_docs(1))))
+        st = self.get_storage(doc_size * 25, 10)
+        with mock.patch.object(storage.bson.BSON, "encode", wraps=storage.bson.BSON.encode) as encode:
+            sizes = [len(b) for b in st.batches(gen_docs(100), 1000)]
+        # one doc in 10 encoded, others estimated
+        self.assertEqual(encode.call_count, 10)
+        self.assertEqual(sizes, [25, 25, 25, 25])
+
+
+class TestRecordBatch(unittest.TestCase):
+
+    def test_record_batch(self):
+        st = storage.BasicStorage(mock.MagicMock(), "test", logging)
+        list(st.batches(gen_docs(0), 10))
+        st.record_batch(10, 2000, 0.5)
+        st.record_batch(5, 1000, 0.25)
+        self.assertEqual(st.stats["batches"], 2)
+        self.assertEqual(st.stats["docs"], 15)
+        self.assertEqual(st.stats["bytes"], 3000)
+        self.assertEqual(st.stats["insert_time"], 0.75)
+        self.assertEqual(st.stats["last_batch"],
+                         {"docs": 5, "bytes": 1000, "time": 0.25, "docs_per_sec": 20.0})
+
+    def test_insert_batch(self):
+        st = storage.BasicStorage(mock.MagicMock(), "test", logging)
+        list(st.batches(gen_docs(0), 10))
+        docs = list(gen_docs(3))
+        self.assertEqual(st.insert_batch(docs, 300), 3)
+        st.temp_collection.insert.assert_called_once_with(docs, manipulate=False, check_keys=False)
+        self.assertEqual((st.stats["docs"], st.stats["bytes"]), (3, 300))
+
+
+class FailingStorage(storage.BasicStorage):
+
+    stored = None
+
+    def store_batch(self, doc_li, nb_bytes=None):
+        if self.stored:
+            self.stored.set()
+        raise ValueError("can't store")
+
+
+@unittest.skipIf(mongomock is None and not MONGODB_URI,
+                 "mongomock is required (stand-in for a mongod server)")
+class TestAsyncWriterStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.db = get_test_db("biothings_test_storage")
+
+    def get_storage(self, *bases):
+        klass = type("TestStorage", (storage.AsyncWriterStorage,) + bases, {})
+        return klass(self.db, "test", logging.getLogger("test_storage"))
+
+    def test_process(self):
+        st = self.get_storage(storage.BasicStorage)
+        self.assertEqual(st.process(gen_docs(250), 100), 250)
+        self.assertEqual(self.db["test"].count_documents({}), 250)
+        self.assertEqual(st.stats["batches"], 3)
+
+    def test_writer_error(self):
+        st = self.get_storage(FailingStorage)
+        parsed = []
+        def docs():
+            for doc in gen_docs(1000):
+                parsed.append(doc)
+                yield doc
+        with self.assertRaisesRegex(ValueError, "can't store"):
+            st.process(docs(), 10)
+        # parser stopped soon after the error
+        self.assertLess(len(parsed), 1000)
+
+    def test_parser_error(self):
+        st = self.get_storage(storage.BasicStorage)
+        def docs():
+            yield from gen_docs(25)
+            raise ValueError("can't parse")
+        with self.assertRaisesRegex(ValueError, "can't parse"):
+            st.process(docs(), 10)
+        # batches parsed before the error are stored
+        self.assertEqual(self.db["test"].count_documents({}), 20)
+
+    def test_parser_and_writer_errors(self):
+        klass = type("FailingStorage", (FailingStorage,), {"stored": threading.Event()})
+        st = self.get_storage(klass)
+        def docs():
+            yield from gen_docs(10)
+            # writer fails on first batch meanwhile
+            klass.stored.wait(5)
+            raise ValueError("can't parse")
+        with self.assertLogs("test_storage", logging.ERROR) as logs:
+            with self.assertRaisesRegex(ValueError, "can't parse"):
+                st.process(docs(), 10)
+        self.assertIn("can't store", logs.output[0])
+
+    def test_merger(self):
+        st = self.get_storage(storage.MergerStorage)
+        with self.assertLogs("test_storage", logging.INFO) as logs:
+            self.assertEqual(st.process(gen_docs(25), 10), 25)
+        # stored by MergerStorage, from the writer thread
+        self.assertEqual(len([l for l in logs.output if "Inserting 10 records (" in l]), 2)
+        self.assertEqual(self.db["test"].count_documents({}), 25)
+
+    @unittest.skipIf(not MONGODB_URI, "BulkWriteError from mongomock has no 'op' to merge from")
+    def test_merger_duplicates(self):
+        st = self.get_storage(storage.MergerStorage)
+        docs = ({"_id": "doc%d" % (i % 5), "val": [i]} for i in range(20))
+        self.assertEqual(st.process(docs, 5), 20)
+        self.assertEqual(self.db["test"].count_documents({}), 5)
+        self.assertEqual(sorted(self.db["test"].find_one({"_id": "doc0"})["val"]), [0, 5, 10, 15])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+'''
+    Biothings Hub Test Helper
+'''
+import logging
+import os
+import sys
+import types
+
+import biothings
+
+# set to a mongodb URI (ex: mongodb://localhost:27017) to run against a real server
+MONGODB_URI = os.environ.get("BIOTHINGS_TEST_MONGODB_URI")
+
+
+def stub_config(*attrs):
+    '''
+    Hub modules import biothings.config (and top-level "config" module) at
+    import time: stub it if no config was set, with a logger and attributes
+    "attrs" (None unless already defined). Return config module.
+    '''
+    if not hasattr(biothings, "config"):
+        biothings.config = types.ModuleType("config")
+    if not hasattr(biothings.config, "logger"):
+        biothings.config.logger = logging
+    sys.modules.setdefault("config", biothings.config)
+    for attr in attrs:
+        if not hasattr(biothings.config, attr):
+            setattr(biothings.config, attr, None)
+    return biothings.config
+
+
+def get_test_db(name):
+    '''
+    Return empty database "name", from MONGODB_URI server if set,
+    or from mongomock (stand-in for a mongod server)
+    '''
+    if MONGODB_URI:
+        from pymongo import MongoClient
+        client = MongoClient(MONGODB_URI)
+    else:
+        import mongomock
+        client = mongomock.MongoClient()
+    client.drop_database(name)
+    return client[name]
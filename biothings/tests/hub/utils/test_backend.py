@@ -0,0 +1,98 @@
+import logging
+import time
+import unittest
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+from biothings.tests.hub.helper import MONGODB_URI, get_test_db, stub_config
+stub_config()
+from biothings.utils.backend import DocMongoBackend
+
+logger = logging.getLogger(__name__)
+
+
+@unittest.skipIf(mongomock is None and not MONGODB_URI,
+                 "mongomock is required (stand-in for a mongod server)")
+class TestDocMongoBackendUpdate(unittest.TestCase):
+
+    # mongomock has no index, keep it small
+    num_docs = MONGODB_URI and 50000 or 500
+
+    def setUp(self):
+        self.db = get_test_db("unittest_backend")
+        self.docs = [{"_id": "id%06d" % i, "a": i, "b": {"c": str(i)}} for i in range(self.num_docs)]
+
+    def tearDown(self):
+        self.db.client.drop_database("unittest_backend")
+
+    def seed(self, col):
+        # half of the documents already exist, with different content
+        col.insert_many([{"_id": d["_id"], "a": -1, "old": True} for d in self.docs[::2]])
+
+    def test_bulk_update_counts(self):
+        col = self.db["counts"]
+        self.seed(col)
+        backend = DocMongoBackend(self.db, col)
+        res = backend.bulk_update(self.docs, upsert=True, batch_size=1000)
+        self.assertEqual(res["inserted"], self.num_docs // 2)
+        self.assertEqual(res["matched"], self.num_docs // 2)
+        self.assertEqual(res["updated"], self.num_docs // 2)
+        self.assertEqual(col.count_documents({}), self.num_docs)
+        # $set update keeps existing fields
+        self.assertTrue(col.find_one({"_id": "id000000"})["old"])
+        # same docs again: everything's matched, nothing modified
+        res = backend.bulk_update(self.docs, upsert=True)
+        self.assertEqual(res, {"inserted": 0, "updated": 0, "matched": self.num_docs})
+
+    def test_bulk_update_no_upsert(self):
+        col = self.db["noupsert"]
+        self.seed(col)
+        backend = DocMongoBackend(self.db, col)
+        self.assertEqual(backend.update(self.docs, upsert=False), self.num_docs // 2)
+        self.assertEqual(col.count_documents({}), self.num_docs // 2)
+
+    def test_bulk_replace(self):
+        col = self.db["replace"]
+        self.seed(col)
+        backend = DocMongoBackend(self.db, col)
+        res = backend.bulk_update(self.docs, upsert=True, replace=True)
+        self.assertEqual(res["inserted"] + res["matched"], self.num_docs)
+        self.assertNotIn("old", col.find_one({"_id": "id000000"}))
+
+    def test_benchmark_writers(self):
+        """
+        Compare the former writer (one ordered bulk op for all docs) with
+        bulk_update() (one unordered bulk_write per batch)
+        """
+        def baseline_writer(col, docs, upsert):
+            # DocMongoBackend.update() before bulk_update()
+            bulk = col.initialize_ordered_bulk_op()
+            at_least_one = False
+            for doc in docs:
+                at_least_one = True
+                op = bulk.find({"_id": doc["_id"]})
+                if upsert:
+                    op = op.upsert()
+                op.update({"$set": doc})
+            if at_least_one:
+                res = bulk.execute()
+                return res["nMatched"] + res["nUpserted"]
+            else:
+                return 0
+
+        old_col = self.db["bench_old"]
+        new_col = self.db["bench_new"]
+        self.seed(old_col)
+        self.seed(new_col)
+        t0 = time.time()
+        old_cnt = baseline_writer(old_col, self.docs, upsert=True)
+        old_time = time.time() - t0
+        t0 = time.time()
+        new_cnt = DocMongoBackend(self.db, new_col).update(self.docs, upsert=True)
+        new_time = time.time() - t0
+        logger.info("%d docs: ordered bulk op %.3fs, bulk_update() %.3fs", self.num_docs, old_time, new_time)
+        self.assertEqual(old_cnt, new_cnt)
+        self.assertEqual(list(old_col.find().sort("_id", 1)), list(new_col.find().sort("_id", 1)))
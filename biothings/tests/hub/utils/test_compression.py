@@ -0,0 +1,115 @@
+import os
+import gzip
+import shutil
+import importlib.util
+import tarfile
+import tempfile
+import unittest
+
+from biothings.utils import compression
+from biothings.utils.common import get_compressed_outfile, open_compressed_file, \
+    untargzall, gunzip
+
+
+def has_zstd():
+    return bool(shutil.which("zstd") or importlib.util.find_spec("zstandard"))
+
+
+class TestCompression(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.data = b"".join([b"line %d\n" % i for i in range(100000)])
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def path(self, name):
+        return os.path.join(self.folder, name)
+
+    def test_detect_format(self):
+        with gzip.open(self.path("a.gz"), "wb") as fout:
+            fout.write(self.data)
+        self.assertEqual(compression.detect_format(self.path("a.gz")), "gzip")
+        with open(self.path("a.txt"), "wb") as fout:
+            fout.write(self.data)
+        self.assertEqual(compression.detect_format(self.path("a.txt")), None)
+        self.assertEqual(compression.format_from_extension("a.tsv.zst"), "zstd")
+
+    def test_python_fallback(self):
+        for fmt in ["gzip", "bz2", "xz"]:
+            backend = compression.get_backend(fmt, external=False)
+            self.assertIsNone(backend.tool)
+            with backend.open(self.path("data"), "wb") as fout:
+                fout.write(self.data)
+            self.assertEqual(compression.detect_format(self.path("data")), fmt)
+            dest = compression.decompress_file(self.path("data"), self.path("data.out"), external=False)
+            with open(dest, "rb") as fin:
+                self.assertEqual(fin.read(), self.data)
+
+    def test_external_tools(self):
+        tested = 0
+        for fmt in ["gzip", "bz2", "xz", "zstd"]:
+            backend = compression.get_backend(fmt, threads=2)
+            if not backend.tool:
+                continue
+            tested += 1
+            with backend.open(self.path("data"), "wb") as fout:
+                fout.write(self.data)
+            self.assertEqual(compression.detect_format(self.path("data")), fmt)
+            with backend.open(self.path("data")) as fin:
+                self.assertEqual(fin.read(), self.data)
+            # reader closed before the end isn't an error
+            fin = backend.open(self.path("data"))
+            fin.read(10)
+            fin.close()
+        if not tested:
+            self.skipTest("No external compression tool found")
+
+    def test_external_error(self):
+        backend = compression.get_backend("xz")
+        if not backend.tool:
+            self.skipTest("xz not found")
+        with open(self.path("bad.xz"), "wb") as fout:
+            fout.write(b"\xfd7zXZ" + b"garbage" * 10)
+        with self.assertRaises(IOError):
+            compression.decompress_file(self.path("bad.xz"))
+
+    def test_xz_threads(self):
+        backend = compression.get_backend("xz", threads=2)
+        if not backend.tool:
+            self.skipTest("xz not found")
+        self.assertIsNotNone(backend.tool_version())
+        versions = compression.XzBackend.versions
+        known = versions[backend.tool]
+        try:
+            # -T is rejected before xz 5.2
+            versions[backend.tool] = (5, 0, 8)
+            self.assertEqual(backend.threads_args(), [])
+            versions[backend.tool] = (5, 2, 4)
+            self.assertEqual(backend.threads_args(), ["-T", "2"])
+        finally:
+            versions[backend.tool] = known
+
+    @unittest.skipIf(not has_zstd(), "zstd command or zstandard module required")
+    def test_zstd_outfile(self):
+        fout = get_compressed_outfile(self.path("data.zst"), compress="zstd")
+        fout.write(self.data)
+        fout.close()
+        fin = open_compressed_file(self.path("data.zst"))
+        self.assertEqual(fin.read(), self.data)
+        fin.close()
+
+    def test_untargz_gunzip(self):
+        with open(self.path("data.txt"), "wb") as fout:
+            fout.write(self.data)
+        with tarfile.open(self.path("archive.tar.gz"), "w:gz") as tf:
+            tf.add(self.path("data.txt"), arcname="extracted.txt")
+        untargzall(self.folder)
+        with open(self.path("extracted.txt"), "rb") as fin:
+            self.assertEqual(fin.read(), self.data)
+        with gzip.open(self.path("other.txt.gz"), "wb") as fout:
+            fout.write(self.data)
+        gunzip(self.path("other.txt.gz"), pattern=".gz", threads=2)
+        with open(self.path("other.txt"), "rb") as fin:
+            self.assertEqual(fin.read(), self.data)
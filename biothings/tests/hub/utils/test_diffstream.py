@@ -0,0 +1,55 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+from biothings.utils import diffstream
+
+
+class TestDiffStream(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.diff1 = {"source": "new_col", "timestamp": datetime(2020, 1, 2),
+                      "add": ["a", "b"],
+                      "update": [{"_id": "c", "patch": [{"op": "replace", "path": "/x", "value": 1}]}],
+                      "delete": ["d"]}
+        self.diff2 = {"source": "new_col", "timestamp": datetime(2020, 1, 2),
+                      "add": [{"_id": "e", "date": datetime(2019, 1, 1)}],
+                      "update": [],
+                      "delete": ["f", "g"]}
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_dump_load(self):
+        fn = os.path.join(self.folder, "1" + diffstream.EXTENSION)
+        count = diffstream.dump_diff(self.diff1, fn)
+        self.assertEqual(count, {"add": 2, "update": 1, "delete": 1})
+        self.assertTrue(diffstream.is_diffstream(fn))
+        self.assertEqual(diffstream.DiffStreamReader(fn).load(), self.diff1)
+
+    def test_concat_stream(self):
+        fn1 = os.path.join(self.folder, "1" + diffstream.EXTENSION)
+        fn2 = os.path.join(self.folder, "2" + diffstream.EXTENSION)
+        merged = os.path.join(self.folder, "diff_0" + diffstream.EXTENSION)
+        diffstream.dump_diff(self.diff1, fn1)
+        diffstream.dump_diff(self.diff2, fn2)
+        diffstream.concat_diffs([fn1, fn2], merged)
+        diff = diffstream.DiffStreamReader(merged)
+        self.assertEqual(diff["source"], "new_col")
+        self.assertEqual(len(diff["delete"]), 3)
+        self.assertEqual(list(diff["add"]), ["a", "b", {"_id": "e", "date": datetime(2019, 1, 1)}])
+        self.assertEqual([p["_id"] for p in diff["update"]], ["c"])
+
+    def test_mixed_sources(self):
+        fn1 = os.path.join(self.folder, "1" + diffstream.EXTENSION)
+        fn2 = os.path.join(self.folder, "2" + diffstream.EXTENSION)
+        merged = os.path.join(self.folder, "diff_0" + diffstream.EXTENSION)
+        diffstream.dump_diff(self.diff1, fn1)
+        self.diff2["source"] = "other_col"
+        diffstream.dump_diff(self.diff2, fn2)
+        diffstream.concat_diffs([fn1, fn2], merged)
+        with self.assertRaises(ValueError):
+            diffstream.DiffStreamReader(merged).load()
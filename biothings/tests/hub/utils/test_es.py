@@ -0,0 +1,77 @@
+import threading
+import unittest
+
+from elasticsearch.serializer import JSONSerializer
+
+import biothings.utils.es as es
+from biothings.utils.es import AdaptiveBulkSender
+
+
+class FakeES(object):
+    """Minimal stand-in for an ES client bulk API, rejecting the first "reject" items"""
+
+    def __init__(self, reject=0):
+        self.transport = type("Transport", (), {"serializer": JSONSerializer()})()
+        self.reject = reject
+        self.indexed = []
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def bulk(self, body, **kwargs):
+        lines = body if isinstance(body, list) else body.strip().split("\n")
+        items = []
+        with self.lock:
+            self.requests += 1
+            for line in lines[::2]:
+                _id = JSONSerializer().loads(line)["index"]["_id"]
+                if self.reject:
+                    self.reject -= 1
+                    items.append({"index": {"_id": _id, "status": 429,
+                                            "error": {"type": "es_rejected_execution_exception"}}})
+                else:
+                    self.indexed.append(_id)
+                    items.append({"index": {"_id": _id, "status": 201}})
+        return {"errors": any(i["index"]["status"] != 201 for i in items), "items": items}
+
+
+class TestAdaptiveBulkSender(unittest.TestCase):
+
+    def setUp(self):
+        self.orig_sleep = es.time.sleep
+        es.time.sleep = lambda s: None
+
+    def tearDown(self):
+        es.time.sleep = self.orig_sleep
+
+    def actions(self, num):
+        return [{"_index": "idx", "_type": "doc", "_op_type": "index", "_id": "id%d" % i,
+                 "value": "x" * 100} for i in range(num)]
+
+    def test_send_by_bytes(self):
+        client = FakeES()
+        sender = AdaptiveBulkSender(client, target_bytes=2000, min_bytes=1000, max_bytes=4000, thread_count=2)
+        num_ok, errors = sender.send(self.actions(500))
+        self.assertEqual((num_ok, errors), (500, []))
+        self.assertEqual(sorted(client.indexed), sorted("id%d" % i for i in range(500)))
+        # requests sized by bytes, not by docs, and size ramped up to max_bytes
+        self.assertTrue(client.requests > 10)
+        stats = sender.get_stats()
+        self.assertEqual(stats["docs"], 500)
+        self.assertEqual(stats["target_bytes"], 4000)
+        self.assertTrue(stats["docs_per_sec"] > 0 and stats["bytes_per_sec"] > 0)
+
+    def test_backoff_on_rejection(self):
+        client = FakeES(reject=30)
+        sender = AdaptiveBulkSender(client, target_bytes=4000, min_bytes=1000, thread_count=2)
+        num_ok, errors = sender.send(self.actions(100))
+        self.assertEqual((num_ok, errors), (100, []))
+        self.assertEqual(len(set(client.indexed)), 100)
+        self.assertEqual(sender.get_stats()["rejected"], 30)
+        self.assertTrue(sender.get_stats()["retries"] > 0)
+
+    def test_give_up(self):
+        client = FakeES(reject=1000)
+        sender = AdaptiveBulkSender(client, max_retries=2, thread_count=1)
+        num_ok, errors = sender.send(self.actions(10))
+        self.assertEqual(num_ok, 0)
+        self.assertEqual(len(errors), 10)
@@ -0,0 +1,56 @@
+import asyncio
+import threading
+import unittest
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+from biothings.utils.hub_db import AsyncCollection, ChangeWatcher, run_in_executor
+
+
+@unittest.skipIf(mongomock is None, "mongomock is required (stand-in for a mongod server)")
+class TestAsyncCollection(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.col = mongomock.MongoClient().db.src_dump
+        self.col.insert_many([{"_id": "s1", "pending": ["upload"]}, {"_id": "s2"}])
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(asyncio.new_event_loop())
+
+    def test_calls_in_thread(self):
+        @asyncio.coroutine
+        def run():
+            acol = AsyncCollection(self.col)
+            docs = yield from acol.find({"pending": "upload"})
+            yield from acol.update_one({"_id": "s1"}, {"$pull": {"pending": "upload"}})
+            doc = yield from acol.find_one({"_id": "s1"})
+            tid = yield from run_in_executor(threading.get_ident)
+            return docs, doc, tid
+
+        docs, doc, tid = self.loop.run_until_complete(run())
+        self.assertEqual([d["_id"] for d in docs], ["s1"])
+        self.assertEqual(doc["pending"], [])
+        self.assertNotEqual(tid, threading.get_ident())
+
+    def test_unknown_method(self):
+        with self.assertRaises(AttributeError):
+            AsyncCollection(self.col).drop
+
+    def test_event_from_thread(self):
+        orig_queue = ChangeWatcher.event_queue
+        ChangeWatcher.event_queue = asyncio.Queue(loop=self.loop)
+        try:
+            @asyncio.coroutine
+            def run():
+                yield from run_in_executor(ChangeWatcher.put_event, {"obj": "source", "op": "save"})
+                return (yield from asyncio.wait_for(ChangeWatcher.event_queue.get(), 1))
+
+            self.assertEqual(self.loop.run_until_complete(run()), {"obj": "source", "op": "save"})
+        finally:
+            ChangeWatcher.event_queue = orig_queue
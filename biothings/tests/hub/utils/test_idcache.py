@@ -0,0 +1,173 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from biothings.tests.hub.helper import stub_config
+from biothings.utils.idcache import MmapIdCache, MmapIdCacheWriter
+
+
+class TestMmapIdCache(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, "mycol.mmap")
+        self.ids = ["id%06d" % i for i in range(10000)] + ["é%d" % i for i in range(10)]
+        shuffled = self.ids + self.ids[:100]  # with duplicates
+        random.shuffle(shuffled)
+        # small runs to exercise the external merge
+        writer = MmapIdCacheWriter(self.filename, run_size=777)
+        for i in range(0, len(shuffled), 1000):
+            writer.write(shuffled[i:i + 1000])
+        writer.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_sorted_no_temp_files(self):
+        self.assertEqual(os.listdir(self.folder), ["mycol.mmap"])
+        with MmapIdCache(self.filename) as cache:
+            self.assertEqual(len(cache), len(self.ids))
+            self.assertEqual(list(cache), sorted(self.ids))
+            self.assertEqual(cache[-1], sorted(self.ids)[-1])
+
+    def test_batches(self):
+        expected = sorted(self.ids)
+        with MmapIdCache(self.filename) as cache:
+            self.assertEqual(cache.num_batches(1000), 11)
+            self.assertEqual(cache.batch(3, 1000), expected[3000:4000])
+            batches = list(cache.iter_batches(1000, start=9))
+            self.assertEqual(len(batches), 2)
+            self.assertEqual(batches[-1], expected[10000:])
+
+    def test_membership(self):
+        with MmapIdCache(self.filename) as cache:
+            self.assertIn("id000000", cache)
+            self.assertIn("id009999", cache)
+            self.assertIn("é9", cache)
+            self.assertNotIn("id010000", cache)
+            self.assertNotIn("", cache)
+            self.assertEqual(cache.index("id000042"), 42)
+            with self.assertRaises(ValueError):
+                cache.index("nope")
+
+    def test_empty(self):
+        empty = os.path.join(self.folder, "empty.mmap")
+        MmapIdCacheWriter(empty).close()
+        # matches "empty_size" used in id_feeder
+        self.assertEqual(os.path.getsize(empty), 24)
+        with MmapIdCache(empty) as cache:
+            self.assertEqual(len(cache), 0)
+            self.assertEqual(list(cache.iter_batches(10)), [])
+            self.assertNotIn("a", cache)
+
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+
+@unittest.skipIf(mongomock is None, "mongomock is required (stand-in for a mongod server)")
+class TestBuildIdCache(unittest.TestCase):
+
+    def setUp(self):
+        import types
+        stub_config()
+        from biothings.utils import mongo
+        self.mongo = mongo
+        self.folder = tempfile.mkdtemp()
+        self.orig_config = mongo.config
+        mongo.config = types.SimpleNamespace(CACHE_FOLDER=self.folder, CACHE_FORMAT=None)
+        self.col = mongomock.MongoClient()["unittest_idcache"]["mycol"]
+        self.ids = ["id%05d" % i for i in range(2000)]
+        self.col.insert_many([{"_id": _id} for _id in self.ids])
+
+    def tearDown(self):
+        self.mongo.config = self.orig_config
+        shutil.rmtree(self.folder)
+
+    def read_cache(self):
+        with open(os.path.join(self.folder, "mycol")) as fin:
+            return [_id.strip() for _id in fin]
+
+    def test_build(self):
+        cnt = self.mongo.build_id_cache(self.col, num_segments=8, max_workers=3)
+        self.assertEqual(cnt, len(self.ids))
+        # range order, no segment or checkpoint left
+        self.assertEqual(self.read_cache(), self.ids)
+        self.assertEqual(os.listdir(self.folder), ["mycol"])
+
+    def test_resume(self):
+        orig_dump = self.mongo._dump_id_segment
+        dumped = []
+        interrupted = True
+
+        def failing_dump(col, id_range, segment_file):
+            if interrupted and segment_file.endswith(".seg3"):
+                raise IOError("interrupted")
+            dumped.append(segment_file)
+            return orig_dump(col, id_range, segment_file)
+
+        self.mongo._dump_id_segment = failing_dump
+        try:
+            with self.assertRaises(IOError):
+                self.mongo.build_id_cache(self.col, num_segments=8, max_workers=1)
+            self.assertTrue(os.path.exists(os.path.join(self.folder, "mycol.checkpoint")))
+            done = len(dumped)
+            interrupted = False
+            self.mongo.build_id_cache(self.col, num_segments=8, max_workers=1)
+        finally:
+            self.mongo._dump_id_segment = orig_dump
+        # only the failed segment has been fetched again
+        self.assertEqual(dumped[done:], [os.path.join(self.folder, "mycol.seg3")])
+        self.assertEqual(self.read_cache(), self.ids)
+
+    def test_unreadable_checkpoint(self):
+        # ex: interrupted while written
+        with open(os.path.join(self.folder, "mycol.checkpoint"), "wb") as fout:
+            fout.write(b"\x80\x03}q\x00")
+        cnt = self.mongo.build_id_cache(self.col, num_segments=4, max_workers=2)
+        self.assertEqual(cnt, len(self.ids))
+        self.assertEqual(self.read_cache(), self.ids)
+        self.assertEqual(os.listdir(self.folder), ["mycol"])
+
+    def test_mixed_id_types(self):
+        self.col.insert_many([{"_id": i} for i in range(500)])
+        cnt = self.mongo.build_id_cache(self.col, num_segments=8, max_workers=3)
+        self.assertEqual(cnt, len(self.ids) + 500)
+        self.assertEqual(sorted(self.read_cache()), sorted(self.ids + [str(i) for i in range(500)]))
+
+    def test_id_feeder_start_batch(self):
+        self.mongo.config.CACHE_FORMAT = "mmap"
+        # no build timestamp: _ids fetched from collection (doc_feeder), cache built
+        with mock.patch.object(self.mongo, "get_collection_timestamp", return_value=None), \
+                mock.patch.object(self.mongo, "Collection", mongomock.collection.Collection):
+            batches = list(self.mongo.id_feeder(self.col, batch_size=500, start_batch=2))
+            self.assertEqual(batches, [self.ids[1000:1500], self.ids[1500:]])
+            with MmapIdCache(os.path.join(self.folder, "mycol.mmap")) as cache:
+                # fully built, from the first batch
+                self.assertEqual(list(cache), self.ids)
+            # then directly from batch #3 in the cache
+            with mock.patch.object(self.mongo, "doc_feeder") as doc_feeder:
+                batches = list(self.mongo.id_feeder(self.col, batch_size=500, start_batch=3,
+                                                    force_use=True))
+            self.assertFalse(doc_feeder.called)
+            self.assertEqual(batches, [self.ids[1500:]])
+
+    def test_count_mismatch(self):
+        orig_dump = self.mongo._dump_id_segment
+
+        def lossy_dump(col, id_range, segment_file):
+            return orig_dump(col, id_range, segment_file) - 1
+
+        self.mongo._dump_id_segment = lossy_dump
+        try:
+            with self.assertRaises(ValueError):
+                self.mongo.build_id_cache(self.col, num_segments=4, max_workers=2)
+        finally:
+            self.mongo._dump_id_segment = orig_dump
+        # no invalid cache, next build starts over
+        self.assertEqual(os.listdir(self.folder), [])
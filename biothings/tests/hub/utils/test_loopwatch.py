@@ -0,0 +1,47 @@
+import asyncio
+import time
+import unittest
+
+from biothings.utils.loopwatch import LoopWatchdog
+
+
+def blocking_callback():
+    time.sleep(0.3)
+
+
+class TestLoopWatchdog(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.watchdog = LoopWatchdog(self.loop, threshold=0.05, logger=self)
+        self.warnings = []
+
+    def tearDown(self):
+        self.watchdog.stop()
+        self.loop.close()
+
+    def warning(self, msg):
+        self.warnings.append(msg)
+
+    def test_blocking_callback(self):
+        self.watchdog.start()
+        self.loop.run_until_complete(asyncio.sleep(0.2, loop=self.loop))
+        self.loop.call_soon(blocking_callback)
+        self.loop.run_until_complete(asyncio.sleep(0.2, loop=self.loop))
+        report = self.watchdog.report()
+        self.assertEqual(len(report["offenders"]), 1, report)
+        offender = report["offenders"][0]
+        self.assertIn("in blocking_callback", offender["location"])
+        self.assertEqual(offender["count"], 1)
+        self.assertTrue(0.2 < offender["max_time"] < 1)
+        self.assertIn("in blocking_callback", offender["stack"][-1])
+        self.assertEqual(report["histogram"][0]["count"], 1)
+        self.assertEqual(len(self.warnings), 1)
+        # reset
+        self.watchdog.report(reset=True)
+        self.assertEqual(self.watchdog.report()["offenders"], [])
+
+    def test_not_blocking(self):
+        self.watchdog.start()
+        self.loop.run_until_complete(asyncio.sleep(0.3, loop=self.loop))
+        self.assertEqual(self.watchdog.report()["offenders"], [])
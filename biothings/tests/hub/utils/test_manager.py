@@ -0,0 +1,286 @@
+import asyncio
+import logging
+import shutil
+import tempfile
+import time
+import types
+import unittest
+
+from biothings.tests.hub.helper import stub_config
+
+
+class JobManagerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        stub_config()
+        self.run_dir = tempfile.mkdtemp()
+        from biothings.utils import manager
+        self.manager = manager
+        self.orig_config = manager.config
+        manager.config = types.SimpleNamespace(RUN_DIR=self.run_dir, HUB_MAX_WORKERS=1,
+                                               MAX_QUEUED_JOBS=10, logger=logging)
+        # job manager relies on the default loop
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        # one thread: jobs run in the order they're launched
+        self.jm = manager.JobManager(self.loop, num_workers=1, num_threads=1, auto_recycle=False)
+        self.launched = []
+
+    def tearDown(self):
+        self.jm.process_queue.shutdown()
+        self.jm.thread_queue.shutdown()
+        self.loop.close()
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        self.manager.config = self.orig_config
+        shutil.rmtree(self.run_dir)
+
+    def pinfo(self, category, source, predicates=None):
+        pinfo = {"category": category, "source": source, "step": "", "description": ""}
+        if predicates:
+            pinfo["__predicates__"] = predicates
+        return pinfo
+
+    def job(self, name):
+        self.launched.append(name)
+        return name
+
+    @asyncio.coroutine
+    def submit(self, pinfo):
+        job = yield from self.jm.defer_to_thread(pinfo, self.job, pinfo["source"])
+        return (yield from job)
+
+
+class TestJobScheduling(JobManagerTestCase):
+
+    def test_priority_then_fifo(self):
+        # too much memory used, everything is postponed
+        self.jm.max_memory_usage = 1
+
+        @asyncio.coroutine
+        def run():
+            jobs = [asyncio.ensure_future(self.submit(self.pinfo(cat, src)))
+                    for cat, src in [("inspector", "i1"), ("uploader", "u1"),
+                                     ("indexer", "x1"), ("uploader", "u2"), ("indexer", "x2")]]
+            yield from asyncio.sleep(0.1)
+            self.assertEqual(self.launched, [])
+            self.assertEqual(len(self.jm.pending_jobs), 5)
+            # memory released
+            self.jm.max_memory_usage = None
+            self.jm.notify()
+            yield from asyncio.gather(*jobs)
+
+        self.loop.run_until_complete(run())
+        self.assertEqual(self.launched, ["x1", "x2", "u1", "u2", "i1"])
+
+    def test_failing_predicate_not_blocking(self):
+        ready = False
+
+        @asyncio.coroutine
+        def run():
+            blocked = asyncio.ensure_future(self.submit(self.pinfo("indexer", "blocked", [lambda jm: ready])))
+            yield from asyncio.sleep(0.1)
+            yield from self.submit(self.pinfo("inspector", "other"))
+            self.assertEqual(self.launched, ["other"])
+            return (yield from blocked)
+
+        def unblock():
+            nonlocal ready
+            ready = True
+            self.jm.notify()
+
+        t0 = time.time()
+        self.loop.call_later(0.5, unblock)
+        self.loop.run_until_complete(run())
+        self.assertEqual(self.launched, ["other", "blocked"])
+        # launched when notified, not when polling again
+        self.assertTrue(time.time() - t0 < 2)
+
+    def test_launched_when_job_done(self):
+        def nothing_running(jm):
+            return len(jm.jobs) == 0
+
+        def slow():
+            time.sleep(0.3)
+
+        @asyncio.coroutine
+        def run():
+            first = yield from self.jm.defer_to_thread(self.pinfo("builder", "first"), slow)
+            t0 = time.time()
+            second = yield from self.jm.defer_to_thread(self.pinfo("builder", "second", [nothing_running]),
+                                                        self.job, "second")
+            waited = time.time() - t0
+            yield from asyncio.gather(first, second)
+            return waited
+
+        waited = self.loop.run_until_complete(run())
+        self.assertTrue(0.2 < waited < 2)
+
+    def test_cancelled_while_pending(self):
+        @asyncio.coroutine
+        def run():
+            blocked = asyncio.ensure_future(self.submit(self.pinfo("indexer", "blocked", [lambda jm: False])))
+            yield from asyncio.sleep(0.1)
+            self.assertEqual(len(self.jm.pending_jobs), 1)
+            blocked.cancel()
+            yield from asyncio.sleep(0.1)
+
+        self.loop.run_until_complete(run())
+        # not admitted, not left pending either
+        self.assertEqual(self.launched, [])
+        self.assertEqual(self.jm.pending_jobs, {})
+
+
+class FakeStatsCollection(object):
+
+    def __init__(self, docs=None):
+        self.docs = dict([(d["_id"], d) for d in docs or []])
+
+    def find(self):
+        return list(self.docs.values())
+
+    def save(self, doc):
+        self.docs[doc["_id"]] = dict(doc)
+
+
+class TestMemoryAdmission(JobManagerTestCase):
+
+    def setUp(self):
+        super(TestMemoryAdmission, self).setUp()
+        self.orig_get_job_stats = self.manager.get_job_stats
+        self.stats = FakeStatsCollection([{"_id": "uploader", "peak_mem": 100, "sources": {"u1": 100}}])
+        self.manager.get_job_stats = lambda: self.stats
+        # loaded when job manager is created, reload from fake collection
+        self.jm.job_stats = None
+        self.jm.load_job_stats()
+
+    def tearDown(self):
+        self.manager.get_job_stats = self.orig_get_job_stats
+        super(TestMemoryAdmission, self).tearDown()
+
+    def test_reservation(self):
+        # declared requirement first, then learned peak for source, then for category
+        self.assertEqual(self.jm.get_reservation({"category": "uploader", "__reqs__": {"mem": 5}}), 5)
+        self.assertEqual(self.jm.get_reservation(self.pinfo("uploader", "u1")), 100)
+        self.assertEqual(self.jm.get_reservation(self.pinfo("uploader", "u2")), 100)
+        self.assertEqual(self.jm.get_reservation(self.pinfo("builder", "b1")), 0)
+
+    def test_learn_peak(self):
+        # saved from a thread
+        self.loop.run_until_complete(self.jm.learn_peak(self.pinfo("uploader", "u2"), 300))
+        # lower peak doesn't override learned one
+        self.assertIsNone(self.jm.learn_peak(self.pinfo("uploader", "u2"), 200))
+        self.assertEqual(self.stats.docs["uploader"]["sources"], {"u1": 100, "u2": 300})
+        self.assertEqual(self.stats.docs["uploader"]["peak_mem"], 300)
+        self.assertEqual(self.jm.get_reservation(self.pinfo("uploader", "u1")), 100)
+        self.assertEqual(self.jm.get_reservation(self.pinfo("uploader", "u3")), 300)
+
+    def test_learn_peak_process_default_executor(self):
+        # saved from job manager's threads, whatever the loop's default executor
+        self.loop.set_default_executor(self.jm.process_queue)
+        self.loop.run_until_complete(self.jm.learn_peak(self.pinfo("uploader", "u2"), 300))
+        self.assertEqual(self.stats.docs["uploader"]["sources"], {"u1": 100, "u2": 300})
+
+    def test_reserved_memory_blocks_admission(self):
+        mem = 500 * 1024 ** 2
+        # room for one job only, once its reservation is accounted for
+        self.jm.max_memory_usage = self.jm.hub_memory + int(1.5 * mem)
+
+        def slow():
+            time.sleep(0.3)
+
+        @asyncio.coroutine
+        def run():
+            pinfo = self.pinfo("builder", "first")
+            pinfo["__reqs__"] = {"mem": mem}
+            first = yield from self.jm.defer_to_thread(pinfo, slow)
+            self.assertEqual(sum(self.jm.reservations.values()), mem)
+            t0 = time.time()
+            pinfo = self.pinfo("builder", "second")
+            pinfo["__reqs__"] = {"mem": mem}
+            second = yield from self.jm.defer_to_thread(pinfo, self.job, "second")
+            waited = time.time() - t0
+            yield from asyncio.gather(first, second)
+            return waited
+
+        waited = self.loop.run_until_complete(run())
+        self.assertTrue(0.2 < waited < 2)
+        self.assertEqual(self.jm.reservations, {})
+
+    def test_peak_over_limit(self):
+        mem = 500 * 1024 ** 2
+        self.jm.max_memory_usage = self.jm.hub_memory + mem
+        # learned peak can never fit
+        self.stats.docs["builder"] = {"_id": "builder", "peak_mem": 10 * mem, "sources": {}}
+        self.jm.job_stats = None
+
+        def slow():
+            time.sleep(0.3)
+
+        @asyncio.coroutine
+        def run():
+            first = yield from self.jm.defer_to_thread(self.pinfo("inspector", "first"), slow)
+            t0 = time.time()
+            # waits for running job, then runs alone instead of being blocked forever
+            second = yield from self.jm.defer_to_thread(self.pinfo("builder", "second"), self.job, "second")
+            waited = time.time() - t0
+            yield from asyncio.gather(first, second)
+            return waited
+
+        waited = self.loop.run_until_complete(run())
+        self.assertTrue(0.2 < waited < 2)
+        self.assertEqual(self.launched, ["second"])
+
+
+class TestWorkerResources(JobManagerTestCase):
+
+    def test_resource_opened_once_per_process(self):
+        opened = []
+
+        def factory():
+            opened.append(1)
+            return object()
+
+        res = self.manager.get_worker_resource("test_resource", factory)
+        self.assertIs(self.manager.get_worker_resource("test_resource", factory), res)
+        self.assertEqual(len(opened), 1)
+        # another process (pid) gets its own
+        orig_getpid = self.manager.os.getpid
+        self.manager.os.getpid = lambda: -1
+        try:
+            self.assertIsNot(self.manager.get_worker_resource("test_resource", factory), res)
+        finally:
+            self.manager.os.getpid = orig_getpid
+        self.assertEqual(len(opened), 2)
+
+    def test_init_worker(self):
+        self.manager.WORKER_RESOURCES["test_init"] = "os.getcwd"
+        try:
+            # errors are only logged
+            self.manager.init_worker(["json", "not_a_module"], ["test_init"])
+            key = (self.manager.os.getpid(), "test_init")
+            self.assertEqual(self.manager._worker_resources[key], self.manager.os.getcwd())
+        finally:
+            self.manager.WORKER_RESOURCES.pop("test_init")
+
+
+class TestJobStatus(JobManagerTestCase):
+
+    def test_update_job_status(self):
+        # no-op outside a job
+        self.manager.update_job_status(storage={"docs": 1})
+        seen = []
+
+        def job():
+            self.manager.update_job_status(storage={"docs": 10})
+            self.manager.update_job_status(progress="50%")
+            seen.extend(self.jm.get_thread_files().values())
+            return True
+
+        @asyncio.coroutine
+        def run():
+            fut = yield from self.jm.defer_to_thread(self.pinfo("uploader", "src"), job)
+            return (yield from fut)
+
+        self.assertTrue(self.loop.run_until_complete(run()))
+        self.assertEqual(len(seen), 1)
+        self.assertEqual(seen[0]["job"]["status"], {"storage": {"docs": 10}, "progress": "50%"})
@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import shutil
+import tempfile
+import types
+import unittest
+
+from biothings.tests.hub.helper import stub_config
+from biothings.utils.metrics import MetricsRegistry
+
+
+def square(x):
+    return x * x
+
+
+def fail():
+    raise ValueError("nope")
+
+
+class TestMetricsRegistry(unittest.TestCase):
+
+    def test_render(self):
+        reg = MetricsRegistry(prefix="test_")
+        cnt = reg.counter("jobs_total", "Jobs", ["category"])
+        hist = reg.histogram("duration_seconds", "Durations", ["category"], buckets=(1, 10))
+        reg.gauge("running", "Running jobs", lambda: [({"category": "a\"b"}, 2)], ["category"])
+        reg.gauge("workers", "Workers", lambda: 4)
+        cnt.inc(category="dump")
+        cnt.inc(2, category="dump")
+        hist.observe(0.5, category="dump")
+        hist.observe(5, category="dump")
+        lines = reg.render().splitlines()
+        self.assertIn("# TYPE test_jobs_total counter", lines)
+        self.assertIn('test_jobs_total{category="dump"} 3', lines)
+        self.assertIn('test_duration_seconds_bucket{category="dump",le="1"} 1', lines)
+        self.assertIn('test_duration_seconds_bucket{category="dump",le="10"} 2', lines)
+        self.assertIn('test_duration_seconds_bucket{category="dump",le="+Inf"} 2', lines)
+        self.assertIn('test_duration_seconds_sum{category="dump"} 5.5', lines)
+        self.assertIn('test_duration_seconds_count{category="dump"} 2', lines)
+        self.assertIn('test_running{category="a\\"b"} 2', lines)
+        self.assertIn("test_workers 4", lines)
+        data = reg.to_dict()
+        self.assertEqual(data["test_jobs_total"], [{"category": "dump", "value": 3}])
+        self.assertEqual(data["test_duration_seconds"][0]["count"], 2)
+
+    def test_bad_labels(self):
+        cnt = MetricsRegistry().counter("jobs_total", "Jobs", ["category"])
+        with self.assertRaises(AssertionError):
+            cnt.inc(source="x")
+
+
+class TestJobManagerMetrics(unittest.TestCase):
+
+    def setUp(self):
+        stub_config()
+        self.run_dir = tempfile.mkdtemp()
+        from biothings.utils import manager
+        self.manager = manager
+        self.orig_config = manager.config
+        manager.config = types.SimpleNamespace(RUN_DIR=self.run_dir, HUB_MAX_WORKERS=2,
+                                               MAX_QUEUED_JOBS=10, logger=logging)
+        # job manager relies on the default loop
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.jm = manager.JobManager(self.loop, num_workers=2)
+
+    def tearDown(self):
+        self.jm.process_queue.shutdown()
+        self.jm.thread_queue.shutdown()
+        self.loop.close()
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        self.manager.config = self.orig_config
+        shutil.rmtree(self.run_dir)
+
+    def test_job_metrics(self):
+        pinfo = {"category": "uploader", "source": "test", "step": "upload", "description": ""}
+
+        @asyncio.coroutine
+        def run():
+            jobs = []
+            for i in range(3):
+                jobs.append((yield from self.jm.defer_to_process(dict(pinfo), square, i)))
+            jobs.append((yield from self.jm.defer_to_thread(dict(pinfo, category="inspector"), fail)))
+            return (yield from asyncio.gather(*jobs, return_exceptions=True))
+
+        res = self.loop.run_until_complete(run())
+        self.assertEqual(res[:3], [0, 1, 4])
+        self.assertIsInstance(res[3], ValueError)
+        metrics = self.jm.metrics()
+        counts = dict(((m["category"], m["executor"], m["status"]), m["value"])
+                      for m in metrics["biothings_hub_jobs_total"])
+        self.assertEqual(counts, {("uploader", "process", "success"): 3,
+                                  ("inspector", "thread", "failed"): 1})
+        durations = metrics["biothings_hub_job_duration_seconds"]
+        self.assertEqual(sorted((d["step"], d["count"]) for d in durations), [("upload", 1), ("upload", 3)])
+        self.assertEqual(metrics["biothings_hub_jobs_running"], [])
+        self.assertEqual(metrics["biothings_hub_jobs_pending"], [])
+        self.assertEqual(sum(d["count"] for d in metrics["biothings_hub_job_wait_seconds"]), 4)
+        text = self.jm.metrics(fmt="text")
+        self.assertIn("# TYPE biothings_hub_job_wait_seconds histogram", text)
+        self.assertIn("biothings_hub_process_pool_workers 2", text)
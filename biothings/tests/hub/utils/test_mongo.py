@@ -0,0 +1,105 @@
+import os
+import types
+import unittest
+
+from biothings.tests.hub.helper import stub_config
+stub_config()
+import biothings.utils.mongo as mongo
+
+
+class TestClientCache(unittest.TestCase):
+
+    uri = "mongodb://localhost:27017"
+
+    def setUp(self):
+        mongo._clients.clear()
+        self.orig_stats = dict(mongo.client_stats)
+        mongo.client_stats.update({"created": 0, "reused": 0, "forked": 0})
+
+    def tearDown(self):
+        for _, client in mongo._clients.values():
+            client.close()
+        mongo._clients.clear()
+        mongo.client_stats.update(self.orig_stats)
+
+    def test_reused(self):
+        client = mongo.get_client(self.uri)
+        self.assertIs(mongo.get_client(self.uri), client)
+        self.assertIsNot(mongo.get_client(self.uri + "/?appname=other"), client)
+        stats = mongo.get_client_stats()
+        self.assertEqual((stats["created"], stats["reused"], stats["open"]), (2, 1, 2))
+        self.assertAlmostEqual(stats["reuse_rate"], 1 / 3)
+
+    def test_not_reused_after_fork(self):
+        client = mongo.get_client(self.uri)
+        # client created by another process (parent)
+        mongo._clients[self.uri] = (-1, client)
+        self.assertIsNot(mongo.get_client(self.uri), client)
+        client.close()
+        self.assertEqual(mongo.get_client_stats()["forked"], 1)
+
+    def test_reset_in_child(self):
+        mongo.get_client(self.uri)
+        pid = os.fork()
+        if pid == 0:
+            # child: inherited clients discarded
+            os._exit(0 if not mongo._clients and mongo.client_stats["forked"] == 1 else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+        self.assertEqual(len(mongo._clients), 1)
+
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+
+@unittest.skipIf(mongomock is None, "mongomock is required (stand-in for a mongod server)")
+class TestIdRanges(unittest.TestCase):
+
+    def setUp(self):
+        self.col = mongomock.MongoClient()["unittest_ranges"]["mycol"]
+
+    def covered(self, ranges):
+        found = []
+        for id_range in ranges:
+            found.extend([d["_id"] for d in self.col.find(mongo.id_range_query(*id_range))])
+        return found
+
+    def test_single_type(self):
+        self.col.insert_many([{"_id": "id%04d" % i} for i in range(1000)])
+        ranges = mongo.get_id_ranges(self.col, 100, exact=True)
+        self.assertEqual(len(ranges), 10)
+        found = self.covered(ranges)
+        self.assertEqual(sorted(found), ["id%04d" % i for i in range(1000)])
+
+    def test_mixed_types(self):
+        from bson import ObjectId
+        oids = [ObjectId() for _ in range(5)]
+        self.col.insert_many([{"_id": "id%04d" % i} for i in range(500)] +
+                             [{"_id": i} for i in range(300)] + [{"_id": 1.5}] +
+                             [{"_id": oid} for oid in oids])
+        self.assertEqual(mongo.get_id_types(self.col), {"string", "number", "objectId"})
+        # a single type can't be split with mixed types
+        with self.assertRaises(ValueError):
+            mongo.get_id_boundaries(self.col, 100, exact=True)
+        for exact in (True, False):
+            found = self.covered(mongo.get_id_ranges(self.col, 100, exact=exact))
+            # each document is in one range only
+            self.assertEqual(len(found), self.col.count_documents({}))
+            self.assertEqual(set(map(repr, found)), set(repr(d["_id"]) for d in self.col.find()))
+
+    def test_several_collections(self):
+        # old collection has an extra _id type, not found in new one
+        old = mongomock.MongoClient()["unittest_ranges"]["old"]
+        old.insert_many([{"_id": "id%04d" % i} for i in range(300)] + [{"_id": i} for i in range(1000)])
+        self.col.insert_many([{"_id": "id%04d" % i} for i in range(100, 500)])
+        ranges = mongo.get_id_ranges([old, self.col], 100, exact=True)
+        # integer _ids are split using old collection, not in one big range
+        self.assertEqual(len([r for r in ranges if r[2] == {"_id": {"$type": "number"}}]), 10)
+        for col in (old, self.col):
+            found = []
+            for id_range in ranges:
+                found.extend([d["_id"] for d in col.find(mongo.id_range_query(*id_range))])
+            self.assertEqual(sorted(map(repr, found)), sorted(repr(d["_id"]) for d in col.find()))
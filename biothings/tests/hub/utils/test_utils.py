@@ -44,3 +44,57 @@ class TestDataTransform(unittest.TestCase):
         self.assertEquals(res['unii'][0]['preferred_term'], 'drugnameA')
         self.assertEquals(res['unii'][1]['preferred_term'], 'drugnameB')
 
+
+
+class TestContentHash(unittest.TestCase):
+
+    def test_stable_hash(self):
+        from datetime import datetime
+        from biothings.utils.common import content_hash
+        doc1 = {"_id": "a", "x": {"b": 1, "c": [1, 2]}, "d": datetime(2020, 1, 1)}
+        doc2 = {"d": datetime(2020, 1, 1), "x": {"c": [1, 2], "b": 1}, "_id": "a"}
+        self.assertEqual(content_hash(doc1), content_hash(doc2))
+        # list order matters
+        doc2["x"]["c"] = [2, 1]
+        self.assertNotEqual(content_hash(doc1), content_hash(doc2))
+
+
+class TestStreamDecompression(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.folder)
+
+    def write_gz(self, name, content):
+        import os, gzip
+        path = os.path.join(self.folder, name)
+        with gzip.open(path, "wt") as fout:
+            fout.write(content)
+        return path
+
+    def test_gunzipall_keeps_compressed(self):
+        import os
+        from biothings.utils.common import gunzipall, stream_decompression, anyfile
+        self.write_gz("data.tsv.gz", "a\t1\nb\t2\n")
+        with stream_decompression():
+            gunzipall(self.folder)
+        self.assertEqual(os.listdir(self.folder), ["data.tsv.gz"])
+        # uncompressed file is read from its compressed version
+        with anyfile(os.path.join(self.folder, "data.tsv")) as fin:
+            self.assertEqual(fin.read(), "a\t1\nb\t2\n")
+        # default: uncompressed copy
+        gunzipall(self.folder)
+        self.assertEqual(sorted(os.listdir(self.folder)), ["data.tsv", "data.tsv.gz"])
+
+    def test_bz2(self):
+        import os, bz2
+        from biothings.utils.common import anyfile
+        path = os.path.join(self.folder, "data.txt.bz2")
+        with bz2.open(path, "wt") as fout:
+            fout.write("hello\n")
+        with anyfile(path) as fin:
+            self.assertEqual(fin.read(), "hello\n")
@@ -1,7 +1,10 @@
 ''' Backend access class. '''
 from functools import partial
+from pymongo import UpdateOne, ReplaceOne
+from pymongo.write_concern import WriteConcern
 
 from biothings.utils.es import ESIndexer
+from biothings.utils.common import iter_n
 from biothings import config as btconfig
 from elasticsearch.exceptions import NotFoundError, TransportError
 
@@ -82,6 +85,8 @@ class DocMemoryBackend(DocBackendBase):
 
 class DocMongoBackend(DocBackendBase):
     name = 'mongo'
+    bulk_batch_size = None # max number of operations per bulk_write() call (None: no limit)
+    bulk_write_concern = None # dict passed to pymongo's WriteConcern, ex: {"w":1,"j":False}
 
     def __init__(self, target_db, target_collection=None):
         """target_collection is a pymongo collection object."""
@@ -145,23 +150,44 @@ class DocMongoBackend(DocBackendBase):
         '''if id does not exist in the target_collection,
             the update will be ignored except if upsert is True
         '''
-        bulk = self.target_collection.initialize_ordered_bulk_op()
-        at_least_one = False
-        for doc in docs:
-            at_least_one = True
-            op = bulk.find({'_id':doc["_id"]})
-            if upsert:
-                op = op.upsert()
-            op.update({"$set":doc})
-        if at_least_one:
-            res = bulk.execute()
-            # if doc is the same, it'll be matched but not modified.
-            # but for us, it's been processed. if upserted, then it can't be matched
-            # before (so matched cound doesn't include upserted). finally, it's only update
-            # ops, so don't count nInserted and nRemoved
-            return res["nMatched"] + res["nUpserted"]
+        res = self.bulk_update(docs, upsert=upsert)
+        # if doc is the same, it'll be matched but not modified.
+        # but for us, it's been processed. if upserted, then it can't be matched
+        # before (so matched cound doesn't include upserted). finally, it's only update
+        # ops, so don't count nInserted and nRemoved
+        return res["matched"] + res["inserted"]
+
+    def bulk_update(self, docs, upsert=False, replace=False, batch_size=None, write_concern=None):
+        '''Update (or replace, if "replace" is True) docs using unordered bulk_write()
+           calls, one per sub-batch of "batch_size" documents (one for all docs if None,
+           default is self.bulk_batch_size). "write_concern" is an optional dict passed
+           to pymongo's WriteConcern (default is self.bulk_write_concern).
+           Because writes are unordered, docs should not contain duplicated _ids.
+           Returns a dict with counts for "inserted" (upserted), "updated" (actually
+           modified) and "matched" (found, whether modified or not) documents.
+        '''
+        batch_size = batch_size or self.bulk_batch_size
+        write_concern = write_concern or self.bulk_write_concern
+        col = self.target_collection
+        if write_concern:
+            col = col.with_options(write_concern=WriteConcern(**write_concern))
+        stats = {"inserted" : 0, "updated" : 0, "matched" : 0}
+        if replace:
+            ops = (ReplaceOne({'_id':doc["_id"]}, doc, upsert=upsert) for doc in docs)
         else:
-            return 0
+            ops = (UpdateOne({'_id':doc["_id"]}, {"$set":doc}, upsert=upsert) for doc in docs)
+        batches = batch_size and iter_n(ops,batch_size) or [list(ops)]
+        for batch in batches:
+            if not batch:
+                continue
+            res = col.bulk_write(list(batch), ordered=False)
+            if not res.acknowledged:
+                # unacknowledged write concern (w=0), no counts available
+                continue
+            stats["inserted"] += res.upserted_count
+            stats["updated"] += res.modified_count
+            stats["matched"] += res.matched_count
+        return stats
 
     def update_diff(self, diff, extra={}):
         '''update a doc based on the diff returned from diff.diff_doc
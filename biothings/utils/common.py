@@ -25,6 +25,7 @@ import inspect
 import types
 import gzip
 import glob
+import threading
 from datetime import date, datetime, timezone
 from functools import partial
 # from json serial, catching special type
@@ -150,28 +151,51 @@ def safewfile(filename, prompt=True, default='C', mode='w'):
     return open(filename, mode), filename
 
 
+# compressed file extensions anyfile() can read through (see also
+# stream_decompression())
+COMPRESSED_EXTENSIONS = ('.gz', '.bz2', '.xz', '.zst')
+
+def find_compressed_file(infile):
+    '''
+    If infile doesn't exist, return its compressed sibling (eg. "infile.gz",
+    kept compressed when decompression is streamed), or infile otherwise.
+    '''
+    if isinstance(infile, str) and not os.path.exists(infile):
+        for ext in COMPRESSED_EXTENSIONS:
+            if os.path.exists(infile + ext):
+                return infile + ext
+    return infile
+
 def anyfile(infile, mode='r'):
     '''
-    return a file handler with the support for gzip/zip comppressed files
+    return a file handler with the support for gzip/zip/bz2/xz/zstd comppressed files
     if infile is a two value tuple, then first one is the compressed file;
       the second one is the actual filename in the compressed file.
       e.g., ('a.zip', 'aa.txt')
-
+    if infile doesn't exist but a compressed version does (eg. infile + ".gz"),
+    the compressed file is read, decompressed on the fly.
     '''
     if isinstance(infile, tuple):
         infile, rawfile = infile[:2]
     else:
+        infile = find_compressed_file(infile)
         rawfile = os.path.splitext(infile)[0]
     filetype = os.path.splitext(infile)[1].lower()
     if filetype == '.gz':
         # import gzip
         in_f = io.TextIOWrapper(gzip.GzipFile(infile, mode))
+    elif filetype == '.bz2':
+        import bz2
+        in_f = io.TextIOWrapper(bz2.BZ2File(infile, mode))
     elif filetype == '.zip':
         import zipfile
         in_f = io.TextIOWrapper(zipfile.ZipFile(infile, mode).open(rawfile, mode))
     elif filetype == '.xz':
         import lzma
         in_f = io.TextIOWrapper(lzma.LZMAFile(infile, mode))
+    elif filetype == '.zst':
+        from biothings.utils.compression import get_backend
+        in_f = io.TextIOWrapper(get_backend("zstd").open(infile, 'rb'))
     else:
         in_f = open(infile, mode)
     return in_f
@@ -279,7 +303,8 @@ def split_ids(q):
 
 def get_compressed_outfile(filename, compress='gzip'):
     '''Get a output file handler with given compress method.
-       currently support gzip/bz2/lzma, lzma only available in py3
+       currently support gzip/bz2/lzma/zstd, zstd using "zstd" command
+       (multi-threaded) or zstandard module
     '''
     if compress == "gzip":
         # import gzip
@@ -290,6 +315,9 @@ def get_compressed_outfile(filename, compress='gzip'):
     elif compress == 'lzma' or compress == 'xz':
         import lzma
         out_f = lzma.LZMAFile(filename, 'wb')
+    elif compress == 'zstd' or compress == 'zst':
+        from biothings.utils.compression import get_backend
+        out_f = get_backend("zstd").open(filename, 'wb')
     elif compress is None:
         out_f = open(filename, 'wb')
     else:
@@ -299,7 +327,7 @@ def get_compressed_outfile(filename, compress='gzip'):
 
 def open_compressed_file(filename):
     '''Get a read-only file-handler for compressed file,
-       currently support gzip/bz2/lzma, lzma only available in py3
+       currently support gzip/bz2/lzma/zstd
     '''
     in_f = open(filename, 'rb')
     sig = in_f.read(5)
@@ -316,6 +344,10 @@ def open_compressed_file(filename):
         # this is a lzma file
         import lzma
         fobj = lzma.LZMAFile(filename, 'r')
+    elif sig[:4] == b'\x28\xb5\x2f\xfd':
+        # this is a zstd file
+        from biothings.utils.compression import get_backend
+        fobj = get_backend("zstd").open(filename, 'rb')
     else:
         # assuming uncompressed ?
         fobj = open(filename, 'rb')
@@ -650,18 +682,43 @@ def untargzall(folder, pattern="*.tar.gz"):
     gunzip and untar all *.tar.gz files in "folder"
     '''
     import tarfile
+    from biothings.utils.compression import get_backend
     for tgz in glob.glob(os.path.join(folder, pattern)):
-        gz = gzip.GzipFile(tgz)
-        tf = tarfile.TarFile(fileobj=gz)
-        logging.info("untargz '%s'", tf.name)
-        tf.extractall(folder)
-        logging.info("done untargz '%s'", tf.name)
+        logging.info("untargz '%s'", tgz)
+        # streamed (decompressed by pigz if available)
+        with get_backend("gzip").open(tgz) as gz:
+            with tarfile.open(fileobj=gz, mode="r|") as tf:
+                tf.extractall(folder)
+        logging.info("done untargz '%s'", tgz)
+
+
+_decompression = threading.local()
+
+@contextmanager
+def stream_decompression():
+    '''
+    Within this context, gunzipall() keeps files compressed: they're
+    decompressed on the fly when read with anyfile(), so there's no
+    uncompressed copy on disk (see BaseDumper.STREAM_DECOMPRESS).
+    Archives (tar, zip) are still extracted.
+    '''
+    previous = getattr(_decompression, "streaming", False)
+    _decompression.streaming = True
+    try:
+        yield
+    finally:
+        _decompression.streaming = previous
 
+def is_stream_decompression():
+    return getattr(_decompression, "streaming", False)
 
 def gunzipall(folder, pattern="*.gz"):
     '''
     gunzip all *.gz files in "folder"
     '''
+    if is_stream_decompression():
+        logging.info("Streaming decompression, keeping '%s' files compressed in '%s'", pattern, folder)
+        return
     for f in glob.glob(os.path.join(folder, pattern)):
         # build uncompress filename from gz file and pattern
         # pattern is used to select/filter files, but it may not
@@ -670,59 +727,93 @@ def gunzipall(folder, pattern="*.gz"):
         suffix = ".%s" % pattern.split(".")[1]
         gunzip(f, suffix)
 
+def decompressall(folder, pattern):
+    '''
+    Decompress all single compressed files (gzip/bz2/xz/zstd) matching
+    pattern in "folder", using multi-threaded tools if available
+    (see utils.compression)
+    '''
+    from biothings.utils.compression import decompress_file
+    if is_stream_decompression():
+        logging.info("Streaming decompression, keeping '%s' files compressed in '%s'", pattern, folder)
+        return
+    for f in glob.glob(os.path.join(folder, pattern)):
+        decompress_file(f)
+
 def unxzall(folder, pattern="*.xz"):
     '''
     unxz all xz files in "folder", in "folder"
     '''
     import tarfile
+    from biothings.utils.compression import get_backend
     for xzfile in glob.glob(os.path.join(folder, pattern)):
         logging.info("unxzing '%s'", xzfile)
-        with tarfile.open(xzfile, 'r:xz') as t:
-            t.extractall(folder)
+        # streamed (decompressed by multi-threaded xz if available)
+        with get_backend("xz").open(xzfile) as xz:
+            with tarfile.open(fileobj=xz, mode="r|") as t:
+                t.extractall(folder)
         logging.info("done unxzing '%s'", xzfile)
 
 
-def gunzip(f, pattern="*.gz"):
+def gunzip(f, pattern="*.gz", threads=None):
+    '''
+    gunzip file "f", using pigz with "threads" threads if available
+    (default to all CPUs)
+    '''
+    from biothings.utils.compression import get_backend
     # build uncompress filename from gz file and pattern
     destf = f.replace(pattern.replace("*", ""), "")
-    fout = open(destf, "wb")
-    with gzip.GzipFile(f) as gz:
-        logging.info("gunzip '%s'", gz.name)
-        for line in gz:
-            fout.write(line)
-        logging.info("Done gunzip '%s'", gz.name)
-    fout.close()
-
-@asyncio.coroutine
+    backend = get_backend("gzip", threads=threads)
+    logging.info("gunzip '%s' using %s", f, backend.tool or "python")
+    backend.decompress(f, destf)
+    logging.info("Done gunzip '%s'", f)
+
 def aiogunzipall(folder, pattern, job_manager, pinfo):
     """
     Gunzip all files in folder matching pattern. job_manager is used
     for parallelisation, and pinfo is a pre-filled dict used by
-    job_manager to report jobs in the hub (see bt.utils.manager.JobManager)
+    job_manager to report jobs in the hub (see bt.utils.manager.JobManager).
+    Return a coroutine. Within stream_decompression() context, files are
+    kept compressed and no job is created (archives are not concerned,
+    untargzall() still extracts them).
     """
-    jobs = []
-    got_error = None
-    logging.info("Unzipping files in '%s'", folder)
-    for f in glob.glob(os.path.join(folder, pattern)):
-        pinfo["description"] = os.path.basename(f)
-        suffix = pattern.replace("*", "")
-        job = yield from job_manager.defer_to_process(pinfo, partial(gunzip, f, suffix=suffix))
-        def gunzipped(fut, inf):
-            try:
-                # res = fut.result()
-                fut.result()
-            except Exception as e:
-                logging.error("Failed to gunzip file %s: %s", inf, e)
-                nonlocal got_error
-                got_error = e
-        job.add_done_callback(partial(gunzipped, inf=f))
-        jobs.append(job)
-        if got_error:
-            raise got_error
-    if jobs:
-        yield from asyncio.gather(*jobs)
-        if got_error:
-            raise got_error
+    # checked in caller's thread (ie. post_dump()'s), the coroutine runs
+    # in the event loop and gunzip() in another process
+    streaming = is_stream_decompression()
+
+    @asyncio.coroutine
+    def do():
+        if streaming:
+            logging.info("Streaming decompression, keeping '%s' files compressed in '%s'", pattern, folder)
+            return
+        jobs = []
+        got_error = None
+        logging.info("Unzipping files in '%s'", folder)
+        files = glob.glob(os.path.join(folder, pattern))
+        # share CPUs between files decompressed in parallel
+        threads = max(1, (os.cpu_count() or 1) // max(1, len(files)))
+        for f in files:
+            pinfo["description"] = os.path.basename(f)
+            suffix = pattern.replace("*", "")
+            job = yield from job_manager.defer_to_process(pinfo, partial(gunzip, f, pattern=suffix, threads=threads))
+            def gunzipped(fut, inf):
+                try:
+                    # res = fut.result()
+                    fut.result()
+                except Exception as e:
+                    logging.error("Failed to gunzip file %s: %s", inf, e)
+                    nonlocal got_error
+                    got_error = e
+            job.add_done_callback(partial(gunzipped, inf=f))
+            jobs.append(job)
+            if got_error:
+                raise got_error
+        if jobs:
+            yield from asyncio.gather(*jobs)
+            if got_error:
+                raise got_error
+
+    return do()
 
 def uncompressall(folder):
     """Try to uncompress any known archive files in folder"""
@@ -730,6 +821,8 @@ def uncompressall(folder):
     untargzall(folder)
     gunzipall(folder)
     unxzall(folder)
+    decompressall(folder, "*.bz2")
+    decompressall(folder, "*.zst")
 
 def md5sum(fname):
     hash_md5 = hashlib.md5()
@@ -739,6 +832,12 @@ def md5sum(fname):
     return hash_md5.hexdigest()
 
 
+def content_hash(doc):
+    """Return a stable hash (md5 hexdigest) of a document's content,
+    keys order doesn't matter (non-JSON values are hashed as strings)"""
+    return hashlib.md5(json.dumps(doc, sort_keys=True, default=str).encode()).hexdigest()
+
+
 class splitstr(str):
     """Type representing strings with space in it"""
     pass
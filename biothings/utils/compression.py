@@ -0,0 +1,242 @@
+"""
+Decompression backends: compressed files are decompressed with multi-threaded
+external tools when available (pigz, xz -T, zstd -T, lbzip2/pbzip2), falling
+back to pure-python modules (gzip, lzma, bz2, and zstandard if installed).
+"""
+import os
+import re
+import gzip
+import shutil
+import signal
+import logging
+import subprocess
+
+# read/write chunk size for python backends
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# format => (magic bytes, extensions)
+FORMATS = {
+    "gzip" : (b'\x1f\x8b\x08', ('.gz',)),
+    "bz2" : (b'BZh', ('.bz2',)),
+    "xz" : (b'\xfd7zXZ', ('.xz',)),
+    "zstd" : (b'\x28\xb5\x2f\xfd', ('.zst', '.zstd')),
+}
+
+
+def detect_format(filename):
+    """Return compression format from file's magic bytes, or None"""
+    with open(filename, 'rb') as in_f:
+        sig = in_f.read(5)
+    for fmt, (magic, _) in FORMATS.items():
+        if sig.startswith(magic):
+            return fmt
+    return None
+
+
+def format_from_extension(filename):
+    ext = os.path.splitext(filename)[1].lower()
+    for fmt, (_, extensions) in FORMATS.items():
+        if ext in extensions:
+            return fmt
+    return None
+
+
+class ProcessFile(object):
+    """
+    File-like object reading from (or writing to) an external process,
+    closing it waits for the process and raises IOError if it failed.
+    """
+
+    def __init__(self, proc, stream, cmd):
+        self.proc = proc
+        self.stream = stream
+        self.cmd = cmd
+
+    def close(self):
+        if self.stream.closed:
+            return
+        self.stream.close()
+        ret = self.proc.wait()
+        # reader closed before the end: process got a broken pipe, that's ok
+        if ret != 0 and not (self.stream is self.proc.stdout and ret == -signal.SIGPIPE):
+            err = self.proc.stderr.read().decode(errors="replace") if self.proc.stderr else ""
+            raise IOError("Command %s failed (returned %s): %s" % (self.cmd, ret, err.strip()))
+
+    def __getattr__(self, attr):
+        return getattr(self.stream, attr)
+
+    def __iter__(self):
+        return iter(self.stream)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Backend(object):
+    """
+    Decompress (and compress) a format, with "tool" command if found in PATH,
+    using "threads" threads (None: all CPUs), or with python module otherwise.
+    """
+
+    format = None
+    tools = []  # candidate commands, first found is used
+
+    def __init__(self, threads=None, external=True):
+        self.threads = threads or os.cpu_count() or 1
+        self.tool = None
+        if external:
+            for tool in self.tools:
+                if shutil.which(tool):
+                    self.tool = tool
+                    break
+
+    def threads_args(self):
+        return []
+
+    def decompress_cmd(self):
+        return [self.tool, "-d", "-c"] + self.threads_args()
+
+    def compress_cmd(self):
+        return [self.tool, "-c"] + self.threads_args()
+
+    def python_open(self, filename, mode):
+        raise NotImplementedError("implement me in subclass")
+
+    def open(self, filename, mode="rb"):
+        """Return a binary file object, reading decompressed data or writing compressed data"""
+        assert mode in ("rb", "wb"), "Only binary read/write modes are supported"
+        if not self.tool:
+            return self.python_open(filename, mode)
+        if mode == "rb":
+            cmd = self.decompress_cmd() + [filename]
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                    bufsize=CHUNK_SIZE)
+            return ProcessFile(proc, proc.stdout, cmd)
+        else:
+            cmd = self.compress_cmd()
+            with open(filename, "wb") as out_f:
+                proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=out_f,
+                                        stderr=subprocess.PIPE, bufsize=CHUNK_SIZE)
+            return ProcessFile(proc, proc.stdin, cmd)
+
+    def decompress(self, filename, destfile):
+        if self.tool:
+            cmd = self.decompress_cmd() + [filename]
+            with open(destfile, "wb") as out_f:
+                proc = subprocess.run(cmd, stdout=out_f, stderr=subprocess.PIPE)
+            if proc.returncode != 0:
+                raise IOError("Command %s failed (returned %s): %s" % \
+                        (cmd, proc.returncode, proc.stderr.decode(errors="replace").strip()))
+        else:
+            with self.python_open(filename, "rb") as in_f, open(destfile, "wb") as out_f:
+                shutil.copyfileobj(in_f, out_f, CHUNK_SIZE)
+
+
+class GzipBackend(Backend):
+
+    format = "gzip"
+    # pigz decompression itself is single-threaded, but reading, writing
+    # and checksumming run in separate threads
+    tools = ["pigz"]
+
+    def threads_args(self):
+        return ["-p", str(self.threads)]
+
+    def python_open(self, filename, mode):
+        return gzip.GzipFile(filename, mode)
+
+
+class XzBackend(Backend):
+
+    format = "xz"
+    tools = ["xz"]
+    # xz version, as a tuple, per command (None if unknown)
+    versions = {}
+
+    def tool_version(self):
+        if not self.tool in self.versions:
+            version = None
+            try:
+                out = subprocess.run([self.tool, "--version"], stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL).stdout.decode(errors="replace")
+                found = re.search(r"(\d+)\.(\d+)(?:\.(\d+))?", out)
+                if found:
+                    version = tuple(int(v or 0) for v in found.groups())
+            except OSError:
+                pass
+            self.versions[self.tool] = version
+        return self.versions[self.tool]
+
+    def threads_args(self):
+        # -T is supported since xz 5.2 (multi-threaded compression),
+        # decompression is multi-threaded since 5.4 only (-T ignored before)
+        version = self.tool_version()
+        if version and version >= (5, 2):
+            return ["-T", str(self.threads)]
+        return []
+
+    def python_open(self, filename, mode):
+        import lzma
+        return lzma.LZMAFile(filename, mode)
+
+
+class Bz2Backend(Backend):
+
+    format = "bz2"
+    tools = ["lbzip2", "pbzip2"]
+
+    def threads_args(self):
+        if self.tool == "lbzip2":
+            return ["-n", str(self.threads)]
+        return ["-p%s" % self.threads]
+
+    def python_open(self, filename, mode):
+        import bz2
+        return bz2.BZ2File(filename, mode)
+
+
+class ZstdBackend(Backend):
+
+    format = "zstd"
+    tools = ["zstd"]
+
+    def threads_args(self):
+        return ["-q", "-T%s" % self.threads]
+
+    def python_open(self, filename, mode):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("zstd files require 'zstd' command or 'zstandard' module")
+        if mode == "rb":
+            return zstandard.ZstdDecompressor().stream_reader(open(filename, "rb"), closefd=True)
+        else:
+            return zstandard.ZstdCompressor(threads=self.threads).stream_writer(
+                    open(filename, "wb"), closefd=True)
+
+
+BACKENDS = dict([(klass.format, klass) for klass in [GzipBackend, XzBackend, Bz2Backend, ZstdBackend]])
+
+
+def get_backend(fmt, threads=None, external=True):
+    """Return backend instance for format "fmt" (gzip, bz2, xz or zstd)"""
+    try:
+        return BACKENDS[fmt](threads=threads, external=external)
+    except KeyError:
+        raise ValueError("Unsupported compression format '%s'" % fmt)
+
+
+def decompress_file(filename, destfile=None, threads=None, external=True):
+    """
+    Decompress filename into destfile (default to filename without its extension),
+    format is detected from file's content. Return destfile.
+    """
+    fmt = detect_format(filename) or format_from_extension(filename)
+    backend = get_backend(fmt, threads=threads, external=external)
+    destfile = destfile or os.path.splitext(filename)[0]
+    logging.info("Decompressing '%s' (%s) using %s", filename, fmt, backend.tool or "python")
+    backend.decompress(filename, destfile)
+    return destfile
@@ -95,6 +95,28 @@ def two_docs_iterator(b1, b2, id_list, step=10000, verbose=False):
         print('Finished.[total time: %s]' % timesofar(t0))
 
 
+def merge_join_iterator(iter1, iter2):
+    '''Merge join over two iterables of docs, both sorted by _id.
+       yield (doc1, doc2) tuples, doc1 or doc2 being None when the _id only
+       exists on one side (_ids must be of comparable types).
+    '''
+    iter1 = iter(iter1)
+    iter2 = iter(iter2)
+    doc1 = next(iter1, None)
+    doc2 = next(iter2, None)
+    while doc1 is not None or doc2 is not None:
+        if doc2 is None or (doc1 is not None and doc1["_id"] < doc2["_id"]):
+            yield doc1, None
+            doc1 = next(iter1, None)
+        elif doc1 is None or doc2["_id"] < doc1["_id"]:
+            yield None, doc2
+            doc2 = next(iter2, None)
+        else:
+            yield doc1, doc2
+            doc1 = next(iter1, None)
+            doc2 = next(iter2, None)
+
+
 def _diff_doc_worker(args):
     _b1, _b2, ids, _path = args
     import biothings.utils.diff
@@ -134,22 +156,28 @@ def diff_docs_jsonpatch(b1, b2, ids, fastdiff=False, exclude_attrs=[]):
     for doc1, doc2 in two_docs_iterator(b1, b2, ids):
         assert doc1['_id'] == doc2['_id'], "Different ids: '%s' != '%s'" % \
                 (doc1['_id'], doc2['_id'])
-        if exclude_attrs:
-            doc1 = filter_dict(doc1, exclude_attrs)
-            doc2 = filter_dict(doc2, exclude_attrs)
-        if fastdiff:
-            if doc1 != doc2:
-                _updates.append(doc1['_id'])
-        else:
-            _patch = jsondiff(doc1, doc2)
-            if _patch:
-                _diff = {}
-                _diff['patch'] = _patch
-                _diff['_id'] = doc1['_id']
-                _updates.append(_diff)
+        _diff = diff_doc_jsonpatch(doc1, doc2, fastdiff=fastdiff, exclude_attrs=exclude_attrs)
+        if _diff:
+            _updates.append(_diff)
     return _updates
 
 
+def diff_doc_jsonpatch(doc1, doc2, fastdiff=False, exclude_attrs=[]):
+    '''Return jsonpatch update (or only _id if fastdiff is True) to
+       go from doc1 to doc2, None if docs are the same.
+    '''
+    if exclude_attrs:
+        doc1 = filter_dict(doc1, exclude_attrs)
+        doc2 = filter_dict(doc2, exclude_attrs)
+    if fastdiff:
+        if doc1 != doc2:
+            return doc1['_id']
+    else:
+        _patch = jsondiff(doc1, doc2)
+        if _patch:
+            return {'patch': _patch, '_id': doc1['_id']}
+
+
 
 
 # TODO: move to mongodb backend class
@@ -232,8 +260,8 @@ def diff_collections(b1, b2, use_parallel=True, step=10000):
 def get_backend(uri, db, col, bk_type):
     if bk_type != "mongodb":
         raise NotImplementedError("Backend type '%s' not supported" % bk_type)
-    from biothings.utils.mongo import MongoClient
-    colobj = MongoClient(uri)[db][col]
+    from biothings.utils.mongo import get_client
+    colobj = get_client(uri)[db][col]
     return DocMongoDBBackend(colobj)
 
 
@@ -0,0 +1,137 @@
+"""
+Line-oriented diff file format ("ndjson"), alternative to pickled diff files.
+
+A diff file is a gzip stream of newline-delimited JSON records (MongoDB extended
+JSON, so dates and ObjectIds survive). The first record is a header:
+    {"op": "header", "version": 1, "source": <collection name>, "timestamp": ...}
+followed by one record per operation:
+    {"op": "add", "v": <_id or whole document if self-contained>}
+    {"op": "update", "v": {"_id": ..., "patch": [...]}}
+    {"op": "delete", "v": <_id>}
+
+Each file is written as a single gzip member, so concatenating files gives a
+valid (multi-member) gzip stream where each original file is an independently
+readable frame. Merging diff files is then a simple concatenation: repeated
+header records are allowed, they must all refer to the same source.
+"""
+import gzip
+import shutil
+
+from bson import json_util
+
+
+EXTENSION = ".ndjson.gz"
+VERSION = 1
+OPERATIONS = ("add", "update", "delete")
+# dates are naive, as returned by pymongo by default
+JSON_OPTIONS = json_util.JSONOptions(tz_aware=False)
+
+
+def is_diffstream(filename):
+    return filename.endswith(EXTENSION) or filename.endswith(EXTENSION + ".synced")
+
+
+class DiffStreamWriter(object):
+
+    def __init__(self, filename, source, timestamp=None):
+        self.filename = filename
+        self.count = dict([(op, 0) for op in OPERATIONS])
+        self.fout = gzip.open(filename, "wt")
+        self._write({"op": "header", "version": VERSION, "source": source, "timestamp": timestamp})
+
+    def _write(self, record):
+        self.fout.write(json_util.dumps(record) + "\n")
+
+    def write(self, op, values):
+        assert op in OPERATIONS, "Unknown operation '%s'" % op
+        for value in values:
+            self._write({"op": op, "v": value})
+            self.count[op] += 1
+
+    def close(self):
+        self.fout.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class DiffOperations(object):
+    """
+    Iterable over values for one operation type, re-reading (streaming)
+    the diff file each time it's iterated. len() also implies a pass over the file.
+    """
+
+    def __init__(self, reader, op):
+        self.reader = reader
+        self.op = op
+
+    def __iter__(self):
+        for record in self.reader.records():
+            if record["op"] == self.op:
+                yield record["v"]
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class DiffStreamReader(object):
+    """
+    Read a diff file with bounded memory. diff["add"], diff["update"] and
+    diff["delete"] are iterables over operations (see DiffOperations),
+    diff["source"] and diff["timestamp"] come from the header.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.header = None
+        for record in self.records():
+            # just read the header
+            break
+        if self.header is None:
+            raise ValueError("No header found in diff file '%s'" % filename)
+
+    def records(self):
+        with gzip.open(self.filename, "rt") as fin:
+            for line in fin:
+                record = json_util.loads(line, json_options=JSON_OPTIONS)
+                if record["op"] == "header":
+                    if self.header is None:
+                        self.header = record
+                    elif record["source"] != self.header["source"]:
+                        raise ValueError("Diff file '%s' mixes sources '%s' and '%s'" % \
+                                         (self.filename, self.header["source"], record["source"]))
+                    continue
+                yield record
+
+    def __getitem__(self, key):
+        if key in OPERATIONS:
+            return DiffOperations(self, key)
+        return self.header[key]
+
+    def load(self):
+        """Load whole diff content in memory, as a dict (same as pickled diff files)"""
+        data = {"source": self.header["source"], "timestamp": self.header["timestamp"]}
+        for op in OPERATIONS:
+            data[op] = []
+        for record in self.records():
+            data[record["op"]].append(record["v"])
+        return data
+
+
+def dump_diff(data, filename):
+    """Write diff dict "data" (keys: source, timestamp, add, update, delete) to filename"""
+    with DiffStreamWriter(filename, data["source"], data.get("timestamp")) as writer:
+        for op in OPERATIONS:
+            writer.write(op, data[op])
+    return writer.count
+
+
+def concat_diffs(filenames, outfile):
+    """Merge diff files into outfile, by concatenation"""
+    with open(outfile, "wb") as fout:
+        for filename in filenames:
+            with open(filename, "rb") as fin:
+                shutil.copyfileobj(fin, fout)
@@ -68,12 +68,136 @@ def wrapper(func):
 class IndexerException(Exception):
     pass
 
+
+class AdaptiveBulkSender(object):
+    """
+    Send bulk actions to ES with requests targeting a size in bytes rather than
+    a number of documents. Requests are sent in parallel (helpers.parallel_bulk,
+    "thread_count" requests in flight at most). When ES pushes back (HTTP 429,
+    rejected execution), rejected actions are retried after a backoff and target
+    size is halved. Otherwise target size is increased, up to "max_bytes".
+    Throughput is recorded in "stats" (see get_stats()).
+    """
+
+    def __init__(self, client, target_bytes=5*1024**2, min_bytes=256*1024, max_bytes=50*1024**2,
+                 max_docs=10000, thread_count=4, max_retries=5, initial_backoff=2, max_backoff=60):
+        self.client = client
+        self.target_bytes = target_bytes
+        self.min_bytes = min_bytes
+        self.max_bytes = max_bytes
+        self.max_docs = max_docs
+        self.thread_count = thread_count
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.stats = {"docs": 0, "bytes": 0, "time": 0.0, "rejected": 0, "retries": 0}
+
+    @staticmethod
+    def is_rejection(item):
+        info = list(item.values())[0]
+        if info.get("status") == 429:
+            return True
+        return "rejected_execution" in str(info.get("error", ""))
+
+    def sizeof(self, action):
+        # same serializer as the one used to send bulk requests
+        body = dict([(k, v) for k, v in action.items() if not k.startswith("_")])
+        return len(self.client.transport.serializer.dumps(body).encode())
+
+    def windows(self, actions):
+        """
+        Group actions so each group gives about 2 requests per thread,
+        yield (actions, size) tuples
+        """
+        window = []
+        size = 0
+        for action in actions:
+            window.append(action)
+            size += self.sizeof(action)
+            if size >= self.target_bytes * self.thread_count * 2 or \
+                    len(window) >= self.max_docs * self.thread_count * 2:
+                yield window, size
+                window = []
+                size = 0
+        if window:
+            yield window, size
+
+    def send_window(self, window):
+        """Send actions, return (num_ok, errors, rejected actions)"""
+        num_ok = 0
+        errors = []
+        rejected = []
+        done = 0
+        try:
+            results = helpers.parallel_bulk(self.client, window,
+                                            thread_count=self.thread_count,
+                                            queue_size=self.thread_count,
+                                            chunk_size=self.max_docs,
+                                            max_chunk_bytes=int(self.target_bytes),
+                                            raise_on_error=False)
+            # results are in the same order as actions
+            for (ok, item), action in zip(results, window):
+                done += 1
+                if ok:
+                    num_ok += 1
+                elif self.is_rejection(item):
+                    rejected.append(action)
+                else:
+                    errors.append(item)
+        except TransportError as e:
+            if e.status_code != 429:
+                raise
+            # whole request rejected, remaining actions need to be sent again
+            rejected.extend(window[done:])
+        return num_ok, errors, rejected
+
+    def send(self, actions):
+        """Send actions, return (num_ok, errors)"""
+        num_ok = 0
+        errors = []
+        t0 = time.time()
+        for window, size in self.windows(actions):
+            backoff = self.initial_backoff
+            attempt = 0
+            while window:
+                ok, errs, rejected = self.send_window(window)
+                num_ok += ok
+                self.stats["docs"] += ok
+                errors.extend(errs)
+                if not rejected:
+                    self.target_bytes = min(self.max_bytes, self.target_bytes * 1.25)
+                    break
+                self.stats["rejected"] += len(rejected)
+                self.target_bytes = max(self.min_bytes, self.target_bytes / 2)
+                attempt += 1
+                if attempt > self.max_retries:
+                    errors.extend([{"rejected": a.get("_id")} for a in rejected])
+                    break
+                logging.warning("ES rejected %d bulk actions, retrying in %ss with requests of %d bytes",
+                                len(rejected), backoff, self.target_bytes)
+                self.stats["retries"] += 1
+                time.sleep(backoff)
+                backoff = min(self.max_backoff, backoff * 2)
+                window = rejected
+            self.stats["bytes"] += size
+        self.stats["time"] += time.time() - t0
+        return num_ok, errors
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        elapsed = stats["time"] or 1e-6
+        stats["docs_per_sec"] = round(stats["docs"] / elapsed, 1)
+        stats["bytes_per_sec"] = round(stats["bytes"] / elapsed, 1)
+        stats["target_bytes"] = int(self.target_bytes)
+        return stats
+
 class ESIndexer():
     def __init__(self, index, doc_type, es_host, step=10000,
                  number_of_shards=10, number_of_replicas=0, 
-                 check_index=True, **kwargs):
+                 check_index=True, bulk_settings=None, es_client=None, **kwargs):
         self.es_host = es_host
-        self._es = get_es(es_host, **kwargs)
+        # an existing client can be passed (ex: reused by process workers)
+        self._es = es_client or get_es(es_host, **kwargs)
         if check_index:
             # if index is actually an alias, resolve the alias to
             # the real underlying index
@@ -101,6 +225,10 @@ class ESIndexer():
         self.number_of_replicas = int(number_of_replicas)   # set number_of_replicas when create_index
         self.step = step   # the bulk size when doing bulk operation.
         self.s = None      # number of records to skip, useful to continue indexing after an error.
+        # if set, dict of AdaptiveBulkSender parameters, index_bulk() then sends
+        # requests sized by bytes, in parallel. Last stats are stored in bulk_stats
+        self.bulk_settings = bulk_settings
+        self.bulk_stats = None
 
     @wrapper
     def get_biothing(self, bid, only_source=False, **kwargs):
@@ -202,7 +330,12 @@ class ESIndexer():
             })
             return ndoc
         actions = (_get_bulk(doc) for doc in docs)
-        num_ok,errors = helpers.bulk(self._es, actions, chunk_size=step)
+        if self.bulk_settings is not None:
+            sender = AdaptiveBulkSender(self._es, **self.bulk_settings)
+            num_ok,errors = sender.send(actions)
+            self.bulk_stats = sender.get_stats()
+        else:
+            num_ok,errors = helpers.bulk(self._es, actions, chunk_size=step)
         if errors:
             raise ElasticsearchException("%d errors while bulk-indexing: %s" % (len(errors),[str(e) for e in errors]))
         return num_ok, errors
@@ -262,6 +395,18 @@ class ESIndexer():
         actions = (_get_bulk(doc) for doc in partial_docs)
         return helpers.bulk(self._es, actions, chunk_size=step, **kwargs)
 
+    def get_settings(self):
+        """return the current index settings (under "index" key)"""
+        s = self._es.indices.get_settings(index=self._index)
+        return s[self._index]["settings"]["index"]
+
+    def update_settings(self, settings):
+        """update dynamic index settings, a None value resets a setting to its default"""
+        return self._es.indices.put_settings(body={"index": settings}, index=self._index)
+
+    def refresh(self):
+        return self._es.indices.refresh(index=self._index)
+
     def get_mapping(self):
         """return the current index mapping"""
         m = self._es.indices.get_mapping(index=self._index, doc_type=self._doc_type)
@@ -763,6 +908,10 @@ def get_hub_config():
     db = Database()
     return db[getattr(db.CONFIG,"HUB_CONFIG_COLLECTION","hub_config")]
 
+def get_job_stats():
+    db = Database()
+    return db[getattr(db.CONFIG,"JOB_STATS_COLLECTION","job_stats")]
+
 def get_source_fullname(col_name):
     pass
 
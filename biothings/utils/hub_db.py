@@ -13,7 +13,8 @@ classes below. See biothings.utils.mongo and biothings.utils.sqlit3 for
 some examples.
 """
 
-import os, asyncio, logging
+import os, asyncio, logging, threading
+import concurrent.futures
 from functools import wraps, partial
 
 from biothings.utils.common import dump as dumpobj, loadobj, \
@@ -66,6 +67,10 @@ def get_last_command():
     """Return the latest cmd document (according to _id)"""
     raise NotImplementedError()
 
+def get_job_stats():
+    """Return a Collection instance storing statistics about jobs (learned from previous runs)"""
+    raise NotImplementedError()
+
 
 
 def get_source_fullname(col_name):
@@ -227,6 +232,68 @@ def restore(archive,drop=False):
         for doc in docs:
             col.save(doc)
 
+##########################################################################
+# async access: hub db calls offloaded to threads, out of the event loop #
+##########################################################################
+
+# number of threads dedicated to hub db access (config.HUB_DB_THREADS)
+HUB_DB_THREADS = 4
+_executor = None
+
+def get_executor():
+    """
+    Thread pool used to access hub db from the event loop, separated from
+    job manager's pools so hub db calls never wait behind jobs
+    """
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(max_workers=HUB_DB_THREADS)
+    return _executor
+
+@asyncio.coroutine
+def run_in_executor(func, *args, **kwargs):
+    """Call func(*args,**kwargs), blocking on hub db, in a thread and return the result"""
+    loop = asyncio.get_event_loop()
+    return (yield from loop.run_in_executor(get_executor(),partial(func,*args,**kwargs)))
+
+def offload(func):
+    """
+    Flag function (ex: a hub command) as only blocking on hub db, so it can
+    safely run in a hub db thread instead of the event loop (see hub API endpoints)
+    """
+    func.__offload__ = True
+    return func
+
+
+class AsyncCollection(object):
+    """
+    Wraps a Collection (any backend), methods are coroutines running
+    the blocking calls in hub db threads. find() returns a list of documents.
+    Ex: docs = yield from AsyncCollection(get_src_dump()).find({"pending":"upload"})
+    """
+
+    def __init__(self, col):
+        self.col = col
+
+    @property
+    def name(self):
+        return self.col.name
+
+    @asyncio.coroutine
+    def find(self, *args, **kwargs):
+        return (yield from run_in_executor(lambda: list(self.col.find(*args,**kwargs))))
+
+    def __getattr__(self, method):
+        if not method in ["find_one","insert_one","update_one","update",
+                          "save","replace_one","remove","count"]:
+            raise AttributeError(method)
+        colmethod = getattr(self.col,method)
+        @asyncio.coroutine
+        def call(*args,**kwargs):
+            return (yield from run_in_executor(colmethod,*args,**kwargs))
+        return call
+
+
 #########################################################################
 # small pubsub framework to track changes in hub db internal collection #
 #########################################################################
@@ -289,15 +356,23 @@ class ChangeWatcher(object):
                     if entity == "event":
                         # sends everything
                         event["data"] = args[0]
-                    klass.event_queue.put_nowait(event)
+                    klass.put_event(event)
                 else:
                     # can't find ID, we send a general event (not specific to one doc)
                     event = {"obj" : entity, "op" : op}
-                    klass.event_queue.put_nowait(event)
+                    klass.put_event(event)
 
             return func(*args,**kwargs)
         return func_wrapper
 
+    @classmethod
+    def put_event(klass,event):
+        if threading.current_thread() is threading.main_thread():
+            klass.event_queue.put_nowait(event)
+        else:
+            # change made from a thread (hub db thread, thread job), queue isn't thread-safe
+            klass.event_queue._loop.call_soon_threadsafe(klass.event_queue.put_nowait,event)
+
     @classmethod
     def wrap(klass,getfunc):
         def decorate():
@@ -327,6 +402,7 @@ def setup(config):
     global get_hub_config
     global get_source_fullname
     global get_last_command
+    global get_job_stats
     get_hub_db_conn = config.hub_db.get_hub_db_conn
     # use ChangeWatcher on internal collections so we can publish changes in real-time
     get_src_dump = ChangeWatcher.wrap(config.hub_db.get_src_dump)
@@ -340,6 +416,9 @@ def setup(config):
     get_hub_config = ChangeWatcher.wrap(config.hub_db.get_hub_config)
     get_source_fullname = config.hub_db.get_source_fullname
     get_last_command = config.hub_db.get_last_command
+    get_job_stats = config.hub_db.get_job_stats
+    global HUB_DB_THREADS
+    HUB_DB_THREADS = getattr(config,"HUB_DB_THREADS",HUB_DB_THREADS)
     # propagate config module to classes
     config.hub_db.Database.CONFIG = config
 
@@ -0,0 +1,178 @@
+"""
+Binary, memory-mapped _id cache format (used by id_feeder when CACHE_FORMAT="mmap").
+
+File layout (integers are native uint64):
+    - header: magic string (8 bytes) + number of _ids (n)
+    - offsets: n+1 offsets, relative to the beginning of data section
+    - data: utf-8 encoded _ids, sorted, concatenated
+
+_ids are sorted so membership can be tested with a binary search, and
+caches merged without loading them in memory. Offsets allow random access,
+so batch #k can be read without reading the k-1 previous ones.
+"""
+import os
+import mmap
+import glob
+import heapq
+import struct
+from array import array
+
+from biothings.utils.common import iter_n
+
+
+MAGIC = b"BTIDC001"
+HEADER = struct.Struct("=8sQ")
+OFFSET_SIZE = array("Q").itemsize
+
+
+class MmapIdCache(object):
+    """
+    Read-only access to a binary _id cache file. Supports len(), indexing
+    and slicing (returning str _ids), "in" operator (O(log n)) and batch access.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, "rb")
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # can't mmap an empty file
+            self._file.close()
+            raise ValueError("Invalid _id cache file '%s' (empty)" % filename)
+        magic, self.count = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError("Invalid _id cache file '%s' (wrong magic %s)" % (filename, magic))
+        self._data_start = HEADER.size + (self.count + 1) * OFFSET_SIZE
+        self._offsets = memoryview(self._mmap)[HEADER.size:self._data_start].cast("Q")
+
+    def close(self):
+        if self._mmap is None:
+            return
+        self._offsets.release()
+        self._offsets = None
+        self._mmap.close()
+        self._mmap = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def _raw(self, i):
+        return self._mmap[self._data_start + self._offsets[i]:self._data_start + self._offsets[i + 1]]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._raw(j).decode() for j in range(*i.indices(self.count))]
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError("_id cache index out of range")
+        return self._raw(i).decode()
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self._raw(i).decode()
+
+    def index(self, _id):
+        """Return position of _id in the cache, raise ValueError if not found"""
+        key = str(_id).encode()
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._raw(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self._raw(lo) == key:
+            return lo
+        raise ValueError("'%s' not in _id cache" % _id)
+
+    def __contains__(self, _id):
+        try:
+            self.index(_id)
+            return True
+        except ValueError:
+            return False
+
+    def num_batches(self, batch_size):
+        return (self.count + batch_size - 1) // batch_size
+
+    def batch(self, num, batch_size):
+        """Return list of _ids for batch number "num" (starting from 0)"""
+        return self[num * batch_size:(num + 1) * batch_size]
+
+    def iter_batches(self, batch_size, start=0):
+        """Iterate over batches of _ids, starting from batch number "start" """
+        for num in range(start, self.num_batches(batch_size)):
+            yield self.batch(num, batch_size)
+
+
+class MmapIdCacheWriter(object):
+    """
+    Build a binary _id cache file. _ids can be added in any order, they're sorted
+    using an external merge sort: sorted runs of "run_size" _ids are written to
+    temporary files ("filename" + ".runN") which are merged when closing the writer.
+    Duplicated _ids are removed. _ids must not contain new line characters.
+    """
+
+    def __init__(self, filename, run_size=1000000):
+        self.filename = filename
+        self.run_size = run_size
+        self.runs = []
+        self.current = []
+
+    def write(self, ids):
+        for _id in ids:
+            self.current.append(str(_id))
+            if len(self.current) >= self.run_size:
+                self.flush_run()
+
+    def flush_run(self):
+        if not self.current:
+            return
+        run_file = "%s.run%d" % (self.filename, len(self.runs))
+        self.current.sort()
+        with open(run_file, "w") as fout:
+            for ids in iter_n(self.current, 10000):
+                fout.write("\n".join(ids) + "\n")
+        self.runs.append(run_file)
+        self.current = []
+
+    def close(self):
+        self.flush_run()
+        data_file = "%s.data" % self.filename
+        offsets = array("Q", [0])
+        runs = [open(run_file) for run_file in self.runs]
+        try:
+            with open(data_file, "wb") as dout:
+                prev = None
+                pos = 0
+                for line in heapq.merge(*runs):
+                    _id = line.rstrip("\n")
+                    if _id == prev:
+                        continue
+                    prev = _id
+                    raw = _id.encode()
+                    dout.write(raw)
+                    pos += len(raw)
+                    offsets.append(pos)
+            with open(self.filename, "wb") as fout:
+                fout.write(HEADER.pack(MAGIC, len(offsets) - 1))
+                offsets.tofile(fout)
+                with open(data_file, "rb") as din:
+                    for chunk in iter(lambda: din.read(1024 * 1024), b""):
+                        fout.write(chunk)
+        finally:
+            for fin in runs:
+                fin.close()
+            for tmpf in glob.glob("%s.run*" % self.filename) + [data_file]:
+                if os.path.exists(tmpf):
+                    os.remove(tmpf)
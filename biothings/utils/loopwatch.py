@@ -0,0 +1,137 @@
+"""
+Event loop watchdog: detects callbacks (or coroutine steps) blocking the
+asyncio event loop longer than a threshold, samples the loop thread's stack
+while it's blocked and aggregates offenders by code location (the callback
+or coroutine called by the loop).
+"""
+import os, sys, time, threading, traceback, logging, datetime
+import asyncio
+
+from biothings.utils.metrics import Histogram
+
+# blocking durations, in seconds
+BLOCKING_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+ASYNCIO_FOLDER = os.path.dirname(asyncio.__file__)
+
+
+def format_frame(frame):
+    return "%s:%s in %s" % (frame.filename,frame.lineno,frame.name)
+
+
+class LoopWatchdog(object):
+    """
+    A heartbeat callback is scheduled on the loop every "threshold/2" seconds,
+    a watchdog thread checks it's on time. If it's late by more than
+    "threshold" seconds, loop is blocked and the stack is sampled. Blocking
+    durations are measured by the heartbeat once the loop is released.
+    """
+
+    def __init__(self, loop, threshold=0.1, stack_depth=15, logger=None):
+        self.loop = loop
+        self.threshold = threshold
+        self.interval = threshold / 2.
+        self.stack_depth = stack_depth
+        self.logger = logger or logging
+        self.histogram = Histogram("loop_blocking_seconds",
+                "Time the event loop was blocked by slow callbacks (longer than threshold)",
+                buckets=BLOCKING_BUCKETS)
+        self.offenders = {} # location => stats
+        self.loop_thread_id = None
+        self.last_beat = None
+        self.sampled = None # (last_beat,stack) for current blocking episode
+        self.running = False
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.loop.call_soon_threadsafe(self.beat)
+        self.thread = threading.Thread(target=self.watch,name="loop-watchdog",daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def beat(self):
+        now = time.monotonic()
+        if self.last_beat is None:
+            self.loop_thread_id = threading.get_ident()
+        else:
+            blocked = now - self.last_beat - self.interval
+            if blocked > self.threshold:
+                self.record(blocked)
+        self.last_beat = now
+        if self.running:
+            self.loop.call_later(self.interval,self.beat)
+
+    def watch(self):
+        while self.running:
+            time.sleep(self.interval / 2.)
+            last = self.last_beat
+            if last is None:
+                continue
+            if time.monotonic() - last - self.interval > self.threshold:
+                with self.lock:
+                    if self.sampled is None or self.sampled[0] != last:
+                        # first time we see it's blocked, capture what's running
+                        self.sampled = (last,self.sample())
+
+    def sample(self):
+        frame = sys._current_frames().get(self.loop_thread_id)
+        if frame is None:
+            return None
+        return traceback.extract_stack(frame)
+
+    def get_location(self, stack):
+        """
+        Return the callback (or coroutine) called by the loop in stack,
+        that is the first frame after asyncio's internals
+        """
+        for i in range(len(stack) - 1,-1,-1):
+            if stack[i].filename.startswith(ASYNCIO_FOLDER):
+                if i + 1 < len(stack):
+                    return format_frame(stack[i + 1])
+                break
+        return format_frame(stack[0])
+
+    def record(self, blocked):
+        with self.lock:
+            stack = None
+            if self.sampled and self.sampled[0] == self.last_beat:
+                stack = self.sampled[1]
+            self.sampled = None
+        if stack:
+            location = self.get_location(stack)
+        else:
+            # blocked for less than watchdog's resolution
+            location = "unknown (not sampled)"
+        self.histogram.observe(blocked)
+        with self.lock:
+            stats = self.offenders.setdefault(location,{"count" : 0, "total_time" : 0., "max_time" : 0.})
+            stats["count"] += 1
+            stats["total_time"] += blocked
+            stats["last_seen"] = datetime.datetime.now().isoformat()
+            if blocked >= stats["max_time"]:
+                stats["max_time"] = blocked
+                if stack:
+                    stats["stack"] = [format_frame(f) for f in stack[-self.stack_depth:]]
+        self.logger.warning("Event loop blocked for %.3fs by %s" % (blocked,location))
+
+    def report(self, reset=False):
+        """
+        Return blocking offenders, worst first (total blocking time), and
+        blocking durations histogram. If reset is True, start over.
+        """
+        with self.lock:
+            offenders = [dict(stats,location=loc) for loc,stats in self.offenders.items()]
+            if reset:
+                self.offenders = {}
+        offenders.sort(key=lambda e: e["total_time"],reverse=True)
+        res = {"threshold" : self.threshold,
+               "offenders" : offenders,
+               "histogram" : self.histogram.to_dict()}
+        if reset:
+            with self.histogram.lock:
+                self.histogram.values = {}
+        return res
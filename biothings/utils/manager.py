@@ -1,4 +1,4 @@
-import importlib, threading, re, copy
+import sys, importlib, threading, re, copy, itertools
 import asyncio, aiocron
 import os, inspect, types, glob, psutil
 import dill as pickle
@@ -11,9 +11,114 @@ import concurrent.futures
 from biothings import config
 logger = config.logger
 
-from biothings.utils.mongo import get_src_conn
-from biothings.utils.common import timesofar, get_random_string, sizeof_fmt
-from biothings.utils.hub_db import get_src_dump, get_src_build
+from biothings.utils.mongo import get_src_conn, get_client_stats
+from biothings.utils.common import timesofar, get_random_string, sizeof_fmt, \
+                                   get_class_from_classpath
+from biothings.utils.metrics import MetricsRegistry
+from biothings.utils.hub_db import get_src_dump, get_src_build, get_job_stats, \
+                                   AsyncCollection, run_in_executor
+
+
+# resources which can be opened once per process worker, by name (see init_worker()),
+# config.HUB_WORKER_RESOURCES lists which ones are opened when the worker starts
+WORKER_RESOURCES = {
+        "src_db" : "biothings.utils.mongo.get_src_db",
+        "target_db" : "biothings.utils.mongo.get_target_db",
+        }
+# modules imported when a worker starts (config.HUB_WORKER_PRELOAD_MODULES)
+WORKER_PRELOAD_MODULES = ["pymongo","elasticsearch","biothings.utils.mongo","biothings.utils.es"]
+
+# resources (connections, ...) opened within current process, keyed by pid:
+# a forked process never reuses connections from its parent
+_worker_resources = {}
+
+
+def get_worker_resource(key, factory=None):
+    """
+    Return resource identified by "key", created once per process calling
+    factory() (or the function named in WORKER_RESOURCES if factory is None),
+    then reused by all jobs running in that process.
+    """
+    pkey = (os.getpid(),key)
+    if not pkey in _worker_resources:
+        if factory is None:
+            factory = get_class_from_classpath(WORKER_RESOURCES[key])
+        _worker_resources[pkey] = factory()
+    return _worker_resources[pkey]
+
+
+def init_worker(preload_modules=None, resources=None):
+    """
+    Process pool initializer: import heavy modules and open connections
+    once, when the worker starts, instead of within the first job it runs.
+    Failures are only logged, jobs would then try again on their own.
+    """
+    for modname in preload_modules or []:
+        try:
+            importlib.import_module(modname)
+        except Exception as e:
+            logger.warning("Can't preload module '%s' in worker %s: %s" % (modname,os.getpid(),e))
+    for name in resources or []:
+        try:
+            get_worker_resource(name)
+        except Exception as e:
+            logger.warning("Can't open resource '%s' in worker %s: %s" % (name,os.getpid(),e))
+
+
+def reset_peak_memory():
+    """Reset current process' RSS high-water mark (Linux only, ignored otherwise)"""
+    try:
+        with open("/proc/self/clear_refs","w") as fout:
+            fout.write("5")
+    except (IOError,OSError):
+        pass
+
+
+def get_peak_memory():
+    """
+    Return current process' RSS high-water mark (since last reset_peak_memory() call
+    when supported), or current RSS if not available
+    """
+    try:
+        with open("/proc/self/status") as fin:
+            for line in fin:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError,OSError):
+        pass
+    return psutil.Process().memory_info().rss
+
+
+class JobResult(object):
+    """Results from a process job, with the worker's peak memory while running it"""
+
+    def __init__(self, results, peak_mem):
+        self.results = results
+        self.peak_mem = peak_mem
+
+
+# worker info and pid file of the job running in current thread, set by track()
+_current_job = threading.local()
+
+
+def update_job_status(**status):
+    """
+    Record status information (progress, throughput, ...) about the job running in
+    current process/thread, reported by job manager within job's info, as "status".
+    Does nothing when not called from a job.
+    """
+    worker = getattr(_current_job,"worker",None)
+    if not worker:
+        return
+    worker["job"].setdefault("status",{}).update(status)
+    # job manager may read pid file at any time, replace it atomically
+    tmpfile = _current_job.pidfile + ".tmp"
+    try:
+        with open(tmpfile,"wb") as fout:
+            pickle.dump(worker,fout)
+        os.replace(tmpfile,_current_job.pidfile)
+    except OSError as e:
+        logger.debug("Can't update job status: %s" % e)
 
 
 def track(func):
@@ -76,7 +181,14 @@ def track(func):
             worker["job"]["id"] = _id
             pidfile = os.path.join(config.RUN_DIR,"%s.pickle" % fn)
             pickle.dump(worker, open(pidfile,"wb"))
-            results = func(*args,**kwargs)
+            _current_job.worker = worker
+            _current_job.pidfile = pidfile
+            if ptype == "process":
+                # worker's memory usage is learned from job to job (see JobManager)
+                reset_peak_memory()
+                results = JobResult(func(*args,**kwargs),get_peak_memory())
+            else:
+                results = func(*args,**kwargs)
         except Exception as e:
             import traceback
             trace = traceback.format_exc()
@@ -84,6 +196,7 @@ def track(func):
             # we want to store exception so for now, just make a reference
             exc = e
         finally:
+            _current_job.worker = None
             if pidfile and os.path.exists(pidfile):
                 logger.debug("Remove PID file '%s'" % pidfile)
                 os.unlink(pidfile)
@@ -105,6 +218,20 @@ def do_work(job_id, ptype, pinfo=None, func=None, *args, **kwargs):
     return func(*args,**kwargs)
 
 
+# priority classes per job category, lower values run first (can be
+# overridden with config.JOB_PRIORITIES, or "__priority__" in pinfo)
+JOB_PRIORITIES = {
+        "admin" : 0,
+        "indexer" : 1, "indexmanager" : 1,
+        "snapshooter" : 1, "snapshotmanager" : 1,
+        "syncer" : 2, "releaser" : 2, "releasemanager" : 2,
+        "builder" : 3, "differ" : 3, "diffmanager" : 3,
+        "uploader" : 4, "dumper" : 4,
+        "inspector" : 5,
+        }
+DEFAULT_JOB_PRIORITY = 4
+
+
 def find_process(pid):
     g = psutil.process_iter()
     for p in g:
@@ -179,7 +306,10 @@ class BaseManager(object):
             raise ManagerError("poll_schedule is not defined")
         @asyncio.coroutine
         def check_pending(state):
-            sources = [src for src in col.find({'pending': state}) if type(src['_id']) == str]
+            # don't block the event loop while querying hub db
+            acol = AsyncCollection(col)
+            sources = yield from acol.find({'pending': state})
+            sources = [src for src in sources if type(src['_id']) == str]
             if sources:
                 logger.info("Found %d resources with pending flag %s (%s)" % \
                         (len(sources),state,repr([src["_id"] for src in sources])))
@@ -187,7 +317,7 @@ class BaseManager(object):
                 logger.info("Run %s for pending flag %s on source '%s'" % (func,state,src["_id"]))
                 try:
                     # first reset flag to make sure we won't call func multiple time
-                    col.update({"_id":src["_id"]},{"$pull":{"pending":state}})
+                    yield from acol.update({"_id":src["_id"]},{"$pull":{"pending":state}})
                     func(src)
                 except ResourceNotFound:
                     logger.error("Resource '%s' has a pending flag set to %s but is not registered in manager" % \
@@ -293,6 +423,19 @@ class BaseStatusRegisterer(object):
             doc = merge_index_info(doc,stage_info)
             self.collection.replace_one({"_id" : doc["_id"]},doc)
 
+    @asyncio.coroutine
+    def load_doc_async(self, key_name, stage):
+        """Same as load_doc(), hub db accessed from a thread (not blocking the event loop)"""
+        return (yield from run_in_executor(self.load_doc,key_name,stage))
+
+    @asyncio.coroutine
+    def register_status_async(self, *args, **kwargs):
+        """
+        Same as register_status() (or its subclass' version), to be used from
+        coroutines: hub db is accessed from a thread (not blocking the event loop)
+        """
+        return (yield from run_in_executor(self.register_status,*args,**kwargs))
+
 
 class BaseSourceManager(BaseManager):
     """
@@ -429,14 +572,17 @@ class JobManager(object):
             logger.debug("Adjusting number of worker to 1")
             self.num_workers = 1
         self.num_threads = num_threads or self.num_workers
-        self.process_queue = process_queue or concurrent.futures.ProcessPoolExecutor(max_workers=self.num_workers)
+        self.process_queue = process_queue or self.new_process_queue()
         # TODO: limit the number of threads (as argument) ?
         self.thread_queue = thread_queue or concurrent.futures.ThreadPoolExecutor(max_workers=self.num_threads)
         if default_executor == "thread":
             self.loop.set_default_executor(self.thread_queue)
         else:
             self.loop.set_default_executor(self.process_queue)
-        self.ok_to_run = asyncio.Semaphore()
+        self.waiting_jobs = [] # (priority,counter,waiting info), see check_constraints()
+        self.job_counter = itertools.count() # FIFO order within a priority class
+        self.scheduler_event = asyncio.Event()
+        self.scheduler = None
         # auto-creata RUN_DIR
         if not os.path.exists(config.RUN_DIR):
             os.makedirs(config.RUN_DIR)
@@ -457,7 +603,170 @@ class JobManager(object):
         self.auto_recycle_setting = auto_recycle # keep setting if we need to restore it its orig value
         self.jobs = {} # all active jobs (thread/process)
         self._pchildren = []
+        self.pending_jobs = {} # job_id => (pinfo,executor), jobs waiting to be launched
+        self.reservations = {} # job_id => memory reserved while job is running
+        self.job_stats = None # learned peak memory usage, per job category (loaded from hub db)
+        self.running_jobs = {} # job_id => (pinfo,executor,started_at)
+        self.setup_metrics()
         self.clean_staled()
+        # loaded once, before the loop runs (hub db calls are blocking)
+        self.load_job_stats()
+
+    def new_process_queue(self):
+        """
+        Process pool which workers preload modules and open connections
+        when they start (see init_worker()). Pool initializers require python 3.7,
+        with older versions resources are opened by the first job needing them
+        (see get_worker_resource())
+        """
+        if sys.version_info < (3,7):
+            return concurrent.futures.ProcessPoolExecutor(max_workers=self.num_workers)
+        preload = getattr(config,"HUB_WORKER_PRELOAD_MODULES",WORKER_PRELOAD_MODULES)
+        resources = getattr(config,"HUB_WORKER_RESOURCES",list(WORKER_RESOURCES))
+        return concurrent.futures.ProcessPoolExecutor(max_workers=self.num_workers,
+                initializer=init_worker,initargs=(preload,resources))
+
+    def setup_metrics(self):
+        """
+        Metrics about jobs, queues and workers (see metrics()). Counters and
+        histograms are updated as jobs run, gauges are computed when collected.
+        """
+        self.metrics_registry = MetricsRegistry(prefix="biothings_hub_")
+        reg = self.metrics_registry
+        self.jobs_counter = reg.counter("jobs_total","Jobs launched",["category","executor","status"])
+        self.job_duration = reg.histogram("job_duration_seconds","Job running time, per step",
+                                          ["category","step","executor"])
+        self.constraints_wait = reg.histogram("job_wait_seconds",
+                "Time spent by jobs waiting to be launched (check_constraints)",["category","executor"])
+        def by_category(jobs):
+            counts = {}
+            for job in jobs:
+                key = (job[0].get("category") or "",job[1])
+                counts[key] = counts.get(key,0) + 1
+            return [({"category" : cat, "executor" : ex},cnt) for (cat,ex),cnt in sorted(counts.items())]
+        reg.gauge("jobs_running","Jobs currently running",
+                  lambda: by_category(self.running_jobs.values()),["category","executor"])
+        reg.gauge("jobs_pending","Jobs waiting for constraints to be met before being launched",
+                  lambda: by_category(self.pending_jobs.values()),["category","executor"])
+        reg.gauge("process_queue_queued","Jobs submitted to the process pool, waiting for a free worker",
+                  self.get_queued_process_jobs)
+        reg.gauge("process_pool_workers","Size of the process pool",lambda: self.num_workers or 0)
+        reg.gauge("process_pool_utilization","Ratio of busy process workers",
+                  lambda: self.num_workers and \
+                          len([j for j in self.running_jobs.values() if j[1] == "process"]) / self.num_workers or 0)
+        reg.gauge("thread_pool_workers","Size of the thread pool",lambda: self.num_threads or 0)
+        reg.gauge("worker_memory_bytes","Memory (RSS) used by each process worker",
+                  self.get_workers_memory,["pid"])
+        reg.gauge("hub_memory_bytes","Memory (RSS) used by the hub and its workers",lambda: self.hub_memory)
+        reg.gauge("reserved_memory_bytes","Memory reserved by running jobs (declared or learned peak usage)",
+                  lambda: sum(self.reservations.values()))
+        reg.gauge("mongo_clients","MongoDB clients requested within hub process, per outcome",
+                  lambda: [({"outcome" : k},v) for k,v in sorted(get_client_stats().items()) \
+                          if k in ["created","reused","forked"]],["outcome"])
+        reg.gauge("mongo_clients_open","MongoDB clients currently cached within hub process",
+                  lambda: get_client_stats()["open"])
+        reg.gauge("mongo_client_reuse_rate","Ratio of MongoDB client requests served from cache",
+                  lambda: get_client_stats()["reuse_rate"])
+        reg.gauge("max_memory_usage_bytes","Max memory usage allowed for the hub (0: no limit)",
+                  lambda: self.max_memory_usage or 0)
+
+    def get_queued_process_jobs(self):
+        if not self.process_queue:
+            return 0
+        running = len([j for j in self.running_jobs.values() if j[1] == "process"])
+        return max(len(self.process_queue._pending_work_items) - min(running,self.num_workers or 0),0)
+
+    def get_workers_memory(self):
+        mems = []
+        for proc in self.pchildren:
+            try:
+                mems.append(({"pid" : proc.pid},proc.memory_info().rss))
+            except psutil.NoSuchProcess:
+                self._pchildren = None
+        return mems
+
+    def job_waiting(self, job_id, pinfo, executor):
+        self.pending_jobs[job_id] = (pinfo or {},executor,time.time())
+
+    def job_started(self, job_id):
+        pinfo,executor,submitted_at = self.pending_jobs.pop(job_id)
+        reserved = self.get_reservation(pinfo)
+        if reserved:
+            self.reservations[job_id] = reserved
+        self.constraints_wait.observe(time.time() - submitted_at,
+                category=pinfo.get("category") or "",executor=executor)
+        self.running_jobs[job_id] = (pinfo,executor,time.time())
+
+    def job_done(self, job_id, failed=False):
+        # a worker is free, memory may have been released, predicates may change
+        self.notify()
+        self.reservations.pop(job_id,None)
+        pinfo,executor,started_at = self.running_jobs.pop(job_id)
+        labels = {"category" : pinfo.get("category") or "", "executor" : executor}
+        self.jobs_counter.inc(status=failed and "failed" or "success",**labels)
+        self.job_duration.observe(time.time() - started_at,step=pinfo.get("step") or "",**labels)
+
+    def load_job_stats(self):
+        if self.job_stats is None:
+            self.job_stats = {}
+            try:
+                for doc in get_job_stats().find():
+                    self.job_stats[doc["_id"]] = doc
+            except Exception as e:
+                logger.warning("Can't load jobs statistics from hub db: %s" % e)
+        return self.job_stats
+
+    def get_learned_peak(self, pinfo):
+        """
+        Return peak memory usage observed in previous runs for the same kind
+        of job (same category and source if known, or same category), or None
+        """
+        stats = self.load_job_stats().get(pinfo.get("category"))
+        if not stats:
+            return None
+        return stats.get("sources",{}).get(str(pinfo.get("source"))) or stats.get("peak_mem")
+
+    def learn_peak(self, pinfo, peak_mem):
+        """
+        Record peak memory usage of a process job, if higher than previously observed.
+        Statistics are saved to hub db from a thread (thread_queue, the loop's default
+        executor may be a process pool), the returned future (None if nothing changed)
+        can be used to wait for it.
+        """
+        category = pinfo.get("category")
+        if not category or not peak_mem:
+            return
+        stats = self.load_job_stats().setdefault(category,{"_id" : category, "peak_mem" : 0, "sources" : {}})
+        source = str(pinfo.get("source"))
+        if peak_mem <= stats["sources"].get(source,0):
+            return
+        stats["sources"][source] = peak_mem
+        stats["peak_mem"] = max(stats["peak_mem"],peak_mem)
+        stats["updated_at"] = datetime.datetime.now()
+        def save(doc):
+            try:
+                get_job_stats().save(doc)
+            except Exception as e:
+                logger.warning("Can't save jobs statistics to hub db: %s" % e)
+        # saved copy, stats can be updated again in the meantime
+        return self.loop.run_in_executor(self.thread_queue,partial(save,dict(stats,sources=dict(stats["sources"]))))
+
+    def get_reservation(self, pinfo):
+        """
+        Return memory to reserve for a job while it's running: declared
+        requirement (pinfo["__reqs__"]["mem"]) or learned peak usage.
+        """
+        pinfo = pinfo or {}
+        return pinfo.get("__reqs__",{}).get("mem") or self.get_learned_peak(pinfo) or 0
+
+    def metrics(self, fmt="json"):
+        """
+        Return job manager's metrics, as a dict (fmt="json") or as text
+        in Prometheus exposition format (fmt="text", see also /metrics API endpoint)
+        """
+        if fmt == "text":
+            return self.metrics_registry.render()
+        return self.metrics_registry.to_dict()
 
     def stop(self,force=False,recycling=False,wait=1):
         @asyncio.coroutine
@@ -478,7 +787,7 @@ class JobManager(object):
                 if recycling:
                     # now replace
                     logger.info("Replacing process queue with new one")
-                    self.process_queue = concurrent.futures.ProcessPoolExecutor(max_workers=self.num_workers)
+                    self.process_queue = self.new_process_queue()
                 else:
                     self.process_queue = None
             except Exception as e:
@@ -546,18 +855,99 @@ class JobManager(object):
         """
         return self.stop(recycling=True)
 
+    def get_priority(self, pinfo=None):
+        """
+        Return job's priority class (lower values run first), from "__priority__"
+        in pinfo if any, or according to job's category (see JOB_PRIORITIES)
+        """
+        pinfo = pinfo or {}
+        if "__priority__" in pinfo:
+            return pinfo["__priority__"]
+        priorities = getattr(config,"JOB_PRIORITIES",JOB_PRIORITIES)
+        return priorities.get(pinfo.get("category"),DEFAULT_JOB_PRIORITY)
+
+    def notify(self):
+        """
+        Wake up the scheduler so waiting jobs are checked again. Called when
+        a job is done, can also be called when anything a predicate depends on
+        has changed.
+        """
+        self.scheduler_event.set()
+
     @asyncio.coroutine
     def check_constraints(self,pinfo=None):
-        mem_req = pinfo and pinfo.get("__reqs__",{}).get("mem") or 0
-        t0 = time.time()
-        waited = False
-        sleep_time = 5 
-        if mem_req:
-            logger.info("Job {cat:%s,source:%s,step:%s} requires %s memory, checking if available" % \
-                    (pinfo.get("category"), pinfo.get("source"), pinfo.get("step"), sizeof_fmt(mem_req)))
+        """
+        Wait until job described by pinfo can be launched. Waiting jobs are
+        ordered by priority class (see get_priority()), then in FIFO order,
+        and admitted by the scheduler (see schedule()).
+        """
+        waiting = {"pinfo" : pinfo or {}, "future" : asyncio.Future(),
+                   "since" : time.time(), "reason" : None}
+        self.waiting_jobs.append((self.get_priority(pinfo),next(self.job_counter),waiting))
+        if self.scheduler is None or self.scheduler.done():
+            self.scheduler = asyncio.ensure_future(self.schedule())
+        self.notify()
+        try:
+            yield from waiting["future"]
+        except asyncio.CancelledError:
+            # scheduler forgets cancelled jobs when woken up
+            self.notify()
+            raise
+
+    @asyncio.coroutine
+    def schedule(self):
+        """
+        Admit waiting jobs, as long as there are some. Jobs are checked again
+        when notified (see notify()), or every JOB_CHECK_INTERVAL seconds as
+        some constraints can change without notice (memory, external predicates)
+        """
+        while self.waiting_jobs:
+            self.scheduler_event.clear()
+            # forget jobs not waiting anymore (cancelled)
+            self.waiting_jobs = [w for w in self.waiting_jobs if not w[2]["future"].done()]
+            if not self.waiting_jobs:
+                break
+            try:
+                entry = self.next_runnable_job()
+            except Exception as e:
+                logger.exception("Error while checking jobs constraints: %s" % e)
+                entry = None
+            if entry:
+                self.waiting_jobs.remove(entry)
+                entry[2]["future"].set_result(True)
+                # let the job register itself as running before checking next ones
+                # (see defer_to_process() and defer_to_thread())
+                yield from asyncio.sleep(0)
+                continue
+            try:
+                yield from asyncio.wait_for(self.scheduler_event.wait(),
+                                            getattr(config,"JOB_CHECK_INTERVAL",5))
+            except asyncio.TimeoutError:
+                pass
+
+    def postpone(self, waiting, reason):
+        # only report when reason changes, not each time the job is checked
+        if waiting["reason"] != reason:
+            pinfo = waiting["pinfo"]
+            logger.info("Can't run job {cat:%s,source:%s,step:%s} right now, %s (job's already been postponed for %s)" % \
+                    (pinfo.get("category"), pinfo.get("source"), pinfo.get("step"), reason, timesofar(waiting["since"])))
+            waiting["reason"] = reason
+
+    def next_runnable_job(self):
+        """
+        Return first waiting job (by priority, then FIFO) which can be launched, or None.
+        Hub's constraints (memory, queue length) apply to all jobs: if they're not met,
+        no job is launched. Predicates apply to each job: a job with failing predicates
+        doesn't prevent following ones from being launched.
+        """
+        waitings = sorted(self.waiting_jobs,key=lambda e: e[:2])
+        if not waitings:
+            return None
+        head = waitings[0][2]
+        hub_mem = None
         if self.max_memory_usage:
             hub_mem = self.hub_memory
-            while hub_mem >= self.max_memory_usage:
+            if hub_mem >= self.max_memory_usage:
                 if self.auto_recycle:
                     pworkers = self.get_pid_files()
                     tworkers = self.get_thread_files()
@@ -573,102 +963,116 @@ class JobManager(object):
                                              "memory usage is still too high (needs at least %s more)" % sizeof_fmt(abs(avail_mem)) + \
                                              "now turn auto-recycling off to prevent infinite recycling...")
                                 self.auto_recycle = False
+                            self.notify()
                         fut.add_done_callback(recycled)
-                logger.info("Hub is using too much memory to launch job {cat:%s,source:%s,step:%s} (%s used, more than max allowed %s), wait a little (job's already been postponed for %s)" % \
-                        (pinfo.get("category"), pinfo.get("source"), pinfo.get("step"), sizeof_fmt(hub_mem),
-                         sizeof_fmt(self.max_memory_usage),timesofar(t0)))
-                yield from asyncio.sleep(sleep_time)
-                waited = True
-                hub_mem = self.hub_memory
-        if mem_req:
-            # max allowed mem is either the limit we gave and the os limit
-            max_mem = self.max_memory_usage and self.max_memory_usage or self.avail_memory
-            # TODO: check projected memory (jobs with mem requirements currently running
-            # as those jobs may not have reached their max mem usage yet)
-            hub_mem = self.hub_memory
-            while mem_req >= (max_mem - hub_mem):
-                logger.info("Job {cat:%s,source:%s,step:%s} needs %s to run, not enough to launch it (hub consumes %s while max allowed is %s), wait a little  (job's already been postponed for %s)" % \
-                        (pinfo.get("category"), pinfo.get("source"), pinfo.get("step"), sizeof_fmt(mem_req), sizeof_fmt(hub_mem),
-                         sizeof_fmt(max_mem), timesofar(t0)))
-                yield from asyncio.sleep(sleep_time)
-                waited = True
-                # refresh limites and usage (manager can be modified from hub
-                # thus memory usage can be modified on-the-fly
-                hub_mem = self.hub_memory
-                max_mem = self.max_memory_usage and self.max_memory_usage or self.avail_memory
+                self.postpone(head,"hub is using too much memory (%s used, more than max allowed %s)" % \
+                        (sizeof_fmt(hub_mem),sizeof_fmt(self.max_memory_usage)))
+                return None
         pendings = len(self.process_queue._pending_work_items.keys()) - config.HUB_MAX_WORKERS
-        while pendings >= config.MAX_QUEUED_JOBS:
-            if not waited:
-                logger.info("Can't run job {cat:%s,source:%s,step:%s} right now, too much pending jobs in the queue (max: %s), will retry until possible" % \
-                        (pinfo.get("category"), pinfo.get("source"), pinfo.get("step"), config.MAX_QUEUED_JOBS))
-            yield from asyncio.sleep(sleep_time)
-            pendings = len(self.process_queue._pending_work_items.keys()) - config.HUB_MAX_WORKERS
-            waited = True
-        # finally check custom predicates
-        predicates =  pinfo and pinfo.get("__predicates__",[])
-        failed_predicate = None
-        while True:
-            for predicate in predicates:
-                if not predicate(self):
-                    failed_predicate = predicate
-                    break # for loop (most inner one)
-                else:
-                    # reset flag
-                    failed_predicate = None
+        if pendings >= config.MAX_QUEUED_JOBS:
+            self.postpone(head,"too much pending jobs in the queue (max: %s)" % config.MAX_QUEUED_JOBS)
+            return None
+        for entry in waitings:
+            waiting = entry[2]
+            pinfo = waiting["pinfo"]
+            mem_req = self.get_reservation(pinfo)
+            if mem_req:
+                # max allowed mem is either the limit we gave and the os limit
+                max_mem = self.max_memory_usage and self.max_memory_usage or self.avail_memory
+                if hub_mem is None:
+                    hub_mem = self.hub_memory
+                # running jobs may not have reached their peak usage yet, account for
+                # what's reserved for them (on top of hub's own usage)
+                hub_rss = self.hub_process.memory_info().rss
+                projected = max(hub_mem,hub_rss + sum(self.reservations.values()))
+                if mem_req >= (max_mem - hub_rss):
+                    # can't fit even with nothing else running (learned peak, or requirement, is
+                    # over the limit): launched alone rather than blocking it (and jobs behind) forever
+                    if self.jobs:
+                        self.postpone(waiting,"needs %s to run, more than max allowed %s, " % (sizeof_fmt(mem_req),sizeof_fmt(max_mem)) + \
+                                "waiting for running jobs to finish to launch it alone")
+                        return None
+                    logger.warning("Job {cat:%s,source:%s,step:%s} needs %s to run, more than max allowed %s, launching it anyway" % \
+                            (pinfo.get("category"),pinfo.get("source"),pinfo.get("step"),sizeof_fmt(mem_req),sizeof_fmt(max_mem)))
+                elif mem_req >= (max_mem - projected):
+                    # no job can overtake it, it would never get enough memory otherwise
+                    self.postpone(waiting,"needs %s to run, not enough to launch it " % sizeof_fmt(mem_req) + \
+                            "(hub consumes %s, %s reserved by running jobs, while max allowed is %s)" % \
+                            (sizeof_fmt(hub_mem),sizeof_fmt(sum(self.reservations.values())),sizeof_fmt(max_mem)))
+                    return None
+            failed_predicate = None
+            try:
+                for predicate in pinfo.get("__predicates__",[]):
+                    if not predicate(self):
+                        failed_predicate = predicate
+                        break
+            except Exception as e:
+                # job can't be checked, report error to the job only
+                logger.exception("Error while checking predicates for job %s: %s" % (pinfo,e))
+                self.waiting_jobs.remove(entry)
+                waiting["future"].set_exception(e)
+                continue
             if failed_predicate:
-                logger.info("Can't run job {cat:%s,source:%s,step:%s} right now, predicate %s failed, will retry until possible" % \
-                        (pinfo.get("category"), pinfo.get("source"), pinfo.get("step"),failed_predicate))
-                yield from asyncio.sleep(sleep_time)
-                waited = True
-            else:
-                break # while loop
-        if waited:
-            logger.info("Job {cat:%s,source:%s,step:%s} now can be launched (total waiting time: %s)" % (pinfo.get("category"),
-                pinfo.get("source"), pinfo.get("step"), timesofar(t0)))
-            # auto-recycle could have been temporarily disabled until more mem is assigned.
-            # if we've been able to run the job, it means we had enough mem so restore
-            # recycling setting (if auto_recycle was False, it's ignored
-            if self.auto_recycle_setting:
-                self.auto_recycle = self.auto_recycle_setting
+                self.postpone(waiting,"predicate %s failed" % failed_predicate)
+                continue
+            if waiting["reason"]:
+                logger.info("Job {cat:%s,source:%s,step:%s} now can be launched (total waiting time: %s)" % (pinfo.get("category"),
+                    pinfo.get("source"), pinfo.get("step"), timesofar(waiting["since"])))
+                # auto-recycle could have been temporarily disabled until more mem is assigned.
+                # if we've been able to run the job, it means we had enough mem so restore
+                # recycling setting (if auto_recycle was False, it's ignored
+                if self.auto_recycle_setting:
+                    self.auto_recycle = self.auto_recycle_setting
+            return entry
+        return None
 
     @asyncio.coroutine
     def defer_to_process(self, pinfo=None, func=None, *args):
 
         @asyncio.coroutine
-        def run(future, job_id):
-            nonlocal pinfo
-            yield from self.check_constraints(pinfo)
-            self.ok_to_run.release()
-            # pinfo can contain predicates hardly pickleable during run_in_executor
-            # but we also need not to touch the original one
-            copy_pinfo = copy.deepcopy(pinfo)
-            copy_pinfo.pop("__predicates__",None)
-            self.jobs[job_id] = copy_pinfo
-            res = self.loop.run_in_executor(self.process_queue,
-                    partial(do_work,job_id,"process",copy_pinfo,func,*args))
-            def ran(f):
-                try:
-                    # consume future, just to trigger potential exceptions
-                    r = f.result()
-                finally:
-                    # whatever the result we want to make sure to clean the job registry
-                    # to keep it sync with actual running jobs
-                    self.jobs.pop(job_id)
-            res.add_done_callback(ran)
-            res = yield from res
+        def run(future, res):
+            res = (yield from res).results
             # process could generate other parallelized jobs and return a Future/Task
             # If so, we want to make sure we get the results from that task
             if type(res) == asyncio.Task:
                 res = yield from res
             future.set_result(res)
-        yield from self.ok_to_run.acquire()
+        job_id = get_random_string()
+        self.job_waiting(job_id,pinfo,"process")
+        try:
+            # wait until job is admitted
+            yield from self.check_constraints(pinfo)
+        except (Exception,asyncio.CancelledError):
+            # CancelledError isn't an Exception subclass as of python 3.8
+            self.pending_jobs.pop(job_id,None)
+            raise
+        # job is registered and submitted right away, before any other job
+        # is checked (predicates and queue length depend on it)
+        # pinfo can contain predicates hardly pickleable during run_in_executor
+        # but we also need not to touch the original one
+        copy_pinfo = copy.deepcopy(pinfo)
+        copy_pinfo.pop("__predicates__",None)
+        self.jobs[job_id] = copy_pinfo
+        self.job_started(job_id)
+        res = self.loop.run_in_executor(self.process_queue,
+                partial(do_work,job_id,"process",copy_pinfo,func,*args))
+        def ran(f):
+            try:
+                # consume future, just to trigger potential exceptions
+                r = f.result()
+                self.learn_peak(copy_pinfo,r.peak_mem)
+            finally:
+                # whatever the result we want to make sure to clean the job registry
+                # to keep it sync with actual running jobs
+                self.jobs.pop(job_id)
+                self.job_done(job_id,failed=f.cancelled() or f.exception() is not None)
+        res.add_done_callback(ran)
         f = asyncio.Future()
-        def runned(innerf,job_id):
+        def runned(innerf):
             if innerf.exception():
                 f.set_exception(innerf.exception())
-        job_id = get_random_string()
-        fut = asyncio.ensure_future(run(f,job_id))
-        fut.add_done_callback(partial(runned,job_id=job_id))
+        fut = asyncio.ensure_future(run(f,res))
+        fut.add_done_callback(runned)
         return f
 
     @asyncio.coroutine
@@ -677,36 +1081,41 @@ class JobManager(object):
         skip_check = pinfo.get("__skip_check__", False)
 
         @asyncio.coroutine
-        def run(future, job_id):
-            if not skip_check:
-                yield from self.check_constraints(pinfo)
-                self.ok_to_run.release()
-            self.jobs[job_id] = pinfo
-            res = self.loop.run_in_executor(self.thread_queue,
-                    partial(do_work,job_id,"thread",pinfo,func,*args))
-            def ran(f):
-                try:
-                    r = f.result()
-                finally:
-                    # whatever the result we want to make sure to clean the job registry
-                    # to keep it sync with actual running jobs
-                    self.jobs.pop(job_id)
-            res.add_done_callback(ran)
+        def run(future, res):
             res = yield from res
             # thread could generate other parallelized jobs and return a Future/Task
             # If so, we want to make sure we get the results from that task
             if type(res) == asyncio.Task:
                 res = yield from res
             future.set_result(res)
+        job_id = get_random_string()
+        self.job_waiting(job_id,pinfo,"thread")
         if not skip_check:
-            yield from self.ok_to_run.acquire()
+            try:
+                # wait until job is admitted
+                yield from self.check_constraints(pinfo)
+            except (Exception,asyncio.CancelledError):
+                self.pending_jobs.pop(job_id,None)
+                raise
+        self.jobs[job_id] = pinfo
+        self.job_started(job_id)
+        res = self.loop.run_in_executor(self.thread_queue,
+                partial(do_work,job_id,"thread",pinfo,func,*args))
+        def ran(f):
+            try:
+                r = f.result()
+            finally:
+                # whatever the result we want to make sure to clean the job registry
+                # to keep it sync with actual running jobs
+                self.jobs.pop(job_id)
+                self.job_done(job_id,failed=f.cancelled() or f.exception() is not None)
+        res.add_done_callback(ran)
         f = asyncio.Future()
-        def runned(innerf, job_id):
+        def runned(innerf):
             if innerf.exception():
                 f.set_exception(innerf.exception())
-        job_id = get_random_string()
-        fut = asyncio.ensure_future(run(f,job_id))
-        fut.add_done_callback(partial(runned,job_id=job_id))
+        fut = asyncio.ensure_future(run(f,res))
+        fut.add_done_callback(runned)
         return f
 
     def submit(self,pfunc,schedule=None):
@@ -0,0 +1,158 @@
+"""
+Minimal metrics registry (counters, histograms, gauges), rendered in the
+Prometheus text exposition format, or as a dict (hub's JSON API/shell).
+No dependency on prometheus_client: metrics are only collected within
+the hub process (job manager) and scraped from the hub API.
+"""
+import math
+import threading
+
+# default histogram buckets, in seconds (jobs last from milliseconds to hours)
+DEFAULT_BUCKETS = (0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600, 4 * 3600, 12 * 3600)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    items = []
+    for k, v in labels:
+        v = str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        items.append('%s="%s"' % (k, v))
+    return "{%s}" % ",".join(items)
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+
+    type = None
+
+    def __init__(self, name, doc, labelnames=()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        assert set(labels) == set(self.labelnames), \
+            "Expecting labels %s for metric '%s', got %s" % (self.labelnames, self.name, list(labels))
+        return tuple((k, labels[k]) for k in self.labelnames)
+
+    def samples(self):
+        """Return list of (suffix, labels, value)"""
+        with self.lock:
+            return [("", key, value) for key, value in sorted(self.values.items(), key=lambda e: str(e[0]))]
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.doc),
+                 "# TYPE %s %s" % (self.name, self.type)]
+        for suffix, labels, value in self.samples():
+            lines.append("%s%s%s %s" % (self.name, suffix, format_labels(labels), format_value(value)))
+        return lines
+
+    def to_dict(self):
+        return [dict(labels, **{"value": value}) for _, labels, value in self.samples()]
+
+
+class Counter(Metric):
+
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    Gauge which value(s) are computed when collected, calling "func",
+    returning a number, or a list of (labels dict, value) when labelnames are defined
+    """
+
+    type = "gauge"
+
+    def __init__(self, name, doc, func, labelnames=()):
+        super(Gauge, self).__init__(name, doc, labelnames)
+        self.func = func
+
+    def samples(self):
+        if not self.labelnames:
+            return [("", (), self.func())]
+        return [("", self.key(labels), value) for labels, value in self.func()]
+
+
+class Histogram(Metric):
+
+    type = "histogram"
+
+    def __init__(self, name, doc, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, doc, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = {"buckets": [0] * len(self.buckets), "sum": 0, "count": 0}
+            data = self.values[key]
+            for i, upper in enumerate(self.buckets):
+                if value <= upper:
+                    data["buckets"][i] += 1
+            data["sum"] += value
+            data["count"] += 1
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, data in sorted(self.values.items(), key=lambda e: str(e[0])):
+                for upper, cnt in zip(self.buckets, data["buckets"]):
+                    samples.append(("_bucket", key + (("le", format_value(upper)),), cnt))
+                samples.append(("_sum", key, data["sum"]))
+                samples.append(("_count", key, data["count"]))
+        return samples
+
+    def to_dict(self):
+        res = []
+        with self.lock:
+            for key, data in sorted(self.values.items(), key=lambda e: str(e[0])):
+                res.append(dict(key, **{"sum": data["sum"], "count": data["count"],
+                                        "buckets": dict(zip([format_value(b) for b in self.buckets],
+                                                            data["buckets"]))}))
+        return res
+
+
+class MetricsRegistry(object):
+
+    def __init__(self, prefix=""):
+        self.prefix = prefix
+        self.metrics = []
+
+    def register(self, metric):
+        metric.name = self.prefix + metric.name
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, doc, labelnames=()):
+        return self.register(Counter(name, doc, labelnames))
+
+    def gauge(self, name, doc, func, labelnames=()):
+        return self.register(Gauge(name, doc, func, labelnames))
+
+    def histogram(self, name, doc, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, doc, labelnames, buckets))
+
+    def render(self):
+        """Return all metrics, in Prometheus text format"""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self):
+        return dict([(metric.name, metric.to_dict()) for metric in self.metrics])
@@ -1,4 +1,5 @@
-import time, logging, os, io, glob, datetime
+import time, logging, os, io, glob, datetime, math, pickle, threading
+import concurrent.futures
 import dateutil.parser as dtparser
 from functools import wraps
 from pymongo import MongoClient, DESCENDING
@@ -12,6 +13,7 @@ from biothings.utils.common import timesofar, get_random_string, iter_n, \
                                    dotdict
 from biothings.utils.backend import DocESBackend, DocMongoBackend
 from biothings.utils.hub_db import IDatabase, ChangeWatcher
+from biothings.utils.idcache import MmapIdCache, MmapIdCacheWriter
 # stub, until set to real config module
 config = None
 
@@ -38,6 +40,54 @@ class Database(MongoClient,IDatabase):
         super(Database,self).__init__(dbname)
         self.name = dbname
 
+
+# clients cached within current process, by URI (see get_client())
+_clients = {}
+_clients_lock = threading.Lock()
+client_stats = {"created" : 0, "reused" : 0, "forked" : 0}
+
+def _reset_clients_after_fork():
+    # clients (and lock) inherited from parent process can't be used
+    global _clients_lock
+    _clients_lock = threading.Lock()
+    client_stats["forked"] += len(_clients)
+    _clients.clear()
+
+if hasattr(os,"register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_clients_after_fork)
+
+def get_client(uri):
+    """
+    Return a Database client connected to "uri", created once per process
+    and reused afterwards (a client is thread-safe and holds its own connection
+    pool). Clients created by a parent process are never reused after a fork.
+    """
+    pid = os.getpid()
+    with _clients_lock:
+        cached = _clients.get(uri)
+        if cached and cached[0] != pid:
+            # fork not caught by register_at_fork (or py<3.7)
+            client_stats["forked"] += 1
+            cached = None
+        if cached:
+            client_stats["reused"] += 1
+            return cached[1]
+        client = Database(uri)
+        _clients[uri] = (pid,client)
+        client_stats["created"] += 1
+        return client
+
+def get_client_stats():
+    """
+    Return statistics about clients cached in current process: number of clients
+    created, reused, discarded after a fork, and reuse rate
+    """
+    stats = dict(client_stats)
+    stats["open"] = len(_clients)
+    total = stats["created"] + stats["reused"]
+    stats["reuse_rate"] = total and stats["reused"] / total or 0.0
+    return stats
+
 def requires_config(func):
     @wraps(func)
     def func_wrapper(*args,**kwargs):
@@ -60,7 +110,7 @@ def get_conn(server, port):
                                                  server, port)
         else:
             uri = "mongodb://{}:{}".format(server, port)
-        conn = Database(uri)
+        conn = get_client(uri)
         return conn
     except (AttributeError,ValueError) as e:
         # missing config variables (or invalid), we'll pretend it's a dummy access to mongo
@@ -72,7 +122,7 @@ def get_conn(server, port):
 
 @requires_config
 def get_hub_db_conn():
-    conn = Database(config.HUB_DB_BACKEND["uri"])
+    conn = get_client(config.HUB_DB_BACKEND["uri"])
     return conn
 
 @requires_config
@@ -129,6 +179,11 @@ def get_hub_config(conn=None):
     conn = conn or get_hub_db_conn()
     return conn[config.DATA_HUB_DB_DATABASE][getattr(config,"HUB_CONFIG_COLLECTION","hub_config")]
 
+@requires_config
+def get_job_stats(conn=None):
+    conn = conn or get_hub_db_conn()
+    return conn[config.DATA_HUB_DB_DATABASE][getattr(config,"JOB_STATS_COLLECTION","job_stats")]
+
 @requires_config
 def get_last_command(conn=None):
     cmd = get_cmd(conn)
@@ -144,7 +199,7 @@ def get_target_conn():
                                              config.DATA_TARGET_PORT)
     else:
         uri = "mongodb://{}:{}".format(config.DATA_TARGET_SERVER,config.DATA_TARGET_PORT)
-    conn = Database(uri)
+    conn = get_client(uri)
     return conn
 
 
@@ -253,6 +308,140 @@ def doc_feeder(collection, step=1000, s=None, e=None, inbatch=False, query=None,
         cur.close()
 
 
+# $type aliases for _id values. Numbers (int, long, double, decimal) are compared,
+# and range-queried, together
+ID_TYPES = [((bool,),"bool"),
+            ((int,float,bson.int64.Int64,bson.decimal128.Decimal128),"number"),
+            ((str,),"string"),
+            ((bson.objectid.ObjectId,),"objectId"),
+            ((datetime.datetime,),"date"),
+            ((bytes,bson.binary.Binary),"binData"),
+            ((dict,),"object")]
+
+def get_id_type(_id):
+    """Return $type alias for _id value (see ID_TYPES)"""
+    for klasses,alias in ID_TYPES:
+        if isinstance(_id,klasses):
+            return alias
+    raise ValueError("Unsupported _id type %s (%s)" % (type(_id),repr(_id)))
+
+def get_id_types(col):
+    """
+    Return the set of _id types found in the whole collection (as $type aliases),
+    fetching one document per type, until none is left with a type not seen yet
+    """
+    types = set()
+    while True:
+        query = types and {"$nor" : [{"_id" : {"$type" : t}} for t in sorted(types)]} or {}
+        doc = col.find_one(query,{"_id":1})
+        if doc is None:
+            return types
+        types.add(get_id_type(doc["_id"]))
+
+def get_id_boundaries(col, batch_size, exact=False, oversampling=10, id_type=None):
+    """
+    Return a sorted list of _id values splitting collection "col" into ranges
+    of about batch_size documents each (see id_ranges()). By default, boundaries
+    are picked from a random sample of _ids ($sample, oversampling times the
+    number of ranges), so range sizes are approximate. "exact" True will walk
+    the whole _id index with a sorted cursor and pick every batch_size-th _id.
+    Range queries are type-bracketed in MongoDB (a string boundary won't match
+    integer _ids), so all _ids must have the same type, or only _ids of type
+    id_type (a $type alias, see get_id_type()) are considered. ValueError is
+    raised if different types are found. See get_id_ranges() to cover the
+    whole collection whatever the types.
+    """
+    if isinstance(col,DocMongoBackend):
+        col = col.target_collection
+    query = id_type and {"_id" : {"$type" : id_type}} or {}
+    total = col.count(query)
+    num_ranges = math.ceil(total / batch_size)
+    if num_ranges <= 1:
+        return []
+    if exact:
+        bounds = []
+        types = set()
+        cur = col.find(query,{"_id":1}).sort("_id",1).batch_size(batch_size)
+        try:
+            for i,doc in enumerate(cur):
+                types.add(get_id_type(doc["_id"]))
+                if i and i % batch_size == 0:
+                    bounds.append(doc["_id"])
+        finally:
+            cur.close()
+    else:
+        sample_size = min(total,num_ranges * oversampling)
+        pipeline = [{"$sample" : {"size" : sample_size}},{"$project" : {"_id" : 1}}]
+        if query:
+            pipeline.insert(0,{"$match" : query})
+        ids = [d["_id"] for d in col.aggregate(pipeline,allowDiskUse=True)]
+        types = set([get_id_type(_id) for _id in ids])
+        if len(types) == 1:
+            ids = sorted(set(ids))
+            step = len(ids) / num_ranges
+            bounds = sorted(set([ids[int(i * step)] for i in range(1,num_ranges)]))
+        else:
+            bounds = []
+    if len(types) > 1:
+        raise ValueError("Found different _id types in collection '%s' (%s), " % (col.name,types) + \
+                         "can't split it into _id ranges")
+    return bounds
+
+def get_id_ranges(col, batch_size, exact=False, oversampling=10):
+    """
+    Return a list of ranges of about batch_size documents each, covering the whole
+    collection (see get_id_boundaries() and id_ranges()). When _ids have different
+    types, each type gets its own ranges, restricted to that type with a query,
+    as a third element: (lo,hi,query). Ranges are meant to be used with id_range_query(*id_range).
+    "col" can also be a list of collections (eg. old and new collections to compare),
+    ranges then cover all of them: each _id type found in any collection gets ranges,
+    computed from the collection having the most documents of that type.
+    """
+    cols = type(col) in (list,tuple) and list(col) or [col]
+    cols = [isinstance(c,DocMongoBackend) and c.target_collection or c for c in cols]
+    col_types = [get_id_types(c) for c in cols]
+    types = set().union(*col_types)
+    def boundaries(id_type=None):
+        query = id_type and {"_id" : {"$type" : id_type}} or {}
+        candidates = [c for c,ctypes in zip(cols,col_types) if ctypes and (id_type is None or id_type in ctypes)]
+        if not candidates:
+            return []
+        largest = len(candidates) == 1 and candidates[0] or max(candidates,key=lambda c: c.count(query))
+        return get_id_boundaries(largest,batch_size,exact=exact,oversampling=oversampling,id_type=id_type)
+    if len(types) <= 1:
+        return id_ranges(boundaries())
+    ranges = []
+    for id_type in sorted(types):
+        ranges.extend([id_range + ({"_id" : {"$type" : id_type}},) for id_range in id_ranges(boundaries(id_type))])
+    return ranges
+
+def id_ranges(boundaries):
+    """
+    Convert sorted _id boundaries (see get_id_boundaries()) into a list of
+    (lo,hi) ranges, lo included, hi excluded. First and last ranges are open
+    (lo or hi is None) so the whole collection is covered (for _ids of
+    the same type as boundaries).
+    """
+    bounds = [None] + list(boundaries) + [None]
+    return [(bounds[i],bounds[i+1]) for i in range(len(bounds) - 1)]
+
+def id_range_query(lo, hi, query=None):
+    """
+    Return a query selecting documents with lo <= _id < hi. lo and/or hi
+    can be None, meaning no lower/upper limit. Optional "query" is combined
+    with the range condition.
+    """
+    cond = {}
+    if not lo is None:
+        cond["$gte"] = lo
+    if not hi is None:
+        cond["$lt"] = hi
+    rquery = cond and {"_id" : cond} or {}
+    if query:
+        rquery = rquery and {"$and" : [query,rquery]} or query
+    return rquery
+
+
 def get_cache_filename(col_name):
     cache_folder = getattr(config,"CACHE_FOLDER",None)
     if not cache_folder:
@@ -287,51 +476,61 @@ def invalidate_cache(col_name,col_type="src"):
                 pass
 
 
-# TODO: this func deals with different backend, should not be in bt.utils.mongo
-# and doc_feeder should do the same as this function regarding backend support
+def get_collection_timestamp(col, logger=logging):
+    """
+    Return the timestamp of the last build (target collection) or upload
+    (source collection) of collection "col", None if not found. Raise
+    ValueError if "col" is neither a target nor a source collection, KeyError
+    if metadata has no timestamp.
+    """
+    ts = None
+    if col.database.name == config.DATA_TARGET_DATABASE:
+        info = get_src_db()["src_build"].find_one({"_id": col.name})
+        if not info:
+            logger.warning("Can't find information for target collection '%s'" % col.name)
+        else:
+            ts = info.get("_meta",{}).get("build_date")
+            ts = ts and dtparser.parse(ts).timestamp()
+    elif col.database.name == config.DATA_SRC_DATABASE:
+        src_dump = get_src_dump()
+        info = src_dump.find_one({"$where":"function() {if(this.upload) {for(var index in this.upload.jobs) {if(this.upload.jobs[index].step == \"%s\") return this;}}}" % col.name})
+        if not info:
+            logger.warning("Can't find information for source collection '%s'" % col.name)
+        else:
+            ts = info["upload"]["jobs"][col.name]["started_at"].timestamp()
+    else:
+        raise ValueError("Can't find metadata for collection '%s' (not a target, not a source collection)" % col)
+    return ts
+
+def get_collection_uuid(col):
+    """Return collection's UUID (changes when it's dropped/re-created), None if not available"""
+    try:
+        res = col.database.command("listCollections",filter={"name":col.name})
+        return res["cursor"]["firstBatch"][0]["info"]["uuid"]
+    except Exception:
+        return None
+
+
 @requires_config
-def id_feeder(col, batch_size=1000, build_cache=True, logger=logging,
-              force_use=False, force_build=False, validate_only=False):
-    """Return an iterator for all _ids in collection "col"
-       Search for a valid cache file if available, if not
-       return a doc_feeder for that collection. Valid cache is
-       a cache file that is newer than the collection.
-       "db" can be "target" or "src".
-       "build_cache" True will build a cache file as _ids are fetched, 
-       if no cache file was found
-       "force_use" True will use any existing cache file and won't check whether
-       it's valid of not.
-       "force_build" True will build a new cache even if current one exists
-       and is valid.
-       "validate_only" will directly return [] if the cache is valid (convenient
-       way to check if the cache is valid)
+def get_cache_file(col, logger=logging, force_use=False, force_build=False):
+    """Return (cache_file,use_cache,build_cache) for collection "col", as used
+       by id_feeder: cache file name (None if no metadata or no CACHE_FOLDER),
+       whether it's valid and can be used (see id_feeder's "force_use" and
+       "force_build") and whether a cache can be built for this collection.
     """
-    src_db = get_src_db()
     ts = None
     found_meta = True
+    build_cache = True
 
     if isinstance(col,DocMongoBackend):
         col = col.target_collection
 
     try:
-        if col.database.name == config.DATA_TARGET_DATABASE:
-            info = src_db["src_build"].find_one({"_id": col.name})
-            if not info:
-                logger.warning("Can't find information for target collection '%s'" % col.name)
-            else:
-                ts = info.get("_meta",{}).get("build_date")
-                ts = ts and dtparser.parse(ts).timestamp()
-        elif col.database.name == config.DATA_SRC_DATABASE:
-            src_dump = get_src_dump()
-            info = src_dump.find_one({"$where":"function() {if(this.upload) {for(var index in this.upload.jobs) {if(this.upload.jobs[index].step == \"%s\") return this;}}}" % col.name})
-            if not info:
-                logger.warning("Can't find information for source collection '%s'" % col.name)
-            else:
-                ts = info["upload"]["jobs"][col.name]["started_at"].timestamp()
-        else:
-            logging.warning("Can't find metadata for collection '%s' (not a target, not a source collection)" % col)
-            found_meta = False
-            build_cache = False
+        ts = get_collection_timestamp(col,logger=logger)
+    except ValueError as e:
+        logging.warning(e)
+        found_meta = False
+        build_cache = False
     except KeyError:
         logger.warning("Couldn't find timestamp in database for '%s'" % col.name)
     except Exception as e:
@@ -346,7 +545,7 @@ def id_feeder(col, batch_size=1000, build_cache=True, logger=logging,
         cache_file = get_cache_filename(col.name)
         try:
             # size of empty file differs depending on compression
-            empty_size = {None:0,"xz":32,"gzip":25,"bz2":14}
+            empty_size = {None:0,"xz":32,"gzip":25,"bz2":14,"mmap":24}
             if force_build:
                 logger.warning("Force building cache file")
                 use_cache = False
@@ -368,17 +567,57 @@ def id_feeder(col, batch_size=1000, build_cache=True, logger=logging,
                     logger.info("Cache is too old, discard it")
         except FileNotFoundError:
             pass
+    return cache_file,use_cache,build_cache
+
+
+# TODO: this func deals with different backend, should not be in bt.utils.mongo
+# and doc_feeder should do the same as this function regarding backend support
+@requires_config
+def id_feeder(col, batch_size=1000, build_cache=True, logger=logging,
+              force_use=False, force_build=False, validate_only=False,
+              start_batch=0):
+    """Return an iterator for all _ids in collection "col"
+       Search for a valid cache file if available, if not
+       return a doc_feeder for that collection. Valid cache is
+       a cache file that is newer than the collection.
+       "db" can be "target" or "src".
+       "build_cache" True will build a cache file as _ids are fetched, 
+       if no cache file was found
+       "force_use" True will use any existing cache file and won't check whether
+       it's valid of not.
+       "force_build" True will build a new cache even if current one exists
+       and is valid.
+       "validate_only" will directly return [] if the cache is valid (convenient
+       way to check if the cache is valid)
+       "start_batch" skips the first batches and start from batch number
+       "start_batch" (starting from 0). With CACHE_FORMAT="mmap", _ids are
+       stored sorted in a memory-mapped file with offsets, so this batch
+       is directly accessed without reading previous ones.
+    """
+    if isinstance(col,DocMongoBackend):
+        col = col.target_collection
+    cache_file,use_cache,can_build = get_cache_file(col,logger=logger,
+            force_use=force_use,force_build=force_build)
+    build_cache = build_cache and can_build
+    cache_format = getattr(config,"CACHE_FORMAT",None)
     if use_cache:
         logger.debug("Found valid cache file for '%s': %s" % (col.name,cache_file))
         if validate_only:
             logging.debug("Only validating cache, now return")
             return []
+        if cache_format == "mmap":
+            with MmapIdCache(cache_file) as cache_in:
+                for ids in cache_in.iter_batches(batch_size,start=start_batch):
+                    yield ids
+            return
         with open_compressed_file(cache_file) as cache_in:
             if cache_format:
                 iocache = io.TextIOWrapper(cache_in)
             else:
                 iocache = cache_in
-            for ids in iter_n(iocache,batch_size):
+            for bnum,ids in enumerate(iter_n(iocache,batch_size)):
+                if bnum < start_batch:
+                    continue
                 yield [_id.strip() for _id in ids if _id.strip()]
     else:
         logger.debug("No cache file found (or invalid) for '%s', use doc_feeder" % col.name)
@@ -394,7 +633,10 @@ def id_feeder(col, batch_size=1000, build_cache=True, logger=logging,
                 os.remove(tmpcache)
             # use temp file and rename once done
             cache_temp = "%s%s" % (cache_temp,get_random_string())
-            cache_out = get_compressed_outfile(cache_temp,compress=cache_format)
+            if cache_format == "mmap":
+                cache_out = MmapIdCacheWriter(cache_temp)
+            else:
+                cache_out = get_compressed_outfile(cache_temp,compress=cache_format)
             logger.info("Building cache file '%s'" % cache_temp)
         else:
             logger.info("Can't build cache, cache not allowed or no cache folder")
@@ -418,15 +660,20 @@ def id_feeder(col, batch_size=1000, build_cache=True, logger=logging,
             doc_feeder_func = partial(wrap_id)
         else:
             raise Exception("Unknown backend %s" % col)
-        for doc_ids in doc_feeder_func():
+        for bnum,doc_ids in enumerate(doc_feeder_func()):
             doc_ids = [str(_doc["_id"]) for _doc in doc_ids]
-            if build_cache:
+            if build_cache and cache_format == "mmap":
+                cache_out.write(doc_ids)
+            elif build_cache:
                 strout = "\n".join(doc_ids) + "\n"
                 if cache_format:
                     # assuming binary format (b/ccompressed)
                     cache_out.write(strout.encode())
                 else:
                     cache_out.write(strout)
+            if bnum < start_batch:
+                # cache still needs to be fully built
+                continue
             yield doc_ids
         if build_cache:
             cache_out.close()
@@ -437,6 +684,144 @@ def id_feeder(col, batch_size=1000, build_cache=True, logger=logging,
                 logger.exception("Couldn't set final cache filename, building cache failed")
 
 
+def _dump_id_segment(col, id_range, segment_file):
+    """Write _ids found in id_range to segment_file, return the number of _ids"""
+    cnt = 0
+    temp_file = segment_file + "._tmp_"
+    with open(temp_file,"w") as fout:
+        for doc_ids in doc_feeder(col, step=10000, inbatch=True, fields={"_id":1},
+                                  query=id_range_query(*id_range)):
+            fout.write("\n".join([str(d["_id"]) for d in doc_ids]) + "\n")
+            cnt += len(doc_ids)
+    os.rename(temp_file,segment_file)
+    return cnt
+
+
+def _load_checkpoint(checkpoint_file, logger=logging):
+    """Return checkpoint stored in checkpoint_file, None if missing or unreadable"""
+    try:
+        with open(checkpoint_file,"rb") as fin:
+            return pickle.load(fin)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning("Can't read checkpoint '%s', ignored: %s" % (checkpoint_file,e))
+        return None
+
+
+def _save_checkpoint(checkpoint, checkpoint_file):
+    # a checkpoint interrupted while written would be lost, write then rename
+    temp_file = "%s._tmp_" % checkpoint_file
+    with open(temp_file,"wb") as fout:
+        pickle.dump(checkpoint,fout)
+    os.replace(temp_file,checkpoint_file)
+
+
+@requires_config
+def build_id_cache(col, num_segments=None, max_workers=None, logger=logging):
+    """
+    Build the _id cache file for collection "col" (a collection or a source
+    collection name), fetching _ids with "num_segments" parallel range cursors
+    (using "max_workers" threads). Each _id range is written to its own segment
+    file, segments are then merged into the final cache file (CACHE_FORMAT is honored).
+    Progress is checkpointed (cache_file + ".checkpoint") so an interrupted build
+    resumes and only fetches missing segments, as long as the collection didn't
+    change (same uuid, upload/build timestamp and count). The number of fetched _ids
+    must match the collection count, ValueError is raised otherwise.
+    Return the number of _ids in the cache.
+    """
+    if type(col) == str:
+        col = get_src_db()[col]
+    if not getattr(config,"CACHE_FOLDER",None):
+        raise ValueError("No CACHE_FOLDER defined, can't build _id cache")
+    if not os.path.exists(config.CACHE_FOLDER):
+        os.makedirs(config.CACHE_FOLDER)
+    cache_file = get_cache_filename(col.name)
+    cache_format = getattr(config,"CACHE_FORMAT",None)
+    checkpoint_file = "%s.checkpoint" % cache_file
+    num_segments = num_segments or getattr(config,"ID_CACHE_SEGMENTS",16)
+    max_workers = max_workers or getattr(config,"ID_CACHE_WORKERS",4)
+    total = col.count()
+    # checkpoint is only valid for the same data: same collection (dropped/re-created
+    # collections get a new uuid), same upload/build and same count
+    try:
+        timestamp = get_collection_timestamp(col,logger=logger)
+    except Exception:
+        timestamp = None
+    key = {"name" : col.full_name, "uuid" : get_collection_uuid(col),
+           "timestamp" : timestamp, "count" : total}
+    checkpoint = _load_checkpoint(checkpoint_file,logger=logger)
+    if checkpoint is not None:
+        if checkpoint.get("key") != key:
+            logger.info("Collection '%s' changed since last checkpoint, restart building cache" % col.name)
+            checkpoint = None
+        else:
+            logger.info("Resuming cache build for '%s', %d/%d segments already done" % \
+                    (col.name,len(checkpoint["done"]),len(checkpoint["ranges"])))
+    if checkpoint is None:
+        for segfile in glob.glob("%s.seg*" % cache_file):
+            os.remove(segfile)
+        # one set of ranges per _id type, so the whole collection is covered
+        ranges = get_id_ranges(col,math.ceil(total / num_segments) or 1)
+        checkpoint = {"key" : key, "ranges" : ranges, "done" : {}}
+        _save_checkpoint(checkpoint,checkpoint_file)
+
+    segment_files = ["%s.seg%d" % (cache_file,i) for i in range(len(checkpoint["ranges"]))]
+    t0 = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for i,id_range in enumerate(checkpoint["ranges"]):
+            if i in checkpoint["done"]:
+                continue
+            futures[executor.submit(_dump_id_segment,col,id_range,segment_files[i])] = i
+        errors = []
+        for fut in concurrent.futures.as_completed(futures):
+            # keep checkpointing other segments on error so they're not fetched again
+            if fut.exception():
+                logger.error("Segment %d for '%s' failed: %s" % (futures[fut],col.name,fut.exception()))
+                errors.append(fut.exception())
+                continue
+            # checkpoint updated from this thread only
+            checkpoint["done"][futures[fut]] = fut.result()
+            _save_checkpoint(checkpoint,checkpoint_file)
+            logger.info("Segment %d for '%s' done (%d/%d)" % \
+                    (futures[fut],col.name,len(checkpoint["done"]),len(checkpoint["ranges"])))
+        if errors:
+            raise errors[0]
+
+    cnt = sum(checkpoint["done"].values())
+    if cnt != total:
+        # ranges missed (or duplicated) some _ids, or data changed while building:
+        # don't produce an invalid cache, next build will start over
+        for segfile in segment_files:
+            if os.path.exists(segfile):
+                os.remove(segfile)
+        os.remove(checkpoint_file)
+        raise ValueError("Segments for '%s' contain %d _ids but collection has %d documents, " % (col.name,cnt,total) + \
+                         "cache file not built")
+
+    # merge segments, in _id range order
+    cache_temp = "%s._tmp_%s" % (cache_file,get_random_string())
+    if cache_format == "mmap":
+        cache_out = MmapIdCacheWriter(cache_temp)
+    else:
+        cache_out = get_compressed_outfile(cache_temp,compress=cache_format)
+    for segfile in segment_files:
+        with open(segfile) as fin:
+            for ids in iter_n(fin,10000):
+                if cache_format == "mmap":
+                    cache_out.write([_id.rstrip("\n") for _id in ids])
+                else:
+                    cache_out.write("".join(ids).encode())
+    cache_out.close()
+    os.rename(cache_temp,cache_file)
+    for segfile in segment_files:
+        os.remove(segfile)
+    os.remove(checkpoint_file)
+    logger.info("Cache file '%s' built with %d _ids (%s)" % (cache_file,cnt,timesofar(t0)))
+    return cnt
+
+
 def check_document_size(doc):
     """
     Return True if doc isn't too large for mongo DB
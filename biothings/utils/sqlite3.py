@@ -47,6 +47,10 @@ def get_hub_config():
     db = Database()
     return db[getattr(db.CONFIG,"HUB_CONFIG_COLLECTION","hub_config")]
 
+def get_job_stats():
+    db = Database()
+    return db[getattr(db.CONFIG,"JOB_STATS_COLLECTION","job_stats")]
+
 def get_last_command():
     try:
         db = Database()